@@ -22,30 +22,84 @@ import time
 import datetime
 import locale
 import httplib
+import socket
+import re
+import random
+import threading
+import urllib
 import urllib2
+import zlib
+import Queue
 from urllib import urlencode, quote_plus
+from urlparse import urlparse
+from email.utils import parsedate_tz, mktime_tz
 from StringIO import StringIO
-from pprint import pformat
+from bisect import bisect_left
 
 
+# Not lazy: urllib2 imports hashlib anyway
 try:
     # Python >= 2.5
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
-try:
-    from elementtree.ElementTree import parse as parse_xml
-except ImportError:
-    # Python 2.5 and higher
-    from xml.etree.ElementTree import parse as parse_xml
 
-try:
-    import feedparser
-except ImportError:
-    print >>sys.stderr, \
-        "Feedparser not available, no RSS parsing."
-    feedparser = None
+class LazyModule:
+    """Stand-in for a module that is imported on first use, the first of
+    `names` that can be imported. Instances are false if none can be
+    imported, and then print `warning` to stderr.
+    """
+    def __init__(self, names, warning=None):
+        self._names = names
+        self._warning = warning
+        self._module = None
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            for name in self._names:
+                try:
+                    self._module = __import__(name, {}, {}, [''])
+                    break
+                except ImportError:
+                    pass
+            else:
+                if self._warning:
+                    print >>sys.stderr, self._warning
+            self._loaded = True
+        return self._module
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+    def __getattr__(self, name):
+        module = self._load()
+        if module is None:
+            raise ImportError, "No module named %s" % self._names[-1]
+        return getattr(module, name)
+
+    def __repr__(self):
+        return "<LazyModule %s>" % "|".join(self._names)
+
+# Python 2.5 and higher have ElementTree in the standard library
+ElementTree = LazyModule(('elementtree.ElementTree', 'xml.etree.ElementTree'))
+
+feedparser = LazyModule(('feedparser',),
+        "Feedparser not available, no RSS parsing.")
+
+# Python 2.6 and higher have json in the standard library
+json = LazyModule(('json', 'simplejson'))
+
+# The C implementation, for the incremental parsers
+FastElementTree = LazyModule(('xml.etree.cElementTree', 'cElementTree',
+    'elementtree.ElementTree', 'xml.etree.ElementTree'))
+
+def parse_xml(source):
+    return ElementTree.parse(source)
+
+def iterparse_xml(source, events=None):
+    return FastElementTree.iterparse(source, events)
 
 
 ### Static config
@@ -69,8 +123,26 @@ DLCS_OK_MESSAGES = ('done', 'ok')
 "Known text values of positive del.icio.us <result/> answers"
 DLCS_WAIT_TIME = 4
 "Time to wait between API requests"
+DLCS_WAIT_BURST = 1
+"Number of API requests that may be done without waiting"
 DLCS_REQUEST_TIMEOUT = 444
-"Seconds before socket triggers timeout"
+"Seconds before a request times out"
+DLCS_MEMOIZE_CHECK = 60
+"Seconds memoized API results are used before they are requested again"
+DLCS_BULK_RETRIES = 3
+"Number of times a throttled bulk operation is retried"
+DLCS_PAGE_SIZE = 1000
+"Number of posts per posts/all request when iterating over pages"
+DLCS_RETRY_DEADLINE = 600
+"Seconds after the first attempt past which a request is not retried"
+DLCS_KEEPALIVE_POOLSIZE = 2
+"Number of idle persistent connections kept per host"
+DLCS_KEEPALIVE_TIMEOUT = 60
+"Seconds an idle persistent connection is kept before it is discarded"
+DLCS_ACCEPT_ENCODING = 'gzip, deflate'
+"Content codings asked for in requests, see ``DecodingHandler``"
+DLCS_DECODE_BUFSIZE = 16384
+"Bytes of coded response body read at a time"
 DLCS_API_REALM = 'del.icio.us API'
 DLCS_API_HOST = 'api.del.icio.us'
 DLCS_API_PATH = 'v1'
@@ -78,6 +150,14 @@ DLCS_API = "https://%s/%s" % (DLCS_API_HOST, DLCS_API_PATH)
 DLCS_RSS = 'http://feeds.delicious.com/rss/'
 "Old RSS feeds, formerly <http://del.icio.us/rss/>"
 DLCS_FEEDS = 'http://feeds.delicious.com/v2/'
+DLCS_FEED_THREADS = 8
+"Number of feeds a FeedFetcher requests concurrently"
+DLCS_FEED_HOST_CONNECTIONS = 4
+"Maximum number of concurrent feed requests to one host"
+DLCS_FEED_HOST_RATE = 10
+"Maximum number of feed requests per second to one host"
+DLCS_HISTOGRAM_BOUNDS = tuple([.001 * 2 ** i for i in range(17)])
+"Upper bounds in seconds of the latency histogram buckets, 1ms to 65s"
 
 PREFERRED_ENCODING = locale.getpreferredencoding()
 # XXX: might need to check sys.platform/encoding combinations here, ie
@@ -103,58 +183,414 @@ if DEBUG and (HTTP_PROXY or HTTPS_PROXY):
     print >>sys.stderr, \
         "Set proxies to %s, %s from env." % (HTTP_PROXY, HTTPS_PROXY, )
 
-### Timeoutsocket hack taken from FeedParser.py
+### Utility classes
 
-# timeoutsocket allows feedparser to time out rather than hang forever on ultra-
-# slow servers. Python 2.3 now has this functionality available in the standard
-# socket library, so under 2.3 you don't need to install anything.  But you
-# probably should anyway, because the socket module is buggy and timeoutsocket
-# is better.
-try:
-    import timeoutsocket # http://www.timo-tasi.org/python/timeoutsocket.py
-    timeoutsocket.setDefaultSocketTimeout(DLCS_REQUEST_TIMEOUT)
-except ImportError:
-    import socket
-    if hasattr(socket, 'setdefaulttimeout'):
-        socket.setdefaulttimeout(DLCS_REQUEST_TIMEOUT)
-if DEBUG: print >>sys.stderr, \
-    "Set socket timeout to %s seconds" % DLCS_REQUEST_TIMEOUT
+class TokenBucket:
+    """Rate limiter allowing bursts of up to `burst` calls, and on average no
+    more than `rate` calls per second. Call the instance (or ``acquire()``)
+    before each request, it sleeps until a token is available.
 
+    The bucket adapts to the server: ``backoff()`` lowers the rate (to no less
+    than `min_rate`) and may pause all callers for some seconds, after which
+    every call raises the rate by `recovery` until it is back at `max_rate`.
+    Instances are thread-safe and may be shared by several clients.
 
-### Utility classes
+    Some attributes:
+    :rate: the current number of calls per second
+    :max_rate: the configured number of calls per second
+    :burst: the maximum number of calls that pass without waiting
+    :waited: the number of calls throttled
+    :backoffs: the number of times the rate was lowered
+    """
+    def __init__(self, rate, burst=1, min_rate=None, recovery=None):
+        self.rate = self.max_rate = float(rate)
+        self.burst = burst
+        self.min_rate = min_rate or self.max_rate / 16
+        self.recovery = recovery or self.max_rate / 8
+        self.tokens = float(burst)
+        self.waited = 0
+        self.backoffs = 0
+        self._last = time.time()
+        self._lock = threading.Lock()
 
-class _Waiter:
+    def __call__(self, tokens=1):
+        return self.acquire(tokens)
+
+    def acquire(self, tokens=1):
+        """Take `tokens` from the bucket, waiting for them if needed. Returns
+        the number of seconds slept.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            if DEBUG>0: print >>sys.stderr, "Waiting %s seconds." % wait
+            time.sleep(wait)
+        return wait
+
+    def reserve(self, tokens=1):
+        """Take `tokens` from the bucket without waiting. Returns the number
+        of seconds the caller has to wait before it may proceed, for callers
+        that cannot sleep, e.g. coroutines on an event loop.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+            # Callers reserve their tokens before sleeping, so concurrent
+            # callers queue up behind each other
+            self.tokens -= tokens
+            wait = max(0, self._last - now) + max(0, -self.tokens) / self.rate
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.recovery)
+            if wait > 0:
+                self.waited += 1
+        finally:
+            self._lock.release()
+        return wait
+
+    def backoff(self, delay=None):
+        """Halve the rate and empty the bucket, i.e. after the server
+        throttled a request. With `delay` no tokens become available for that
+        many seconds.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+            self.backoffs += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            if delay:
+                self._last = max(self._last, now + delay)
+            if DEBUG>0: print >>sys.stderr, \
+                    "Backing off to %s requests per second." % self.rate
+        finally:
+            self._lock.release()
+
+    def _refill(self, now):
+        if now > self._last:
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self._last) * self.rate)
+            self._last = now
+
+
+class _Waiter(TokenBucket, object):
     """Waiter makes sure a certain amount of time passes between
     successive calls of `Waiter()`.
 
     Some attributes:
-    :last: time of last call
-    :wait: the minimum time needed between calls
+    :wait: the minimum time needed between calls, setting it resets the rate
     :waited: the number of calls throttled
 
-    pydelicious.Waiter is an instance created when the module is loaded.
+    pydelicious.Waiter is an instance created when the module is loaded, it is
+    shared by all API openers that have no `rate_limiter` of their own.
     """
-    def __init__(self, wait):
-        self.wait = wait
-        self.waited = 0
-        self.lastcall = 0;
+    def __init__(self, wait, burst=1):
+        TokenBucket.__init__(self, 1.0 / wait, burst)
 
-    def __call__(self):
-        tt = time.time()
-        wait = self.wait
+    def _get_wait(self):
+        return 1.0 / self.max_rate
 
-        timeago = tt - self.lastcall
+    def _set_wait(self, wait):
+        self._lock.acquire()
+        try:
+            self.rate = self.max_rate = 1.0 / wait
+            self.min_rate = self.max_rate / 16
+            self.recovery = self.max_rate / 8
+        finally:
+            self._lock.release()
 
-        if timeago < wait:
-            wait = wait - timeago
-            if DEBUG>0: print >>sys.stderr, "Waiting %s seconds." % wait
-            time.sleep(wait)
-            self.waited += 1
-            self.lastcall = tt + wait
-        else:
-            self.lastcall = tt
+    wait = property(_get_wait, _set_wait)
+
+Waiter = _Waiter(DLCS_WAIT_TIME, DLCS_WAIT_BURST)
+
+
+class RetryPolicy:
+    """Decides if and when ``http_request()`` repeats a failed request.
+
+    Failures have separate budgets: up to `connect` retries after connection
+    errors, `timeout` retries after requests timed out and `throttled`
+    retries after 503 answers. Retry n waits `base` * 2 ** (n - 1) seconds,
+    at most `max_delay`, less a random fraction of up to `jitter` so that
+    clients failing at the same moment do not retry in lockstep. The
+    Retry-After header of a throttled request is the minimum delay. No retry
+    starts `deadline` seconds after the first attempt, and attempts time out
+    by then.
+
+    The policy of an opener is its `retry_policy` (see
+    ``build_api_opener()``), or the shared ``DefaultRetryPolicy``. Policies
+    keep no state per request and may be shared.
 
-Waiter = _Waiter(DLCS_WAIT_TIME)
+    Some attributes:
+    :budgets: maps 'connect', 'timeout' and 'throttled' to a number of
+        retries
+    :deadline: seconds for all attempts, or None
+    """
+    def __init__(self, connect=3, timeout=3, throttled=0, base=1,
+            max_delay=60, jitter=.5, deadline=DLCS_RETRY_DEADLINE):
+        self.budgets = {'connect': connect, 'timeout': timeout,
+                'throttled': throttled}
+        self.base = base
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self._random = random.Random()
+
+    def classify(self, error):
+        """Return the kind of failure an exception is, 'connect', 'timeout'
+        or 'throttled', or None for errors that are not retried.
+        """
+        if isinstance(error, PyDeliciousThrottled):
+            return 'throttled'
+        if isinstance(error, urllib2.HTTPError):
+            if error.code == 503:
+                return 'throttled'
+            return None
+        if isinstance(error, urllib2.URLError):
+            error = error.reason
+        if isinstance(error, socket.timeout):
+            return 'timeout'
+        if isinstance(error, (urllib2.URLError, socket.error,
+                httplib.HTTPException, EOFError)) or \
+                isinstance(error, basestring):
+            return 'connect'
+        return None
+
+    def retry_after(self, error):
+        "Return the seconds to wait the server asked for, or None. "
+        delay = getattr(error, 'retry_after', None)
+        if delay is None and isinstance(error, urllib2.HTTPError):
+            value = error.info().get('Retry-After')
+            if value:
+                delay = retry_after_seconds(value)
+        return delay
+
+    def delay(self, kind, failures, elapsed, retry_after=None):
+        """Return the seconds to wait before retrying after a failure of
+        `kind`, or None to give up. `failures` maps the kinds to the number
+        of failed attempts so far, `elapsed` is the time since the first
+        attempt.
+        """
+        if failures.get(kind, 0) > self.budgets.get(kind, 0):
+            return None
+        retries = sum(failures.values())
+        delay = min(self.max_delay, self.base * 2 ** (retries - 1))
+        delay -= delay * self.jitter * self._random.random()
+        if retry_after:
+            delay = max(delay, retry_after)
+        if self.deadline is not None and elapsed + delay >= self.deadline:
+            return None
+        return delay
+
+    def timeout(self, elapsed, timeout=DLCS_REQUEST_TIMEOUT):
+        "Return the timeout of an attempt started `elapsed` seconds late. "
+        if self.deadline is None:
+            return timeout
+        return max(.001, min(timeout, self.deadline - elapsed))
+
+DefaultRetryPolicy = RetryPolicy()
+
+
+class LRUCache:
+    """Mapping of at most `size` items, the least recently used item is
+    dropped to make room for a new one. Instances are thread-safe.
+
+    Some attributes:
+    :size: the maximum number of items
+    :hits: the number of successful lookups
+    :misses: the number of lookups for absent keys
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = 0
+        self._items = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._tick += 1
+            item = self._items[key]
+            item[1] = self._tick
+            return item[0]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        self._lock.acquire()
+        try:
+            if key not in self._items and len(self._items) >= self.size:
+                lru = min([(tick, k) for k, (v, tick) in self._items.items()])
+                del self._items[lru[1]]
+            self._tick += 1
+            self._items[key] = [value, self._tick]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class Histogram:
+    """Counts values in buckets with the upper `bounds`, and one bucket for
+    larger values. Percentiles are estimated as the bound of the bucket they
+    fall in. Not thread-safe, see ``RequestMetrics``.
+
+    Some attributes:
+    :count: the number of values
+    :total: the sum of the values
+    :min: the smallest value
+    :max: the largest value
+    """
+    def __init__(self, bounds=DLCS_HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        "Return the estimated `p` percentile (0 to 100), or None. "
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+
+    def snapshot(self):
+        "Return the histogram as dictionary, with the non-empty buckets. "
+        return {'count': self.count, 'total': self.total, 'min': self.min,
+            'max': self.max, 'mean': self.count and self.total / self.count,
+            'p50': self.percentile(50), 'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': [(i < len(self.bounds) and self.bounds[i] or None, n)
+                for i, n in enumerate(self.buckets) if n]}
+
+
+class RequestMetrics:
+    """Counters and latency histograms per API path, or per other key such
+    as a URL. A ``DeliciousAPI`` records its requests in its `metrics`, and
+    ``record`` can be added to ``http_request_hooks`` to record every HTTP
+    request by URL. Instances are thread-safe.
+
+    A request is recorded with a dictionary of statistics, those that are
+    missing or None are left out:
+
+    :wait: seconds waiting for the rate limiter
+    :network: seconds spent requesting and reading the response
+    :parse: seconds spent parsing the response
+    :total: seconds for the entire call, including the above
+    :bytes: the size of the response body
+    :wire_bytes: the size of the response body on the network, if coded
+    :retries: the number of times the request was repeated after errors
+    :error: the class name of the exception raised, or None
+    """
+    timings = ('wait', 'network', 'parse', 'total')
+
+    def __init__(self, bounds=DLCS_HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, stats):
+        self._lock.acquire()
+        try:
+            m = self._keys.get(key)
+            if m is None:
+                m = self._keys[key] = {'count': 0, 'errors': {},
+                    'retries': 0, 'bytes': 0, 'wire_bytes': 0}
+                for timing in self.timings:
+                    m[timing] = Histogram(self.bounds)
+            m['count'] += 1
+            m['retries'] += stats.get('retries') or 0
+            m['bytes'] += stats.get('bytes') or 0
+            # uncoded responses are as large on the network
+            m['wire_bytes'] += stats.get('wire_bytes') or \
+                    stats.get('bytes') or 0
+            error = stats.get('error')
+            if error:
+                m['errors'][error] = m['errors'].get(error, 0) + 1
+            for timing in self.timings:
+                if stats.get(timing) is not None:
+                    m[timing].add(stats[timing])
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return the metrics per key as dictionary of plain values, e.g. to
+        write as JSON.
+        """
+        self._lock.acquire()
+        try:
+            snapshot = {}
+            for key, m in self._keys.items():
+                s = snapshot[key] = {'count': m['count'],
+                    'errors': dict(m['errors']), 'retries': m['retries'],
+                    'bytes': m['bytes'], 'wire_bytes': m['wire_bytes']}
+                for timing in self.timings:
+                    s[timing] = m[timing].snapshot()
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._keys.clear()
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Return a table with the number of requests, errors, retries,
+        bytes and bytes on the network, and the mean and 90th percentile of
+        the timings per key.
+        """
+        lines = ["%-20s %6s %6s %7s %10s %10s  %s" % ('path', 'count',
+            'errors', 'retries', 'bytes', 'wire', '  '.join(["%-15s" % t
+                for t in self.timings]))]
+        snapshot = self.snapshot()
+        for key in sorted(snapshot):
+            m = snapshot[key]
+            timings = []
+            for timing in self.timings:
+                h = m[timing]
+                if h['count']:
+                    timings.append("%6.3f/%-8.3f" % (h['mean'], h['p90']))
+                else:
+                    timings.append("%-15s" % '-')
+            lines.append("%-20s %6i %6i %7i %10i %10i  %s" % (key,
+                m['count'], sum(m['errors'].values()), m['retries'],
+                m['bytes'], m['wire_bytes'], '  '.join(timings)))
+        lines.append("(seconds mean/90th percentile)")
+        return "\n".join(lines)
 
 
 class PyDeliciousException(Exception):
@@ -185,9 +621,542 @@ class DeliciousHTTPErrorHandler(urllib2.HTTPDefaultErrorHandler):
     def http_error_503(self, req, fp, code, msg, headers):
         # Retry-After?
         errmsg = "Try again later."
+        delay = None
         if 'Retry-After' in headers:
             errmsg = "You may try again after %s" % headers['Retry-After']
-        raise PyDeliciousThrottled, errmsg
+            delay = retry_after_seconds(headers['Retry-After'])
+        # Slow down further requests by this opener, if its rate limiter can
+        rate_limiter = getattr(self.parent, 'rate_limiter', None) or Waiter
+        backoff = getattr(rate_limiter, 'backoff', None)
+        if backoff:
+            backoff(delay)
+        e = PyDeliciousThrottled(errmsg)
+        e.retry_after = delay
+        raise e
+
+
+class _ConnectionPool:
+    """Keeps idle persistent HTTP(S) connections per host.
+
+    At most `size` idle connections are kept for each host, connections idle
+    for more than `timeout` seconds are closed rather than reused. The pool is
+    safe to share between threads.
+
+    Some attributes:
+    :created: the number of connections opened
+    :reused: the number of requests sent over an idle connection
+    :discarded: the number of connections closed by the pool
+    """
+    def __init__(self, size=DLCS_KEEPALIVE_POOLSIZE,
+            timeout=DLCS_KEEPALIVE_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        "Return an idle connection for `key`, or None."
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, lastused = idle.pop()
+                if time.time() - lastused < self.timeout:
+                    self.reused += 1
+                    return conn
+                self.discarded += 1
+                conn.close()
+        finally:
+            self._lock.release()
+
+    def put(self, key, conn):
+        "Return a connection to the pool after its response has been read."
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+            self.discarded += 1
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        "Close all idle connections."
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn, lastused in idle:
+                    self.discarded += 1
+                    conn.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        "Return a dictionary with connection reuse statistics."
+        self._lock.acquire()
+        try:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': sum(map(len, self._idle.values())),
+            }
+        finally:
+            self._lock.release()
+
+
+class _PooledSocket:
+    """Socket-like adapter for a response read over a pooled connection.
+
+    Hands the connection back to the pool once the response body has been
+    read completely, or closes it if the response is abandoned halfway.
+    """
+    def __init__(self, response, conn, pool, key):
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        self._key = key
+
+    def recv(self, amt=None):
+        data = self._response.read(amt)
+        if not data or self._response.isclosed():
+            self._release()
+        return data
+    read = recv
+
+    def close(self):
+        self._release()
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if not conn:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._key, conn)
+        else:
+            self._response.close()
+            conn.close()
+
+
+try:
+    _HTTPSHandler = urllib2.HTTPSHandler
+except AttributeError:
+    # Python without SSL support
+    _HTTPSHandler = urllib2.BaseHandler
+
+class KeepAliveHandler(urllib2.HTTPHandler, _HTTPSHandler):
+    """Replaces the urllib2 HTTP(S) handlers with ones that keep connections
+    open between requests, so successive API calls don't pay a new TCP and
+    SSL handshake each.
+
+    The `pool` attribute holds the ``_ConnectionPool`` with the idle
+    connections and reuse statistics, see ``stats()``.
+    """
+    def __init__(self, debuglevel=0, poolsize=DLCS_KEEPALIVE_POOLSIZE,
+            timeout=DLCS_KEEPALIVE_TIMEOUT, context=None):
+        urllib2.AbstractHTTPHandler.__init__(self, debuglevel)
+        self._context = context
+        self.pool = _ConnectionPool(poolsize, timeout)
+
+    def http_open(self, req):
+        return self._open(httplib.HTTPConnection, req)
+
+    if hasattr(urllib2, 'HTTPSHandler'):
+        def https_open(self, req):
+            if self._context is None:
+                return self._open(httplib.HTTPSConnection, req)
+            return self._open(httplib.HTTPSConnection, req,
+                    context=self._context)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close()
+
+    def _open(self, http_class, req, **conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update([(k, v) for k, v in req.headers.items()
+                if k not in headers])
+        headers['Connection'] = 'keep-alive'
+        headers = dict([(k.title(), v) for k, v in headers.items()])
+
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        tunnel_headers = {}
+        if tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = \
+                    headers.pop('Proxy-Authorization')
+
+        key = (http_class.__name__, host, tunnel_host)
+        conn = self.pool.get(key)
+        if conn:
+            if conn.sock and req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                conn.sock.settimeout(req.timeout)
+            try:
+                response = self._request(conn, req, headers)
+            except (socket.error, httplib.HTTPException):
+                # The server dropped the idle connection, start a new one
+                conn.close()
+                conn = None
+
+        if not conn:
+            conn = http_class(host, timeout=req.timeout, **conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            if tunnel_host:
+                conn.set_tunnel(tunnel_host, headers=tunnel_headers)
+            self.pool.created += 1
+            try:
+                response = self._request(conn, req, headers)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        fp = socket._fileobject(_PooledSocket(response, conn, self.pool, key),
+                close=True)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _request(self, conn, req, headers):
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
+
+
+class _DecodedFile:
+    """Decompresses a gzip or deflate coded response body while it is read,
+    so the parsers receive the decoded data in parts as it arrives.
+
+    Some attributes:
+    :wire_bytes: the number of coded bytes read from the network so far
+    :bytes: the number of decoded bytes so far
+    """
+    def __init__(self, fp, coding):
+        self.fp = fp
+        self.coding = coding
+        self.wire_bytes = 0
+        self.bytes = 0
+        if coding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        else:
+            # gzip header and trailer
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._first = True
+        self._buffer = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer]
+            self._buffer = ''
+            while self._decoder:
+                parts.append(self._decode())
+            return ''.join(parts)
+        while len(self._buffer) < size and self._decoder:
+            self._buffer += self._decode()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer and self._decoder and \
+                (size is None or size < 0 or len(self._buffer) < size):
+            self._buffer += self._decode()
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self._decoder = None
+        self.fp.close()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def _decode(self):
+        chunk = self.fp.read(DLCS_DECODE_BUFSIZE)
+        self.wire_bytes += len(chunk)
+        if not chunk:
+            data = self._decoder.flush()
+            self._decoder = None
+        elif self._first and self.coding == 'deflate':
+            self._first = False
+            try:
+                data = self._decoder.decompress(chunk)
+            except zlib.error:
+                # Some servers send raw deflate data without zlib header
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = self._decoder.decompress(chunk)
+        else:
+            data = self._decoder.decompress(chunk)
+        self.bytes += len(data)
+        return data
+
+
+def decode_body(fp, headers):
+    """Return a file that decodes the response body `fp` according to the
+    Content-Encoding of the `headers` (a ``mimetools.Message``), or `fp`
+    itself for bodies without known coding. The Content-Encoding and
+    Content-Length headers of decoded bodies are removed.
+    """
+    coding = headers.get('content-encoding', '').strip().lower()
+    if coding in ('x-gzip', 'gzip'):
+        coding = 'gzip'
+    elif coding != 'deflate':
+        return fp
+    del headers['content-encoding']
+    if 'content-length' in headers:
+        del headers['content-length']
+    return _DecodedFile(fp, coding)
+
+class _CountingFile:
+    """Counts the bytes read from a response body and the time spent in the
+    reads, to tell network from parse time while the body is parsed.
+
+    Some attributes:
+    :bytes: the number of bytes read so far
+    :seconds: the time spent reading so far
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytes = 0
+        self.seconds = 0
+
+    def read(self, *args):
+        return self._count(self.fp.read, args)
+
+    def readline(self, *args):
+        return self._count(self.fp.readline, args)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def _count(self, read, args):
+        start = time.time()
+        data = read(*args)
+        self.seconds += time.time() - start
+        self.bytes += len(data)
+        return data
+
+
+def wire_bytes(response, default=None):
+    """Return the number of bytes of the response body read from the
+    network so far, or `default` for bodies that were not coded.
+    """
+    fp = getattr(response, 'fp', response)
+    return getattr(fp, 'wire_bytes', default)
+
+
+class DecodingHandler(urllib2.BaseHandler):
+    """Asks for gzip or deflate coded responses with the Accept-Encoding
+    header, and decodes their bodies while they are read, see
+    ``decode_body()``.
+    """
+
+    # before the cache handler, which then stores decoded bodies
+    handler_order = 300
+
+    def __init__(self, accept=DLCS_ACCEPT_ENCODING):
+        self.accept = accept
+
+    def http_request(self, request):
+        if not request.has_header('Accept-encoding'):
+            request.add_unredirected_header('Accept-encoding', self.accept)
+        return request
+
+    def http_response(self, request, response):
+        headers = response.info()
+        fp = decode_body(response, headers)
+        if fp is response:
+            return response
+        decoded = urllib.addinfourl(fp, headers, response.geturl(),
+                response.code)
+        decoded.msg = response.msg
+        return decoded
+
+    https_request = http_request
+    https_response = http_response
+
+
+class _Record(object):
+    """Base for compact, dictionary-like records of API data elements.
+
+    Known attributes are kept in slots, attributes that are not set are not
+    present as keys, like in the attribute dictionaries of the elements.
+    Unknown attributes are kept in a dictionary.
+    """
+    __slots__ = ('_extra',)
+    attributes = ()
+
+    def __init__(self, attrib):
+        self._extra = None
+        get = attrib.get
+        for k in self.attributes:
+            setattr(self, k, get(k))
+        if len(attrib) > len([k for k in self.attributes if k in attrib]):
+            self._extra = dict([(k, v) for k, v in attrib.items()
+                if k not in self.attributes])
+
+    def __getitem__(self, key):
+        if key in self.attributes:
+            v = getattr(self, key)
+            if v is not None:
+                return v
+        elif self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError, key
+
+    def __setitem__(self, key, value):
+        if key in self.attributes:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.attributes and getattr(self, key) is not None:
+            setattr(self, key, None)
+        elif self._extra and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError, key
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in self.attributes if getattr(self, k) is not None]
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return hasattr(other, "items") and \
+                dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.items()))
+
+
+class Post(_Record):
+    """A post as parsed from a posts document, see ``dlcs_parse_xml``.
+
+    Behaves like the attribute dictionary of the post element but uses far
+    less memory. The `tags` attribute holds the tags split into a tuple,
+    the 'tag' value is joined from it. Records parsed with the same
+    `strings` dictionary share equal tag strings.
+    """
+    attributes = ('href', 'hash', 'meta', 'description', 'extended', 'tag',
+            'time', 'shared', 'others')
+    __slots__ = ('href', 'hash', 'meta', 'description', 'extended', 'tags',
+            'time', 'shared', 'others')
+
+    def __init__(self, attrib, strings=None):
+        if strings is None:
+            strings = {}
+        intern_str = strings.setdefault
+        get = attrib.get
+        self.href = get('href')
+        self.hash = get('hash')
+        self.meta = get('meta')
+        self.description = get('description')
+        self.extended = get('extended')
+        self.time = get('time')
+        self.others = get('others')
+        shared = get('shared')
+        if shared:
+            shared = intern_str(shared, shared)
+        self.shared = shared
+        tag = get('tag')
+        if tag is None:
+            self.tags = None
+        else:
+            self.tags = tuple([intern_str(t, t) for t in tag.split(' ') if t])
+        self._extra = None
+        for k in attrib:
+            if k not in self.attributes:
+                self._extra = dict([(k, v) for k, v in attrib.items()
+                    if k not in self.attributes])
+                break
+
+    def _get_tag(self):
+        if self.tags is not None:
+            return ' '.join(self.tags)
+
+    def _set_tag(self, value):
+        if value is None:
+            self.tags = None
+        else:
+            self.tags = tuple([t for t in value.split(' ') if t])
+
+    tag = property(_get_tag, _set_tag)
+
+
+class Tag(_Record):
+    """A tag as parsed from a tags document, see ``dlcs_parse_xml``."""
+    attributes = ('tag', 'count')
+    __slots__ = attributes
+
+    def __init__(self, attrib, strings=None):
+        _Record.__init__(self, attrib)
+
+_records = {'post': Post, 'tag': Tag}
 
 
 ### Utility functions
@@ -204,48 +1173,127 @@ def delicious_datetime(str):
     return datetime.datetime(*time.strptime(str, ISO_8601_DATETIME)[0:6])
 
 
-def http_request(url, user_agent=USER_AGENT, retry=4, opener=None):
+def retry_after_seconds(value):
+    """Return the number of seconds to wait according to a Retry-After
+    header value, which is either a number of seconds or a HTTP date.
+    Returns None for unrecognized values.
+    """
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date:
+            return max(0, mktime_tz(date) - time.time())
+
+
+http_request_hooks = []
+"""Callables called after every ``http_request()`` with the URL and a
+dictionary with the seconds until the response headers arrived ('network'),
+the number of 'retries' and the 'error' class name or None. See
+``RequestMetrics``."""
+
+def http_request(url, user_agent=USER_AGENT, retry=None, opener=None,
+        policy=None, rate_limiter=None):
     """Retrieve the contents referenced by the URL using urllib2.
 
-    Retries up to four times (default) on exceptions.
+    Failed requests are retried according to `policy`, the `retry_policy`
+    of the opener or ``DefaultRetryPolicy``; see ``RetryPolicy``. For
+    compatibility, `retry` sets the number of attempts after connection
+    errors and time-outs instead. Retries wait for `rate_limiter`, the
+    `rate_limiter` of the opener or the shared ``Waiter``. Requests time out after
+    DLCS_REQUEST_TIMEOUT seconds. The number of retries and the time spent
+    are set as the `retries` and `network` attributes of the returned
+    response, and passed to the ``http_request_hooks``.
     """
     request = urllib2.Request(url, headers={'User-Agent':user_agent})
 
     if not opener:
-        opener = urllib2.build_opener()
-
-    # Remember last error
-    e = None
-
-    # Repeat request on time-out errors
-    tries = retry;
-    while tries:
+        opener = urllib2.build_opener(DecodingHandler())
+    if retry is not None:
+        policy = RetryPolicy(connect=retry - 1, timeout=retry - 1)
+    elif not policy:
+        policy = getattr(opener, 'retry_policy', None) or DefaultRetryPolicy
+
+    start = time.time()
+    stats = {'retries': 0, 'error': None}
+    # Number of failed attempts per kind of failure
+    failures = {}
+
+    try:
+        while True:
+            try:
+                fl = opener.open(request,
+                        timeout=policy.timeout(time.time() - start))
+                stats['network'] = time.time() - start
+                annotate(fl, network=stats['network'],
+                        retries=stats['retries'])
+                return fl
+
+            except Exception, e:
+                exc_info = sys.exc_info()
+                kind = policy.classify(e)
+                delay = None
+                if kind:
+                    failures[kind] = failures.get(kind, 0) + 1
+                    delay = policy.delay(kind, failures,
+                            time.time() - start, policy.retry_after(e))
+
+                if delay is None:
+                    stats['error'] = e.__class__.__name__
+                    if isinstance(e, urllib2.HTTPError):
+                        # reraise unexpected protocol errors as
+                        # PyDeliciousException
+                        raise PyDeliciousException, "%s" % e
+                    elif kind in ('connect', 'timeout'):
+                        # Give up
+                        raise PyDeliciousException, \
+                            "Unable to retrieve data at '%s', %s" % (url, e)
+                    # i.e. throttled or unauthorized
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                print >> sys.stderr, "%s, retrying in %.1f seconds." % (e,
+                        delay)
+                time.sleep(delay)
+                (rate_limiter or getattr(opener, 'rate_limiter', None)
+                        or Waiter)()
+                stats['retries'] += 1
+
+    finally:
+        if 'network' not in stats:
+            stats['network'] = time.time() - start
+        for hook in http_request_hooks:
+            hook(url, stats)
+
+
+def annotate(response, **attrs):
+    """Set attributes on a response, if it takes attributes (e.g. not on
+    files). Used to pass statistics along with responses.
+    """
+    for name, value in attrs.items():
         try:
-            return opener.open(request)
-
-        except urllib2.HTTPError, e:
-            # reraise unexpected protocol errors as PyDeliciousException
-            raise PyDeliciousException, "%s" % e
+            setattr(response, name, value)
+        except (AttributeError, TypeError):
+            return
 
-        except urllib2.URLError, e:
-            # xxx: Ugly check for time-out errors
-            #if len(e)>0 and 'timed out' in arg[0]:
-            print >> sys.stderr, "%s, %s tries left." % (e, tries)
-            Waiter()
-            tries = tries - 1
-            #else:
-            #	tries = None
 
-    # Give up
-    raise PyDeliciousException, \
-            "Unable to retrieve data at '%s', %s" % (url, e)
-
-
-def build_api_opener(host, user, passwd, extra_handlers=() ):
+def build_api_opener(host, user, passwd, extra_handlers=(), keepalive=True,
+        rate_limiter=None, retry_policy=None):
     """
     Build a urllib2 style opener with HTTP Basic authorization for one host
     and additional error handling. If HTTP_PROXY is set a proxyhandler is also
     added.
+
+    Unless ``keepalive`` is false the opener keeps its connections open and
+    reuses them for subsequent requests, see ``KeepAliveHandler``. The handler
+    is available as the ``keepalive`` attribute on the returned opener.
+
+    Responses are requested gzip or deflate coded and decoded while they are
+    read, see ``DecodingHandler``.
+
+    Requests through the opener are throttled by ``rate_limiter``, which
+    defaults to the shared ``Waiter``. See ``TokenBucket``. Failed requests
+    are retried according to ``retry_policy``, or the shared
+    ``DefaultRetryPolicy``. See ``RetryPolicy``.
     """
 
     global DEBUG, HTTP_PROXY, HTTPS_PROXY, DLCS_API_REALM
@@ -254,9 +1302,15 @@ def build_api_opener(host, user, passwd, extra_handlers=() ):
     password_manager.add_password(DLCS_API_REALM, host, user, passwd)
     auth_handler = urllib2.HTTPBasicAuthHandler(password_manager)
 
-    handlers = ( auth_handler, DeliciousHTTPErrorHandler(), ) + extra_handlers
+    handlers = ( auth_handler, DeliciousHTTPErrorHandler(),
+            DecodingHandler(), ) + extra_handlers
 
-    if DEBUG:
+    keepalive_handler = None
+    if keepalive:
+        keepalive_handler = KeepAliveHandler(debuglevel=DEBUG)
+        handlers += ( keepalive_handler, )
+
+    elif DEBUG:
         httpdebug = urllib2.HTTPHandler(debuglevel=DEBUG)
         handlers += ( httpdebug, )
 
@@ -269,13 +1323,16 @@ def build_api_opener(host, user, passwd, extra_handlers=() ):
         handlers += ( urllib2.ProxyHandler( proto ), )
 
     o = urllib2.build_opener(*handlers)
+    o.keepalive = keepalive_handler
+    o.rate_limiter = rate_limiter
+    o.retry_policy = retry_policy
 
     return o
 
-def dlcs_api_opener(user, passwd):
+def dlcs_api_opener(user, passwd, keepalive=True):
     "Build an opener for DLCS_API_HOST, see build_api_opener()"
 
-    return build_api_opener(DLCS_API_HOST, user, passwd)
+    return build_api_opener(DLCS_API_HOST, user, passwd, keepalive=keepalive)
 
 
 def dlcs_api_request(path, params=None, user='', passwd='', throttle=True,
@@ -284,11 +1341,19 @@ def dlcs_api_request(path, params=None, user='', passwd='', throttle=True,
 
     This implements a minimum interval between calls to avoid
     throttling. [#]_ Use param 'throttle' to turn this behaviour off.
+    Calls are throttled by the `rate_limiter` of the opener, or by the
+    shared ``Waiter``. The seconds waited are set as the `wait` attribute of
+    the returned response.
 
     .. [#] http://del.icio.us/help/api/
     """
+    if not opener:
+        opener = dlcs_api_opener(user, passwd)
+
+    wait = time.time()
     if throttle:
-        Waiter()
+        (getattr(opener, 'rate_limiter', None) or Waiter)()
+    wait = time.time() - wait
 
     if params:
         url = "%s/%s?%s" % (DLCS_API, path, urlencode(params))
@@ -298,13 +1363,12 @@ def dlcs_api_request(path, params=None, user='', passwd='', throttle=True,
     if DEBUG: print >>sys.stderr, \
             "dlcs_api_request: %s" % url
 
-    if not opener:
-        opener = dlcs_api_opener(user, passwd)
-
     fl = http_request(url, opener=opener)
+    annotate(fl, wait=wait)
 
-    if DEBUG>2: print >>sys.stderr, \
-            pformat(fl.info().headers)
+    if DEBUG>2:
+        from pprint import pformat
+        print >>sys.stderr, pformat(fl.info().headers)
 
     return fl
 
@@ -334,7 +1398,7 @@ def dlcs_encode_params(params, usercodec=PREFERRED_ENCODING, encoded=False):
 
             if encoded:
             	assert isinstance(params[key], str)
-            else:
+            elif isinstance(params[key], str):
                 params[key] = params[key].decode(usercodec)
 
             assert isinstance(params[key], basestring)
@@ -346,7 +1410,7 @@ def dlcs_encode_params(params, usercodec=PREFERRED_ENCODING, encoded=False):
     return params
 
 
-def dlcs_parse_xml(data, split_tags=False):
+def dlcs_parse_xml(data, split_tags=False, compact=False):
     """Parse any del.icio.us XML document and return Python data structure.
 
     Recognizes all XML document formats as returned by the version 1 API and
@@ -359,6 +1423,10 @@ def dlcs_parse_xml(data, split_tags=False):
      {'dates': [{'count':'...','date':'...'},], 'tag':'', 'user':'...'}
      {'result':(True, "done")}
      # etcetera.
+
+    With ``compact=True`` posts and tags are returned as ``Post`` and ``Tag``
+    records instead of dictionaries, which share equal tag strings and take
+    much less memory for large collections.
     """
     # TODO: split_tags is not implemented
 
@@ -367,8 +1435,11 @@ def dlcs_parse_xml(data, split_tags=False):
     if not hasattr(data, 'read'):
         data = StringIO(data)
 
-    doc = parse_xml(data)
-    root = doc.getroot()
+    records = None
+    if compact:
+        root, records = _iterparse_records(data)
+    else:
+        root = parse_xml(data).getroot()
     fmt = root.tag
 
     # Split up into three cases: Data, Result or Update
@@ -378,7 +1449,10 @@ def dlcs_parse_xml(data, split_tags=False):
         # Use `fmt` (without last 's') to find data elements, elements
         # don't have contents, attributes contain all the data we need:
         # append to list
-        elist = [el.attrib for el in doc.findall(fmt[:-1])]
+        if records is not None:
+            elist = records
+        else:
+            elist = [el.attrib for el in root.findall(fmt[:-1])]
 
         # Return list in dict, use tagname of rootnode as keyname.
         data = {fmt: elist}
@@ -411,57 +1485,165 @@ def dlcs_parse_xml(data, split_tags=False):
         raise PyDeliciousException, "Unknown XML document format '%s'" % fmt
 
 
-## Feed util
-
-def dlcs_rss_request(tag="", popular=0, user="", url=''):
-    """Parse a RSS request, old style.
-
-    This requests old (now undocumented?) URL paths that still seem to work.
-
-    - http://del.icio.us/rss/url/{urimd5}
-    - http://del.icio.us/rss/{user}/{tag}
-    - http://del.icio.us/rss/{user}
-    - http://del.icio.us/rss
-    - http://del.icio.us/rss/tag/{tag}
-    - http://del.icio.us/rss/popular
-    - http://del.icio.us/rss/popular/{tag}
+def _iterparse_records(data):
+    """Parse a document for ``dlcs_parse_xml()`` with ``compact=True``,
+    returns the root element and the list of records for posts and tags
+    documents, or None. Records are built while parsing and their elements
+    discarded, so the document tree is never built up.
+    """
+    events = iter(iterparse_xml(data, events=('start', 'end')))
+    event, root = events.next()
+    record = root.tag in ('posts', 'tags') and _records[root.tag[:-1]]
+    if not record:
+        for event, el in events:
+            pass
+        return root, None
+
+    strings = {}
+    records = []
+    for event, el in events:
+        if event == 'end' and el.tag == root.tag[:-1]:
+            records.append(record(el.attrib, strings))
+            # keeps the attributes of the root
+            del root[:]
+    return root, records
+
+def dlcs_iterparse_posts(data, path='posts/all', compact=False):
+    """Parse a del.icio.us posts document incrementally, yielding the
+    attribute dictionary of every post as soon as it is read.
+
+    Unlike ``dlcs_parse_xml()`` the document tree is never built up, each
+    element is discarded after it is yielded so memory use does not depend on
+    the size of the document. A negative `result` answer raises a
+    ``DeliciousError`` for `path`. With ``compact=True`` ``Post`` records
+    are yielded.
     """
 
-    tag = quote_plus(tag)
-    user = quote_plus(user)
+    if not hasattr(data, 'read'):
+        data = StringIO(data)
 
-    if url != '':
-        url = DLCS_RSS + 'url/%s' % md5(url).hexdigest()
+    events = iter(iterparse_xml(data, events=('start', 'end')))
+    event, root = events.next()
 
-    elif user != '' and tag != '':
-        url = DLCS_RSS + '%(user)s/%(tag)s' % {'user':user, 'tag':tag}
+    if root.tag == 'posts':
+        strings = {}
+        for event, el in events:
+            if event == 'end' and el.tag == 'post':
+                if compact:
+                    yield Post(el.attrib, strings)
+                else:
+                    yield el.attrib
+                root.clear()
 
-    elif user != '' and tag == '':
-        url = DLCS_RSS + '%s' % user
+    elif root.tag == 'result':
+        for event, el in events:
+            pass
+        msg = root.attrib.get('code', root.text)
+        if msg not in DLCS_OK_MESSAGES:
+            DeliciousError.raiseFor(msg, path)
 
-    elif popular == 0 and tag == '':
-        url = DLCS_RSS
+    else:
+        raise PyDeliciousException, \
+                "Unexpected XML document format '%s'" % root.tag
 
-    elif popular == 0 and tag != '':
-        url = DLCS_RSS + "tag/%s" % tag
 
-    elif popular == 1 and tag == '':
-        url = DLCS_RSS + 'popular/'
+## Feed util
 
-    elif popular == 1 and tag != '':
-        url = DLCS_RSS + 'popular/%s' % tag
+_feed_fields = {
+    'link': 'url', 'guid': 'url', 'id': 'url',
+    'title': 'description',
+    'date': 'dt', 'pubDate': 'dt', 'modified': 'dt', 'updated': 'dt',
+    'published': 'dt',
+    'description': 'extended', 'summary': 'extended', 'content': 'extended',
+    'creator': 'user', 'author': 'user',
+    'category': 'tags', 'subject': 'tags',
+}
+"""Maps the names of the RSS 1.0, RSS 2.0, Dublin Core and Atom elements of
+feed items to the fields of the posts of ``dlcs_iterparse_feed()``"""
+
+_RDF_ABOUT = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+
+def _local_name(tag):
+    return tag[tag.rfind('}') + 1:]
+
+def _feed_post(item):
+    "Return the post dictionary for a feed item or entry element. "
+    post = {'url': u'', 'description': u'', 'tags': u'', 'dt': u'',
+        'extended': u'', 'user': u''}
+    tags = []
+    ids = []
+    for el in item:
+        name = _local_name(el.tag)
+        field = _feed_fields.get(name)
+        if not field:
+            continue
+        if name == 'link' and el.get('href') is not None:
+            # Atom
+            if el.get('rel', 'alternate') != 'alternate':
+                continue
+            value = el.get('href')
+        elif name == 'category' and el.get('term') is not None:
+            value = el.get('term')
+        elif name == 'author' and len(el):
+            # Atom person construct
+            value = [c.text for c in el if _local_name(c.tag) == 'name']
+            value = value and value[0]
+        else:
+            value = el.text
+        value = unicode((value or '').strip())
+        if field == 'tags':
+            if value:
+                tags.append(value)
+        elif name in ('guid', 'id'):
+            ids.append(value)
+        elif not post[field]:
+            post[field] = value
+    post['tags'] = u' '.join(tags)
+    if not post['url']:
+        post['url'] = unicode((ids and ids[0]) or item.get(_RDF_ABOUT, ''))
+    return post
+
+def dlcs_iterparse_feed(data):
+    """Extract the posts of an RSS 1.0, RSS 2.0 or Atom feed incrementally,
+    yielding a dictionary with the 'url', 'description', 'tags', 'dt',
+    'extended' and 'user' of each item as soon as it is read. Tags are
+    separated by spaces.
+
+    This only reads the elements del.icio.us feeds use, and is much faster
+    than feedparser. Malformed documents raise a ``SyntaxError``, see
+    ``dlcs_feed_posts()``.
+    """
 
-    if DEBUG:
-        print 'dlcs_rss_request', url
+    if not hasattr(data, 'read'):
+        data = StringIO(data)
 
-    rss = http_request(url).read()
+    for event, el in iterparse_xml(data):
+        if _local_name(el.tag) in ('item', 'entry'):
+            yield _feed_post(el)
+            el.clear()
 
-    # assert feedparser, "requires feedparser to be installed."
-    if not feedparser:
-        return rss
+def dlcs_feed_posts(data):
+    """Return the posts of a feed as list of dictionaries, see
+    ``dlcs_iterparse_feed()``. Malformed feeds are left to the more lenient
+    feedparser; if it is not installed they raise a ``PyDeliciousException``.
+    """
 
-    rss = feedparser.parse(rss)
+    if not hasattr(data, 'read'):
+        data = StringIO(data)
 
+    data = _RecordingFile(data)
+    try:
+        return list(dlcs_iterparse_feed(data))
+    except SyntaxError:
+        if not feedparser:
+            raise PyDeliciousException, \
+                    "Malformed feed, feedparser is needed to parse it"
+        feed = data.getvalue()
+        # a file, feedparser would fetch a string that looks like a URL
+        return _feedparser_posts(feedparser.parse(StringIO(feed)))
+
+def _feedparser_posts(rss):
+    "Return the post dictionaries for the entries of a parsed feed. "
     posts = []
     for e in rss.entries:
         if e.has_key("links") and e["links"]!=[] and e["links"][0].has_key("href"):
@@ -489,7 +1671,7 @@ def dlcs_rss_request(tag="", popular=0, user="", url=''):
         if e.has_key("summary"):
             extended = e['summary']
         elif e.has_key("summary_detail"):
-            e['summary_detail']["value"]
+            extended = e['summary_detail']["value"]
         else:
             extended = ""
         if e.has_key("author"):
@@ -505,6 +1687,178 @@ def dlcs_rss_request(tag="", popular=0, user="", url=''):
     return posts
 
 
+class _RecordingFile:
+    "Keeps a copy of what is read from `fp`, to parse it again. "
+    def __init__(self, fp):
+        self.fp = fp
+        self._parts = []
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self._parts.append(data)
+        return data
+
+    def getvalue(self):
+        "Return everything read so far, and the rest of `fp`. "
+        return ''.join(self._parts) + self.fp.read()
+
+
+_json_space = re.compile(r'[ \t\n\r]*')
+
+class _JSONStream:
+    """Decodes JSON values one by one from a file, reading only as much as
+    needed to complete the next value.
+    """
+    def __init__(self, fp, bufsize=DLCS_DECODE_BUFSIZE):
+        self.fp = fp
+        self.bufsize = bufsize
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def peek(self):
+        "Return the next character after white space, or '' at the end. "
+        while True:
+            self.pos = _json_space.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        "Consume and return the next character, which is one of `chars`. "
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError, "Expected %s at %r" % (" or ".join(chars),
+                    self.buffer[self.pos:self.pos + 20] or 'end of data')
+        self.pos += 1
+        return c
+
+    def value(self):
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number might continue in the next part
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _fill(self):
+        data = self.fp.read(self.bufsize)
+        if not data:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+
+def dlcs_iterparse_json(data):
+    """Decode a JSON document incrementally. For an array every element is
+    yielded as soon as it is read, for an object every key and value pair.
+    Other documents are yielded as one value.
+    """
+
+    if not hasattr(data, 'read'):
+        data = StringIO(data)
+
+    stream = _JSONStream(data)
+    c = stream.peek()
+    if c not in ('[', '{'):
+        yield stream.value()
+        return
+
+    stream.pos += 1
+    end = c == '[' and ']' or '}'
+    if stream.peek() == end:
+        return
+    while True:
+        if end == ']':
+            yield stream.value()
+        else:
+            key = stream.value()
+            stream.expect(':')
+            yield key, stream.value()
+        if stream.expect(',' + end) == end:
+            return
+
+
+dlcs_json_fields = {'u': 'href', 'd': 'description', 't': 'tag',
+    'dt': 'time', 'n': 'extended', 'a': 'user'}
+"Maps the keys of the posts in v2 JSON feeds to the v1 API attribute names"
+
+def dlcs_json_record(item):
+    """Return the record for an item of a v2 JSON feed with the names and
+    values of the v1 API: posts get 'href', 'description', 'tag' (separated
+    by spaces), 'time', 'extended' and 'user', tag counts become 'tag' and
+    'count', and the 'dt' of other records (e.g. users) becomes 'time'.
+    Other values are returned as is.
+    """
+    if isinstance(item, tuple):
+        tag, count = item
+        return {'tag': tag, 'count': unicode(count)}
+    if not isinstance(item, dict):
+        return item
+    if 'u' in item:
+        record = dict([(dlcs_json_fields.get(k, k), v)
+            for k, v in item.items()])
+        if isinstance(record.get('tag'), list):
+            record['tag'] = u' '.join(record['tag'])
+        return record
+    record = dict(item)
+    if 'dt' in record:
+        record['time'] = record.pop('dt')
+    return record
+
+
+def dlcs_rss_request(tag="", popular=0, user="", url=''):
+    """Parse a RSS request, old style. Returns a list of post dictionaries,
+    see ``dlcs_feed_posts()``.
+
+    This requests old (now undocumented?) URL paths that still seem to work.
+
+    - http://del.icio.us/rss/url/{urimd5}
+    - http://del.icio.us/rss/{user}/{tag}
+    - http://del.icio.us/rss/{user}
+    - http://del.icio.us/rss
+    - http://del.icio.us/rss/tag/{tag}
+    - http://del.icio.us/rss/popular
+    - http://del.icio.us/rss/popular/{tag}
+    """
+
+    tag = quote_plus(tag)
+    user = quote_plus(user)
+
+    if url != '':
+        url = DLCS_RSS + 'url/%s' % md5(url).hexdigest()
+
+    elif user != '' and tag != '':
+        url = DLCS_RSS + '%(user)s/%(tag)s' % {'user':user, 'tag':tag}
+
+    elif user != '' and tag == '':
+        url = DLCS_RSS + '%s' % user
+
+    elif popular == 0 and tag == '':
+        url = DLCS_RSS
+
+    elif popular == 0 and tag != '':
+        url = DLCS_RSS + "tag/%s" % tag
+
+    elif popular == 1 and tag == '':
+        url = DLCS_RSS + 'popular/'
+
+    elif popular == 1 and tag != '':
+        url = DLCS_RSS + 'popular/%s' % tag
+
+    if DEBUG:
+        print 'dlcs_rss_request', url
+
+    return dlcs_feed_posts(http_request(url))
+
+
 """
     Bookmarks from the hotlist:
         {format}
@@ -589,39 +1943,57 @@ delicious_v2_feeds = {
 }
 
 
-def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15, **kwds):
-
-    """
-    Request and parse a feed.
-    Count should be between 1 and 100, default 15.
-    Format values include 'rss' and 'json', defaults to json.
-
-    - http://www.delicious.com/help/feeds
-    """
+def dlcs_feed_url(name_or_url, url_map=delicious_v2_feeds, count=15, **kwds):
+    "Return the URL of a feed, see ``dlcs_feed()``. "
 
     #if fancy == True:
     #    '?fancy'
     #elif fancy != None:        
     #    '?plain'
-    format = kwds.setdefault('format', 'json')
+    kwds.setdefault('format', 'json')
     kwds.setdefault('count', count)
 
     if not name_or_url:
         name_or_url = 'hotlist'
     if name_or_url in url_map:
         params = dict([(k, quote_plus(str(v))) for k,v in kwds.items()])
-        url = DLCS_FEEDS + url_map[name_or_url] % params
+        return DLCS_FEEDS + url_map[name_or_url] % params
     else:
-        url = name_or_url
+        return name_or_url
+
+
+def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15,
+        opener=None, posts=False, rate_limiter=None, **kwds):
+
+    """
+    Request and parse a feed.
+    Count should be between 1 and 100, default 15.
+    Format values include 'rss' and 'json', defaults to json.
+    The request is made with the urllib2 ``opener``, if given, and retried
+    after waiting for ``rate_limiter``, see ``http_request()``.
+    RSS feeds are parsed by feedparser, or with ``posts`` into a list of
+    post dictionaries by ``dlcs_feed_posts()``. JSON feeds are returned as
+    string, or with ``posts`` as list of records, see ``dlcs_iter_feed()``.
+
+    - http://www.delicious.com/help/feeds
+    """
+
+    format = kwds.setdefault('format', 'json')
+    url = dlcs_feed_url(name_or_url, url_map, count, **kwds)
 
     if DEBUG:
         print 'dlcs_feed', url
 
-    feed = http_request(url).read()
+    fl = http_request(url, opener=opener, rate_limiter=rate_limiter)
+    if posts and format == 'rss':
+        return dlcs_feed_posts(fl)
+    elif posts and format == 'json':
+        return [dlcs_json_record(item) for item in dlcs_iterparse_json(fl)]
+    feed = fl.read()
 
     if format == 'rss':
         if feedparser:
-            rss = feedparser.parse(feed)
+            rss = feedparser.parse(StringIO(feed))
             return rss
         else:
             return feed
@@ -629,6 +2001,221 @@ def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15, **kwds):
         return feed
 
 
+def dlcs_iter_feed(name_or_url, url_map=delicious_v2_feeds, count=15,
+        opener=None, rate_limiter=None, **kwds):
+
+    """
+    Request a feed and yield its records while it is read, see ``dlcs_feed()``.
+    Items of JSON feeds are yielded as soon as they are decoded, see
+    ``dlcs_json_record()``; RSS feeds yield the post dictionaries of
+    ``dlcs_feed_posts()``.
+    """
+
+    format = kwds.setdefault('format', 'json')
+    url = dlcs_feed_url(name_or_url, url_map, count, **kwds)
+
+    if DEBUG:
+        print 'dlcs_iter_feed', url
+
+    fl = http_request(url, opener=opener, rate_limiter=rate_limiter)
+    if format == 'rss':
+        for post in dlcs_feed_posts(fl):
+            yield post
+    else:
+        for item in dlcs_iterparse_json(fl):
+            yield dlcs_json_record(item)
+
+
+class FeedFetcher:
+    """Requests many feeds at once using a pool of threads.
+
+    Feeds are public and not throttled like the API, but the requests to any
+    one host are still limited to `host_connections` at a time and on average
+    `host_rate` per second. Connections are kept open and reused, see
+    ``KeepAliveHandler``.
+
+    Additional urllib2 `handlers`, e.g. a cache, are added to the opener.
+
+    Some attributes:
+    :threads: the number of worker threads
+    :host_connections: the maximum number of concurrent requests per host
+    :host_rate: the maximum number of requests per second to one host
+    """
+    def __init__(self, threads=DLCS_FEED_THREADS,
+            host_connections=DLCS_FEED_HOST_CONNECTIONS,
+            host_rate=DLCS_FEED_HOST_RATE, url_map=delicious_v2_feeds,
+            handlers=()):
+        self.threads = threads
+        self.host_connections = host_connections
+        self.host_rate = host_rate
+        self.url_map = url_map
+        self.keepalive = KeepAliveHandler(debuglevel=DEBUG,
+                poolsize=host_connections)
+        self.opener = urllib2.build_opener(self.keepalive,
+                DecodingHandler(), *handlers)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, feeds):
+        """Request the feeds and yield a ``(feed, result, error)`` tuple for
+        each as soon as it completes, in no particular order. Every feed
+        is a name or URL, or a tuple of the name and a dictionary with the
+        parameters for ``dlcs_feed()``. `error` is the exception raised for
+        a failed request, or None.
+        """
+        requests = Queue.Queue()
+        results = Queue.Queue()
+        count = 0
+        for feed in feeds:
+            requests.put(feed)
+            count += 1
+        workers = []
+        for i in range(min(self.threads, count)):
+            requests.put(None)
+            worker = threading.Thread(target=self._work,
+                    args=(requests, results))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        try:
+            for i in range(count):
+                yield results.get()
+        finally:
+            # Abandoned: drop the remaining requests
+            while True:
+                try:
+                    requests.get_nowait()
+                except Queue.Empty:
+                    break
+            for worker in workers:
+                requests.put(None)
+
+    def close(self):
+        "Close the idle connections. "
+        self.keepalive.close()
+
+    def _work(self, requests, results):
+        while True:
+            feed = requests.get()
+            if feed is None:
+                return
+            if isinstance(feed, tuple):
+                name, params = feed
+            else:
+                name, params = feed, {}
+            try:
+                params = dict(params)
+                format = params.setdefault('format', 'json')
+                posts = params.pop('posts', False)
+                url = dlcs_feed_url(name, self.url_map, **params)
+                connections, rate_limiter = self._host(urlparse(url)[1])
+                connections.acquire()
+                try:
+                    rate_limiter()
+                    # retries wait for the host too
+                    result = dlcs_feed(url, format=format,
+                            opener=self.opener, posts=posts,
+                            rate_limiter=rate_limiter)
+                finally:
+                    connections.release()
+            except Exception, e:
+                results.put((feed, None, e))
+            else:
+                results.put((feed, result, None))
+
+    def _host(self, host):
+        self._lock.acquire()
+        try:
+            if host not in self._hosts:
+                self._hosts[host] = (
+                        threading.Semaphore(self.host_connections),
+                        TokenBucket(self.host_rate, self.host_connections))
+            return self._hosts[host]
+        finally:
+            self._lock.release()
+
+
+class PostsPages:
+    """Iterates over the posts of a ``DeliciousAPI`` collection in pages of
+    `results` posts, requested with the ``posts/all`` `start` and `results`
+    parameters from offset `start` on. Each page is a list of post
+    dictionaries. Other `params` are passed on to ``posts_all()``.
+
+    With `prefetch` the next page is requested in a background thread while
+    the caller processes the current one. Requests still go through the
+    rate limiter of the API. A failed request raises its exception from
+    ``next()``; calling ``next()`` again retries the same page, or a new
+    instance can continue from the `start` attribute.
+
+    Some attributes:
+    :start: the offset of the next page
+    :pages: the number of pages returned
+    :requests: the number of requests completed
+    :attrs: the attributes of the first posts document, e.g. 'update'
+    """
+    def __init__(self, api, start=0, results=DLCS_PAGE_SIZE, prefetch=True,
+            **params):
+        self.api = api
+        self.start = start
+        self.results = results
+        self.prefetch = prefetch
+        self.params = params
+        self.pages = self.requests = 0
+        self.attrs = None
+        self._pending = None
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        if self._pending is None:
+            self._pending = self._request(self.start, False)
+        thread, result = self._pending
+        self._pending = None
+        if thread:
+            thread.join()
+        if 'error' in result:
+            exc_info = result['error']
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        posts = result['posts']
+        self.requests += 1
+        if self.attrs is None:
+            self.attrs = result['attrs']
+        if len(posts) < self.results:
+            self._done = True
+        elif self.prefetch:
+            self._pending = self._request(self.start + len(posts), True)
+        if not posts:
+            raise StopIteration
+        self.start += len(posts)
+        self.pages += 1
+        return posts
+
+    def _request(self, start, background):
+        "Request the page at `start`, returns the thread and the result. "
+        result = {}
+        def fetch():
+            try:
+                rs = self.api.posts_all(start=start, results=self.results,
+                        **self.params)
+                result['posts'] = rs['posts']
+                result['attrs'] = dict([(k, v) for k, v in rs.items()
+                    if k != 'posts'])
+            except Exception:
+                result['error'] = sys.exc_info()
+        if not background:
+            fetch()
+            return None, result
+        thread = threading.Thread(target=fetch)
+        thread.setDaemon(True)
+        thread.start()
+        return thread, result
+
+
 ### Main module class
 
 class DeliciousAPI:
@@ -645,7 +2232,8 @@ class DeliciousAPI:
     def __init__(self, user, passwd, codec=PREFERRED_ENCODING,
             api_request=dlcs_api_request, xml_parser=dlcs_parse_xml,
             build_opener=dlcs_api_opener, encode_params=dlcs_encode_params,
-            encoded=False):
+            encoded=False, rate_limiter=None, memoize=0,
+            memoize_check=DLCS_MEMOIZE_CHECK, metrics=None, retry_policy=None):
 
         """Initialize access to the API for ``user`` with ``passwd``.
 
@@ -662,8 +2250,29 @@ class DeliciousAPI:
         with HTTP authentication. See ``dlcs_api_opener()`` for the default
         implementation.
 
-        ``encode_params`` finally preprocesses API parameters before
+        ``encode_params`` preprocesses API parameters before
         they are passed to ``api_request``.
+
+        ``rate_limiter`` is set on the opener to throttle the requests
+        of this instance only, e.g. a ``TokenBucket``. By default all
+        instances share the module's ``Waiter``. Likewise ``retry_policy``
+        replaces the ``DefaultRetryPolicy`` for this instance, see
+        ``RetryPolicy``.
+
+        With ``memoize`` set to a number the results of that many requests to
+        the read-only paths in ``memoized_paths`` are kept. They are
+        dropped after a succesful request to one of the ``write_paths``, or
+        when a ``posts_update()`` call reports a new time. A result that was
+        memoized more than ``memoize_check`` seconds ago is requested again
+        (None to keep it until it is dropped). Memoized results are shared
+        between callers, and should not be modified.
+
+        Requests are recorded in ``metrics``, a ``RequestMetrics``, if
+        given. Callables in the ``before_request`` list are called with the
+        path and parameters before each request, those in
+        ``after_request`` with the path, the parameters and the dictionary
+        of statistics described at ``RequestMetrics``. Memoized results
+        are not requested and not recorded.
         """
 
         assert user != ""
@@ -677,11 +2286,28 @@ class DeliciousAPI:
         self._encoded = encoded
         assert callable(build_opener)
         self._opener = build_opener(user, passwd)
+        if rate_limiter:
+            self._opener.rate_limiter = rate_limiter
+        if retry_policy:
+            self._opener.retry_policy = retry_policy
         assert callable(api_request)
         self._api_request = api_request
         assert callable(xml_parser)
         self._parse_response = xml_parser
 
+        self.memo = None
+        if memoize:
+            self.memo = LRUCache(memoize)
+        self.memoize_check = memoize_check
+        self._memo_update = None
+
+        self.before_request = []
+        self.after_request = []
+        self.metrics = metrics
+        if metrics is not None:
+            self.after_request.append(
+                    lambda path, params, stats: metrics.record(path, stats))
+
     ### Core functionality
 
     def request(self, path, _raw=False, **params):
@@ -714,23 +2340,102 @@ class DeliciousAPI:
             params = self._encode_params(params, self.codec,
                     encoded=self._encoded)
 
+            rs = self._memoized(path, params)
+            if rs is None:
+                rs = self._request(path, params)
+                self._memoize(path, params, rs)
+            return rs
+
+    def _memoized(self, path, params):
+        "Return the memoized result of a request if it is recent, or None. "
+        if self.memo is None or path not in self.memoized_paths:
+            return None
+        memoized = self.memo.get((path, tuple(sorted(params.items()))))
+        if memoized is None or self.memoize_check is not None and \
+                time.time() - memoized[0] > self.memoize_check:
+            return None
+        return memoized[1]
+
+    def _memoize(self, path, params, rs):
+        "Keep the result of a request, or drop the results it outdates. "
+        if self.memo is None:
+            return
+        if path in self.memoized_paths:
+            self.memo.put((path, tuple(sorted(params.items()))),
+                    (time.time(), rs))
+        elif path in self.write_paths:
+            self.memo.clear()
+        elif path == 'posts/update':
+            if rs['update']['time'] != self._memo_update:
+                self.memo.clear()
+                self._memo_update = rs['update']['time']
+
+    def _request(self, path, params):
+        if not (self.before_request or self.after_request):
             # get answer and parse
             fl = self._api_request(path, params=params, opener=self._opener)
-            rs = self._parse_response(fl)
+            return self._check_response(path, params,
+                    self._parse_response(fl))
 
-            if type(rs) == dict and 'result' in rs:
-                if not rs['result'][0]:
-                    # Raise an error for negative 'result' answers
-                    errmsg = ""
-                    if len(rs['result'])>0:
-                        errmsg = rs['result'][1]
-                    DeliciousError.raiseFor(errmsg, path, **params)
+        stats = self._before_request(path, params)
+        try:
+            fl = self._api_request(path, params=params, opener=self._opener)
+            self._response_stats(fl, stats)
+            if hasattr(fl, 'read'):
+                fl = _CountingFile(fl)
+            start = time.time()
+            rs = self._parse_response(fl)
+            stats['parse'] = time.time() - start
+            if isinstance(fl, _CountingFile):
+                self._read_stats(fl, stats)
+            rs = self._check_response(path, params, rs)
+        except Exception, e:
+            self._after_request(path, params, stats, e)
+            raise
+        self._after_request(path, params, stats)
+        return rs
+
+    def _before_request(self, path, params):
+        for hook in self.before_request:
+            hook(path, params)
+        return {'wait': None, 'network': None, 'parse': None,
+            'bytes': None, 'wire_bytes': None, 'retries': 0, 'error': None,
+            'total': time.time()}
+
+    def _response_stats(self, fl, stats):
+        for name in ('wait', 'network', 'retries'):
+            stats[name] = getattr(fl, name, stats[name])
+
+    def _read_stats(self, fl, stats):
+        "Move the time spent reading the parsed body to network time. "
+        stats['network'] = (stats['network'] or 0) + fl.seconds
+        stats['parse'] -= fl.seconds
+        stats['bytes'] = fl.bytes
+        stats['wire_bytes'] = wire_bytes(fl.fp, fl.bytes)
+
+    def _after_request(self, path, params, stats, error=None):
+        stats['total'] = time.time() - stats['total']
+        if error is not None:
+            stats['error'] = error.__class__.__name__
+        for hook in self.after_request:
+            hook(path, params, stats)
+
+    def _check_response(self, path, params, rs):
+        "Return the parsed response `rs`, see ``request()``. "
+
+        if type(rs) == dict and 'result' in rs:
+            if not rs['result'][0]:
+                # Raise an error for negative 'result' answers
+                errmsg = ""
+                if len(rs['result'])>0:
+                    errmsg = rs['result'][1]
+                DeliciousError.raiseFor(errmsg, path, **params)
 
-                else:
-                    # not out-of-the-oridinary result, OK
-                    return
+            else:
+                # not out-of-the-oridinary result, OK
+                return
 
-            return rs
+        return rs
 
     def request_raw(self, path, **params):
         """Calls the path in the API, returns the filehandle. Returned file-
@@ -740,7 +2445,22 @@ class DeliciousAPI:
         """
         # see `request()` on how the response can be handled
         params = self._encode_params(params, self.codec, encoded=self._encoded)
-        return self._api_request(path, params=params, opener=self._opener)
+        if self.memo is not None and path in self.write_paths:
+            self.memo.clear()
+        if not (self.before_request or self.after_request):
+            return self._api_request(path, params=params, opener=self._opener)
+
+        # the response is read by the caller, only the time to the headers
+        # is recorded
+        stats = self._before_request(path, params)
+        try:
+            fl = self._api_request(path, params=params, opener=self._opener)
+        except Exception, e:
+            self._after_request(path, params, stats, e)
+            raise
+        self._response_stats(fl, stats)
+        self._after_request(path, params, stats)
+        return fl
 
     ### Explicit declarations of API paths, their parameters and docs
 
@@ -873,6 +2593,28 @@ class DeliciousAPI:
             return self.request("posts/all", tag=tag, fromdt=fromdt, todt=todt,
                     start=start, results=results, meta=meta, **kwds)
 
+    def iter_posts_all(self, tag="", fromdt=None, todt=None, meta=True,
+            _compact=False, **kwds):
+        """Like `posts_all` but parses the response while it is read, and
+        yields the posts one at a time. Use this for large collections.
+        With ``_compact=True`` the posts are ``Post`` records.
+
+        See ``dlcs_iterparse_posts()``.
+        """
+        fl = self.request_raw("posts/all", tag=tag, fromdt=fromdt, todt=todt,
+                meta=meta, **kwds)
+        return dlcs_iterparse_posts(fl, "posts/all", _compact)
+
+    def posts_pages(self, tag="", fromdt=None, todt=None, meta=True,
+            start=0, results=DLCS_PAGE_SIZE, prefetch=True, **kwds):
+        """Returns an iterator over all posts in pages of `results` posts,
+        from offset `start` on. The next page is requested while the current
+        one is processed, unless `prefetch` is false. Use this for
+        collections too large to request at once, see ``PostsPages``.
+        """
+        return PostsPages(self, start, results, prefetch, tag=tag,
+                fromdt=fromdt, todt=todt, meta=meta, **kwds)
+
     def posts_add(self, url, description, extended="", tags="", dt="",
             replace=False, shared=True, **kwds):
         """Add a post to del.icio.us. Returns a `result` message or raises an
@@ -908,6 +2650,116 @@ class DeliciousAPI:
         """
         return self.request("posts/delete", url=url, **kwds)
 
+    def posts_bulk(self, operations, journal=None, retries=DLCS_BULK_RETRIES):
+        """Add, replace or delete many posts. Returns an iterator that
+        performs the operations one by one and yields ``(url, action,
+        status)`` for each.
+
+        ``operations`` is a sequence of ``(action, params)`` tuples, with
+        action 'add', 'replace' or 'delete' and a dictionary of arguments
+        for ``posts_add`` or ``posts_delete`` that includes 'url'. Of several
+        operations on one URL only the last is performed, at the position
+        of the first.
+
+        The calls are paced by the rate limiter like any other request, and
+        throttled calls are retried up to ``retries`` times. Status is 'done'
+        or the exception for an operation that failed.
+
+        With ``journal`` set to a filename every performed operation is
+        logged to that file. When the journal of an interrupted run of the
+        same operations exists the operations it lists as done are skipped,
+        and reported with status 'journal'; the journal of any other run is
+        overwritten. The journal is removed after all operations succeeded.
+        """
+        urls, ops, done, run = self._bulk_plan(operations, journal)
+        failed = 0
+        fl = journal and self._bulk_journal(journal, run, done)
+        try:
+            for url in urls:
+                action, params = ops[url]
+                key, digest = self._bulk_key(url, action, params)
+                if done.get(key) == digest:
+                    yield url, action, 'journal'
+                    continue
+
+                status = self._posts_bulk_call(action, params, retries)
+                if status != 'done':
+                    failed += 1
+                if fl:
+                    print >>fl, status == 'done' and 'done' or 'fail', \
+                            digest, key
+                    fl.flush()
+                yield url, action, status
+        finally:
+            if fl:
+                fl.close()
+
+        if journal and not failed:
+            os.unlink(journal)
+
+    def _bulk_plan(self, operations, journal):
+        """Return the URLs of the operations in order, the last operation for
+        each URL, the digests the journal lists as done, by URL, and the
+        digest of the run. Only a journal of the same run is read.
+        """
+        urls = []
+        ops = {}
+        for action, params in operations:
+            if action not in ('add', 'replace', 'delete'):
+                raise PyDeliciousException, \
+                        "Unknown bulk operation '%s'" % action
+            url = params['url']
+            if url not in ops:
+                urls.append(url)
+            ops[url] = action, params
+        run = md5(' '.join([self._bulk_key(url, *ops[url])[1]
+            for url in urls])).hexdigest()
+
+        done = {}
+        if journal and os.path.exists(journal):
+            lines = open(journal).read().splitlines()
+            if lines and lines[0] == 'run ' + run:
+                for line in lines[1:]:
+                    status, digest, url = line.split(' ', 2)
+                    if status == 'done':
+                        done[url] = digest
+        return urls, ops, done, run
+
+    def _bulk_journal(self, journal, run, done):
+        "Open the journal to resume the run, or a new one. "
+        if done:
+            return open(journal, 'a')
+        fl = open(journal, 'w')
+        print >>fl, 'run', run
+        return fl
+
+    def _bulk_key(self, url, action, params):
+        "Return the journal key and digest of an operation. "
+        key = url
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return key, md5(repr((action, sorted(params.items())))).hexdigest()
+
+    def _posts_bulk_call(self, action, params, retries):
+        params = dict(params)
+        if action == 'delete':
+            method = self.posts_delete
+        else:
+            params['replace'] = action == 'replace'
+            method = self.posts_add
+        for attempt in range(retries + 1):
+            try:
+                method(**params)
+                return 'done'
+            except PyDeliciousThrottled, last_error:
+                # the rate limiter has backed off, try again
+                if DEBUG: print >>sys.stderr, \
+                        "posts_bulk: %s throttled, %i retries left" % (
+                            params['url'], retries - attempt)
+            except (DeliciousError, PyDeliciousException), e:
+                return e
+        return last_error
+
     # Bundles
     def bundles_all(self, **kwds):
         """Retrieve user bundles from del.icio.us.
@@ -963,6 +2815,14 @@ class DeliciousAPI:
     def get_method(self, path):
         return getattr(self, self.paths[path])
 
+    # Paths whose results may be memoized, see ``__init__``
+    memoized_paths = ('tags/get', 'posts/dates', 'posts/get', 'posts/recent',
+        'posts/all', 'tags/bundles/all')
+
+    # Paths that change the collection
+    write_paths = ('tags/delete', 'tags/rename', 'posts/add', 'posts/delete',
+        'tags/bundles/set', 'tags/bundles/delete')
+
     def get_url(self, url):
         """Return the del.icio.us url at which the HTML page with posts for
         ``url`` can be found.
@@ -0,0 +1,522 @@
+"""Asynchronous access to the del.icio.us API from an asyncio event loop.
+
+``AsyncDeliciousAPI`` has the methods of ``DeliciousAPI``, but every API call
+is a coroutine that runs on the event loop instead of blocking a thread::
+
+    @asyncio.coroutine
+    def recent_hrefs(api):
+        posts = yield From(api.posts_recent(count=5))
+        raise Return([post['href'] for post in posts['posts']])
+
+    api = AsyncDeliciousAPI(user, passwd)
+    loop = asyncio.get_event_loop()
+    print loop.run_until_complete(recent_hrefs(api))
+
+This requires Trollius, the asyncio port for Python 2, hence the ``yield
+From(...)`` and ``raise Return(...)`` forms.
+
+The requests of all instances are throttled by the shared
+``pydelicious.Waiter``, or per instance by its `rate_limiter`. Coroutines
+waiting for the rate limiter sleep on the event loop. Proxies are not
+supported.
+"""
+import os
+import sys
+import time
+import base64
+import httplib
+from StringIO import StringIO
+from urllib import urlencode, addinfourl, splitport
+from urlparse import urlparse
+
+import trollius as asyncio
+from trollius import From, Return
+
+import pydelicious
+from pydelicious import DeliciousAPI, dlcs_parse_xml, dlcs_encode_params, \
+    dlcs_iterparse_posts, retry_after_seconds, annotate, decode_body, \
+    _CountingFile, RetryPolicy, DeliciousError, \
+    PyDeliciousException, PyDeliciousThrottled, PyDeliciousUnauthorized, \
+    PREFERRED_ENCODING, USER_AGENT, DLCS_KEEPALIVE_POOLSIZE, \
+    DLCS_KEEPALIVE_TIMEOUT, DLCS_REQUEST_TIMEOUT, DLCS_ACCEPT_ENCODING, \
+    DLCS_BULK_RETRIES, DLCS_PAGE_SIZE, DLCS_MEMOIZE_CHECK
+
+
+class AsyncOpener:
+
+    """Requests URLs with HTTP Basic authorization over persistent
+    connections, the asynchronous counterpart of the urllib2 openers built by
+    ``pydelicious.build_api_opener``.
+
+    Some attributes:
+    :rate_limiter: throttles requests through this opener, or None for the
+        shared ``pydelicious.Waiter``
+    :retry_policy: a ``pydelicious.RetryPolicy`` for failed requests, or None
+        for the shared ``pydelicious.DefaultRetryPolicy``
+    :poolsize: the number of idle connections kept per host
+    :timeout: seconds before a request is abandoned
+    :created: the number of connections opened
+    :reused: the number of requests sent on an idle connection
+    """
+
+    def __init__(self, user, passwd, poolsize=DLCS_KEEPALIVE_POOLSIZE,
+            timeout=DLCS_REQUEST_TIMEOUT, rate_limiter=None, loop=None,
+            retry_policy=None):
+        self.authorization = 'Basic ' + base64.b64encode(
+                '%s:%s' % (user, passwd))
+        self.poolsize = poolsize
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.loop = loop
+        self.created = self.reused = 0
+        self._idle = {}
+
+    @asyncio.coroutine
+    def open(self, url, timeout=None):
+        """GET the URL, and return the response as an ``urllib.addinfourl``
+        like those of urllib2. Raises ``PyDeliciousUnauthorized``,
+        ``PyDeliciousThrottled`` or ``PyDeliciousException`` for HTTP errors.
+        `timeout` overrides the timeout of the opener. Gzip or deflate coded
+        bodies are decoded while they are read.
+        """
+        scheme, netloc, path, params, query, fragment = urlparse(url)
+        selector = path
+        if query:
+            selector += '?' + query
+        key = scheme, netloc
+
+        while True:
+            conn, reused = yield From(self._connect(key))
+            try:
+                response = yield From(asyncio.wait_for(
+                    self._request(conn, netloc, selector),
+                    timeout or self.timeout, loop=self.loop))
+            except (EnvironmentError, EOFError, asyncio.TimeoutError), e:
+                conn[1].close()
+                if reused and not isinstance(e, asyncio.TimeoutError):
+                    # The server closed the idle connection, use a new one
+                    continue
+                raise
+            break
+
+        code, msg, headers, body, keep_alive = response
+        idle = self._idle.setdefault(key, [])
+        if keep_alive and len(idle) < self.poolsize:
+            idle.append((conn, time.time()))
+        else:
+            conn[1].close()
+
+        if code == 401:
+            raise PyDeliciousUnauthorized, "Check credentials."
+        elif code == 503:
+            errmsg = "Try again later."
+            delay = None
+            if 'Retry-After' in headers:
+                errmsg = "You may try again after %s" % headers['Retry-After']
+                delay = retry_after_seconds(headers['Retry-After'])
+            backoff = getattr(self.rate_limiter or pydelicious.Waiter,
+                    'backoff', None)
+            if backoff:
+                backoff(delay)
+            e = PyDeliciousThrottled(errmsg)
+            e.retry_after = delay
+            raise e
+        elif code >= 400:
+            raise PyDeliciousException, "HTTP Error %i: %s" % (code, msg)
+
+        fl = addinfourl(decode_body(StringIO(body), headers), headers, url,
+                code)
+        fl.msg = msg
+        raise Return(fl)
+
+    def close(self):
+        "Close all idle connections. "
+        for idle in self._idle.values():
+            for (reader, writer), since in idle:
+                writer.close()
+        self._idle = {}
+
+    def stats(self):
+        return {'created': self.created, 'reused': self.reused,
+            'idle': sum([len(idle) for idle in self._idle.values()])}
+
+    @asyncio.coroutine
+    def _connect(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            conn, since = idle.pop()
+            if time.time() - since < DLCS_KEEPALIVE_TIMEOUT \
+                    and not conn[0].at_eof():
+                self.reused += 1
+                raise Return((conn, True))
+            conn[1].close()
+
+        scheme, netloc = key
+        host, port = splitport(netloc)
+        ssl = scheme == 'https'
+        if port:
+            port = int(port)
+        else:
+            port = ssl and 443 or 80
+        conn = yield From(asyncio.open_connection(host, port, ssl=ssl,
+            loop=self.loop))
+        self.created += 1
+        raise Return((conn, False))
+
+    @asyncio.coroutine
+    def _request(self, conn, host, selector):
+        reader, writer = conn
+        writer.write("GET %s HTTP/1.1\r\n"
+                "Host: %s\r\n"
+                "User-Agent: %s\r\n"
+                "Authorization: %s\r\n"
+                "Accept-Encoding: %s\r\n"
+                "\r\n" % (selector, host, USER_AGENT, self.authorization,
+                    DLCS_ACCEPT_ENCODING))
+
+        line = yield From(reader.readline())
+        if not line:
+            raise EOFError, "Connection closed by server"
+        version, code, msg = (line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+        lines = []
+        while True:
+            line = yield From(reader.readline())
+            if line in ('\r\n', '\n', ''):
+                break
+            lines.append(line)
+        headers = httplib.HTTPMessage(StringIO(''.join(lines)))
+
+        keep_alive = version == 'HTTP/1.1' and \
+                headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = yield From(reader.readline())
+                size = int(size.split(';')[0], 16)
+                if not size:
+                    # skip trailer
+                    while (yield From(reader.readline())) not in \
+                            ('\r\n', '\n', ''):
+                        pass
+                    break
+                chunks.append((yield From(reader.readexactly(size))))
+                yield From(reader.readexactly(2))
+            body = ''.join(chunks)
+        elif 'content-length' in headers:
+            body = yield From(reader.readexactly(
+                int(headers['content-length'])))
+        else:
+            body = yield From(reader.read())
+            keep_alive = False
+
+        raise Return((int(code), msg, headers, body, keep_alive))
+
+
+def async_api_opener(user, passwd):
+    "Build an ``AsyncOpener`` for the API. "
+    return AsyncOpener(user, passwd)
+
+
+@asyncio.coroutine
+def wait_for_token(rate_limiter, loop=None):
+    """Wait on the event loop for the rate limiter, a ``TokenBucket``. Other
+    rate limiters are simply called.
+    """
+    reserve = getattr(rate_limiter, 'reserve', None)
+    if reserve:
+        wait = reserve()
+        if wait > 0:
+            yield From(asyncio.sleep(wait, loop=loop))
+    else:
+        rate_limiter()
+
+
+@asyncio.coroutine
+def async_api_request(path, params=None, user='', passwd='', throttle=True,
+        opener=None, retry=None):
+    """Coroutine to retrieve/query a path within the del.icio.us API, see
+    ``pydelicious.dlcs_api_request()``. Failed requests are retried
+    according to the `retry_policy` of the opener, or with `retry` attempts
+    after connection errors and time-outs like ``http_request()``. Like with
+    ``dlcs_api_request()`` the response has `wait`, `network` and `retries`
+    attributes.
+    """
+    if not opener:
+        opener = async_api_opener(user, passwd)
+    rate_limiter = opener.rate_limiter or pydelicious.Waiter
+    if retry is not None:
+        policy = RetryPolicy(connect=retry - 1, timeout=retry - 1)
+    else:
+        policy = opener.retry_policy or pydelicious.DefaultRetryPolicy
+
+    wait = time.time()
+    if throttle:
+        yield From(wait_for_token(rate_limiter, opener.loop))
+    wait = time.time() - wait
+
+    if params:
+        url = "%s/%s?%s" % (pydelicious.DLCS_API, path, urlencode(params))
+    else:
+        url = "%s/%s" % (pydelicious.DLCS_API, path)
+
+    if pydelicious.DEBUG: print >>sys.stderr, \
+            "async_api_request: %s" % url
+
+    start = time.time()
+    retries = 0
+    # Number of failed attempts per kind of failure
+    failures = {}
+    while True:
+        try:
+            fl = yield From(opener.open(url,
+                policy.timeout(time.time() - start, opener.timeout)))
+            annotate(fl, wait=wait, network=time.time() - start,
+                    retries=retries)
+            raise Return(fl)
+        except (EnvironmentError, EOFError, asyncio.TimeoutError,
+                PyDeliciousThrottled), e:
+            if isinstance(e, asyncio.TimeoutError):
+                kind = 'timeout'
+            else:
+                kind = policy.classify(e) or 'connect'
+            failures[kind] = failures.get(kind, 0) + 1
+            delay = policy.delay(kind, failures, time.time() - start,
+                    policy.retry_after(e))
+            if delay is None:
+                if kind == 'throttled':
+                    raise
+                raise PyDeliciousException, \
+                        "Unable to retrieve data at '%s', %s" % (url, e)
+            print >> sys.stderr, "%s, retrying in %.1f seconds." % (e, delay)
+            yield From(asyncio.sleep(delay, loop=opener.loop))
+            yield From(wait_for_token(rate_limiter, opener.loop))
+            retries += 1
+
+
+class AsyncPostsPages:
+
+    """The pages of posts of an ``AsyncDeliciousAPI`` collection, like
+    ``pydelicious.PostsPages``. ``next()`` is a coroutine that returns the
+    next page, or None after the last one::
+
+        pages = api.posts_pages(results=100)
+        while True:
+            page = yield From(pages.next())
+            if page is None:
+                break
+
+    With `prefetch` the next page is requested in a task on the event loop
+    while the caller processes the current one. A failed request raises its
+    exception from ``next()``, calling it again retries the same page.
+
+    Some attributes:
+    :start: the offset of the next page
+    :pages: the number of pages returned
+    :requests: the number of requests completed
+    :attrs: the attributes of the first posts document, e.g. 'update'
+    """
+
+    def __init__(self, api, start=0, results=DLCS_PAGE_SIZE, prefetch=True,
+            **params):
+        self.api = api
+        self.start = start
+        self.results = results
+        self.prefetch = prefetch
+        self.params = params
+        self.pages = self.requests = 0
+        self.attrs = None
+        self._pending = None
+        self._done = False
+
+    @asyncio.coroutine
+    def next(self):
+        if self._done:
+            raise Return(None)
+        if self._pending is None:
+            self._pending = self._request(self.start)
+        pending, self._pending = self._pending, None
+        rs = yield From(pending)
+
+        posts = rs['posts']
+        self.requests += 1
+        if self.attrs is None:
+            self.attrs = dict([(k, v) for k, v in rs.items() if k != 'posts'])
+        if len(posts) < self.results:
+            self._done = True
+        elif self.prefetch:
+            self._pending = self._request(self.start + len(posts))
+        if not posts:
+            raise Return(None)
+        self.start += len(posts)
+        self.pages += 1
+        raise Return(posts)
+
+    def _request(self, start):
+        "Schedule the request for the page at `start`, returns the task. "
+        return asyncio.ensure_future(self.api.posts_all(start=start,
+            results=self.results, **self.params), loop=self.api._opener.loop)
+
+
+class AsyncDeliciousAPI(DeliciousAPI):
+
+    """``DeliciousAPI`` for asyncio event loops: ``request()``,
+    ``request_raw()`` and all methods for the API paths (``tags_get()``,
+    ``posts_all()``, ``posts_add()``, etc.) are coroutines, with the same
+    parameters and results as the methods of ``DeliciousAPI``.
+
+    Each instance keeps its own persistent connections, call ``close()`` when
+    done. ``posts_bulk()`` is a coroutine too, it returns all results at
+    once instead of an iterator. Results are memoized as described at
+    ``DeliciousAPI``.
+    """
+
+    def __init__(self, user, passwd, codec=PREFERRED_ENCODING,
+            api_request=async_api_request, xml_parser=dlcs_parse_xml,
+            build_opener=async_api_opener, encode_params=dlcs_encode_params,
+            encoded=False, rate_limiter=None, memoize=0,
+            memoize_check=DLCS_MEMOIZE_CHECK, metrics=None, retry_policy=None):
+        DeliciousAPI.__init__(self, user, passwd, codec, api_request,
+                xml_parser, build_opener, encode_params, encoded,
+                rate_limiter, memoize, memoize_check, metrics=metrics,
+                retry_policy=retry_policy)
+
+    @asyncio.coroutine
+    def request(self, path, _raw=False, **params):
+        "See ``DeliciousAPI.request()``. "
+        if _raw:
+            fl = yield From(self.request_raw(path, **params))
+            raise Return(fl)
+
+        params = self._encode_params(params, self.codec,
+                encoded=self._encoded)
+        rs = self._memoized(path, params)
+        if rs is not None:
+            raise Return(rs)
+        if not (self.before_request or self.after_request):
+            fl = yield From(self._api_request(path, params=params,
+                opener=self._opener))
+            rs = self._check_response(path, params, self._parse_response(fl))
+            self._memoize(path, params, rs)
+            raise Return(rs)
+
+        stats = self._before_request(path, params)
+        try:
+            fl = yield From(self._api_request(path, params=params,
+                opener=self._opener))
+            self._response_stats(fl, stats)
+            # the response was read completely by the opener, only count it
+            fl = _CountingFile(fl)
+            start = time.time()
+            rs = self._parse_response(fl)
+            stats['parse'] = time.time() - start
+            self._read_stats(fl, stats)
+            rs = self._check_response(path, params, rs)
+        except Exception, e:
+            self._after_request(path, params, stats, e)
+            raise
+        self._after_request(path, params, stats)
+        self._memoize(path, params, rs)
+        raise Return(rs)
+
+    @asyncio.coroutine
+    def request_raw(self, path, **params):
+        "See ``DeliciousAPI.request_raw()``. "
+        params = self._encode_params(params, self.codec,
+                encoded=self._encoded)
+        if self.memo is not None and path in self.write_paths:
+            self.memo.clear()
+        stats = self._before_request(path, params)
+        try:
+            fl = yield From(self._api_request(path, params=params,
+                opener=self._opener))
+        except Exception, e:
+            self._after_request(path, params, stats, e)
+            raise
+        self._response_stats(fl, stats)
+        self._after_request(path, params, stats)
+        raise Return(fl)
+
+    @asyncio.coroutine
+    def iter_posts_all(self, tag="", fromdt=None, todt=None, meta=True,
+            _compact=False, **kwds):
+        """Returns an iterator over the parsed posts, see
+        ``DeliciousAPI.iter_posts_all()``. The document is read completely
+        before parsing starts.
+        """
+        fl = yield From(self.request_raw("posts/all", tag=tag,
+            fromdt=fromdt, todt=todt, meta=meta, **kwds))
+        raise Return(dlcs_iterparse_posts(fl, "posts/all", _compact))
+
+    @asyncio.coroutine
+    def posts_bulk(self, operations, journal=None, retries=DLCS_BULK_RETRIES):
+        """Add, replace or delete many posts, see
+        ``DeliciousAPI.posts_bulk()``. The operations are performed one after
+        another, returns the list of ``(url, action, status)`` when all are
+        done. The journal is written and read like the one of
+        ``DeliciousAPI.posts_bulk()``.
+        """
+        urls, ops, done, run = self._bulk_plan(operations, journal)
+        results = []
+        failed = 0
+        fl = journal and self._bulk_journal(journal, run, done)
+        try:
+            for url in urls:
+                action, params = ops[url]
+                key, digest = self._bulk_key(url, action, params)
+                if done.get(key) == digest:
+                    results.append((url, action, 'journal'))
+                    continue
+
+                status = yield From(self._posts_bulk_call(action, params,
+                    retries))
+                if status != 'done':
+                    failed += 1
+                if fl:
+                    print >>fl, status == 'done' and 'done' or 'fail', \
+                            digest, key
+                    fl.flush()
+                results.append((url, action, status))
+        finally:
+            if fl:
+                fl.close()
+
+        if journal and not failed:
+            os.unlink(journal)
+        raise Return(results)
+
+    @asyncio.coroutine
+    def _posts_bulk_call(self, action, params, retries):
+        params = dict(params)
+        if action == 'delete':
+            method = self.posts_delete
+        else:
+            params['replace'] = action == 'replace'
+            method = self.posts_add
+        for attempt in range(retries + 1):
+            try:
+                yield From(method(**params))
+                raise Return('done')
+            except PyDeliciousThrottled, last_error:
+                # the rate limiter has backed off, try again
+                if pydelicious.DEBUG: print >>sys.stderr, \
+                        "posts_bulk: %s throttled, %i retries left" % (
+                            params['url'], retries - attempt)
+            except (DeliciousError, PyDeliciousException), e:
+                raise Return(e)
+        raise Return(last_error)
+
+    def posts_pages(self, tag="", fromdt=None, todt=None, meta=True,
+            start=0, results=DLCS_PAGE_SIZE, prefetch=True, **kwds):
+        """Returns an ``AsyncPostsPages`` over all posts in pages of
+        `results` posts, see ``DeliciousAPI.posts_pages()``.
+        """
+        return AsyncPostsPages(self, start, results, prefetch, tag=tag,
+                fromdt=fromdt, todt=todt, meta=meta, **kwds)
+
+    def close(self):
+        "Close the persistent connections. "
+        self._opener.close()
+
+    def __repr__(self):
+        return "AsyncDeliciousAPI(%s)" % self.user
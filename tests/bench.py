@@ -0,0 +1,514 @@
+"""Benchmarks for parsing, encoding and the dlcs cached queries.
+
+Synthetic ``posts/all``, ``tags/get`` and ``posts/dates`` documents, RSS and
+JSON feeds are generated for every size (number of items), and then parsed,
+encoded or queried. Every benchmark runs in a forked child process, so the
+peak memory reported is its own. Results are written as JSON, which can be
+compared with the results of another version::
+
+    % python tests/bench.py -o new.json
+    % python tests/bench.py --sizes 1000,10000 --bench parse_posts_all
+    % python tests/bench.py --compare old.json new.json
+
+Reported per benchmark and size:
+
+:seconds: the best wall time of the runs
+:times: the wall time of each run
+:peak_rss_kb: the peak resident memory of the child process
+:rss_growth_kb: how much the peak grew while running, i.e. excluding the
+    generated input
+"""
+import os
+import sys
+import gc
+import time
+import random
+import codecs
+import shutil
+import tempfile
+import optparse
+from cStringIO import StringIO
+from ConfigParser import ConfigParser
+from xml.sax.saxutils import quoteattr, escape
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+try:
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+import pydelicious
+from pydelicious import PyDeliciousException
+
+try:
+    from tools import dlcs
+except ImportError:
+    # installed package
+    from pydelicious.tools import dlcs
+
+
+SIZES = (1000, 10000, 100000, 1000000)
+"Default numbers of items per document"
+
+REPEAT = 3
+"Default number of runs per benchmark and size"
+
+WORDS = ('python', 'web', 'programming', 'design', 'linux', 'music',
+    'reference', 'tools', 'software', 'blog', 'video', 'news', 'howto',
+    'tutorial', 'art', 'photography', 'science', 'research', 'books',
+    'javascript', 'css', 'free', 'opensource', 'food', 'travel', 'games',
+    'history', 'security', 'education', 'business', 'culture', 'politics',
+    u'caf\xe9', u'm\xfasica', u'\u65e5\u672c')
+"Words for tags and descriptions, the first ones occur most"
+
+
+## Synthetic data
+
+def pick(rng, words):
+    "Pick a word, with a long-tailed (Zipf-like) distribution. "
+    return words[int(rng.paretovariate(1.0) - 1) % len(words)]
+
+def vocabulary(size):
+    "Return `size` distinct tags, most frequent first. "
+    return [WORDS[i % len(WORDS)] + (i >= len(WORDS) and
+        unicode(i // len(WORDS)) or u'') for i in range(size)]
+
+def gen_posts(size, seed=0):
+    """Generate `size` post dictionaries like those parsed from
+    ``posts/all``, with unicode values.
+    """
+    rng = random.Random(seed)
+    tags = vocabulary(max(len(WORDS), size // 20))
+    for i in xrange(size):
+        href = u'http://example.org/%s/%i' % (pick(rng, WORDS), i)
+        yield {
+            'href': href,
+            'hash': md5(href.encode('utf-8')).hexdigest(),
+            'meta': md5(str(i)).hexdigest(),
+            'description': u' '.join([pick(rng, WORDS)
+                for w in range(rng.randint(2, 8))]).capitalize(),
+            'extended': rng.random() < .3 and u' '.join([pick(rng, WORDS)
+                for w in range(rng.randint(5, 30))]) or u'',
+            'tag': u' '.join(dict.fromkeys([pick(rng, tags)
+                for t in range(rng.randint(1, 6))])),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                time.gmtime(1230000000 - i * 3600)),
+            'shared': rng.random() < .9 and u'yes' or u'no',
+            'others': unicode(rng.randint(0, 500)),
+        }
+
+def gen_tags(size):
+    "Generate `size` tag dictionaries like those parsed from ``tags/get``. "
+    for i, tag in enumerate(vocabulary(size)):
+        yield {'tag': tag, 'count': unicode(size // (i + 1) + 1)}
+
+# The documents are written to a buffer as they are generated, so their
+# generation does not take (much) more memory than the parsed result and the
+# peak memory of the benchmarks is about the benchmarked code.
+
+def xml_document(root, element, records, attrib=u''):
+    "Return an API document with an element per record as UTF-8 string. "
+    doc = StringIO()
+    doc.write('<?xml version="1.0" encoding="UTF-8"?>\n<%s%s>\n' % (
+        root, attrib))
+    for record in records:
+        doc.write((u'  <%s %s />\n' % (element, u' '.join([
+            u'%s=%s' % (k, quoteattr(v))
+            for k, v in record.items()]))).encode('utf-8'))
+    doc.write('</%s>\n' % root)
+    return doc.getvalue()
+
+def posts_all_xml(size):
+    return xml_document('posts', 'post', gen_posts(size),
+        u' tag="" user="bench"')
+
+def tags_get_xml(size):
+    return xml_document('tags', 'tag', gen_tags(size))
+
+def posts_dates_xml(size):
+    return xml_document('dates', 'date', (
+        {'count': unicode(i % 17 + 1), 'date': time.strftime('%Y-%m-%d',
+            time.gmtime(1230000000 - i * 86400))} for i in xrange(size)),
+        u' tag="" user="bench"')
+
+def rss_feed(size):
+    "Return an RSS 2.0 feed like the version 2 feeds. "
+    doc = StringIO()
+    doc.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+        '<channel><title>Delicious/bench</title>'
+        '<link>http://delicious.com/bench</link>\n')
+    for post in gen_posts(size):
+        doc.write((u'<item><title>%s</title><pubDate>%s</pubDate>'
+            u'<link>%s</link><dc:creator>bench</dc:creator>'
+            u'<description>%s</description>%s</item>\n' % (
+                escape(post['description']), post['time'],
+                escape(post['href']), escape(post['extended']),
+                u''.join([u'<category>%s</category>' % escape(t)
+                    for t in post['tag'].split()]))).encode('utf-8'))
+    doc.write('</channel></rss>\n')
+    return doc.getvalue()
+
+FEED_FIXTURES = ('rss.xml', 'rss_popular.xml', 'feed_v2.rss')
+"Recorded feeds in var/, parsed by the feed benchmarks"
+
+def fixture_feeds(size):
+    """Return the fixture feeds, repeated until they hold about `size`
+    items together.
+    """
+    var = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'var')
+    feeds = [open(os.path.join(var, name)).read() for name in FEED_FIXTURES]
+    items = sum([feed.count('<item') for feed in feeds])
+    return feeds * max(1, size // items)
+
+def json_feed(size):
+    "Return a JSON feed like the version 2 feeds. "
+    doc = StringIO()
+    doc.write('[')
+    for i, post in enumerate(gen_posts(size)):
+        if i:
+            doc.write(',')
+        doc.write(json.dumps({'u': post['href'], 'd': post['description'],
+            't': post['tag'].split(), 'dt': post['time'],
+            'n': post['extended']}))
+    doc.write(']')
+    return doc.getvalue()
+
+def encode_params(size):
+    "Return `size` parameter sets for ``posts/add``. "
+    params = []
+    for post in gen_posts(size):
+        params.append({'url': post['href'],
+            'description': post['description'], 'extended': post['extended'],
+            'tags': post['tag'], 'dt': post['time'],
+            'replace': 'no', 'shared': post['shared'].encode('utf-8')})
+    return params
+
+
+## Benchmarks
+
+class Benchmark:
+
+    """A measured function `run` and the function `setup` that returns its
+    input for a given size. `teardown` is called with the input afterwards.
+    Sizes above `max_size` are skipped.
+    """
+
+    def __init__(self, name, setup, run, teardown=None, max_size=None):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.teardown = teardown
+        self.max_size = max_size
+
+    def __repr__(self):
+        return "Benchmark(%s)" % self.name
+
+
+def parse(compact=False):
+    def run(data):
+        return pydelicious.dlcs_parse_xml(StringIO(data), compact=compact)
+    return run
+
+def iterparse(compact=False):
+    def run(data):
+        for post in pydelicious.dlcs_iterparse_posts(StringIO(data),
+                compact=compact):
+            pass
+    return run
+
+def run_encode_params(params):
+    for p in params:
+        pydelicious.dlcs_encode_params(p)
+
+def run_rss_request(data):
+    # Serve the document instead of a del.icio.us response. Each benchmark
+    # runs in its own process, so this does not affect the others.
+    pydelicious.http_request = lambda url, *args, **kwds: StringIO(data)
+    return pydelicious.dlcs_rss_request(tag='python')
+
+def run_feed_posts(feeds):
+    for feed in feeds:
+        pydelicious.dlcs_feed_posts(StringIO(feed))
+
+def run_feedparser(feeds):
+    for feed in feeds:
+        pydelicious.feedparser.parse(StringIO(feed))
+
+def run_json_feed(data):
+    pydelicious.http_request = lambda url, *args, **kwds: StringIO(data)
+    return dlcs.jsonread(pydelicious.dlcs_feed('recent', format='json'))
+
+def run_json_records(data):
+    pydelicious.http_request = lambda url, *args, **kwds: StringIO(data)
+    for record in pydelicious.dlcs_iter_feed('recent', format='json'):
+        pass
+
+
+DLCS_OPTS = {'keep_cache': True, 'ignore_case': False}
+"Options for the dlcs commands: use the cache as it is"
+
+def setup_store(size):
+    """Store `size` posts and tags in a temporary dlcs cache and build its
+    indices. Returns the directory and the dlcs configuration.
+    """
+    path = tempfile.mkdtemp(prefix='dlcs-bench-')
+    conf = ConfigParser()
+    conf.add_section('local-files')
+    conf.set('local-files', 'store', os.path.join(path, 'store.sqlite'))
+    # Indexing takes more memory than the queries
+    failed = forked(build_store, conf, size)
+    if failed:
+        shutil.rmtree(path)
+        raise PyDeliciousException, failed['error']
+    return path, conf
+
+def build_store(conf, size):
+    store = dlcs.cached_store(conf)
+    store.replace(gen_posts(size))
+    store.commit()
+    store.replace_tags(gen_tags(max(len(WORDS), size // 20)))
+    store.close()
+    # The commands get an API instance, but should not use it
+    dlcs.cached_snapshot(conf, None, True)
+    dlcs.cached_fulltext(conf, None, True)
+
+def teardown_store((path, conf)):
+    shutil.rmtree(path)
+
+def dlcs_command(cmd, *args):
+    "Return a function that runs the dlcs command without output. "
+    def run((path, conf)):
+        stdout = sys.stdout
+        # like dlcs.main does
+        sys.stdout = codecs.getwriter('utf-8')(open(os.devnull, 'w'))
+        try:
+            getattr(dlcs, cmd)(conf, None, *args, **DLCS_OPTS)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return run
+
+def store_benchmark(name, cmd, *args):
+    return Benchmark(name, setup_store, dlcs_command(cmd, *args),
+        teardown_store)
+
+
+BENCHMARKS = [
+    Benchmark('parse_posts_all', posts_all_xml, parse()),
+    Benchmark('parse_posts_all_compact', posts_all_xml, parse(True)),
+    Benchmark('iterparse_posts_all', posts_all_xml, iterparse()),
+    Benchmark('parse_tags_get', tags_get_xml, parse()),
+    Benchmark('parse_posts_dates', posts_dates_xml, parse()),
+    Benchmark('encode_params', encode_params, run_encode_params),
+    Benchmark('rss_request', rss_feed, run_rss_request),
+    Benchmark('feed_posts', fixture_feeds, run_feed_posts),
+    # feedparser takes about a millisecond per entry
+    Benchmark('feedparser', fixture_feeds, run_feedparser, max_size=10000),
+    Benchmark('json_feed', json_feed, run_json_feed),
+    Benchmark('json_feed_records', json_feed, run_json_records),
+    store_benchmark('dlcs_tagged', 'tagged', 'python+web'),
+    store_benchmark('dlcs_tagrel', 'tagrel', 'python'),
+    store_benchmark('dlcs_findposts', 'findposts', 'python', 'pro*'),
+    store_benchmark('dlcs_tags', 'tags'),
+    store_benchmark('dlcs_findtags', 'findtags', 'web'),
+    store_benchmark('dlcs_stats', 'stats'),
+]
+"All benchmarks, in the order they run"
+
+
+def peak_rss():
+    "Return the peak resident memory of this process in kilobytes. "
+    if not resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes instead of kilobytes
+        rss //= 1024
+    return rss
+
+def measure(bench, size, repeat=REPEAT):
+    "Run a benchmark `repeat` times and return its result dictionary. "
+    if bench.run is run_feedparser and not pydelicious.feedparser:
+        return {'skipped': 'feedparser not installed'}
+    data = bench.setup(size)
+    try:
+        gc.collect()
+        before = peak_rss()
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            result = bench.run(data)
+            times.append(time.time() - start)
+            del result
+        after = peak_rss()
+    finally:
+        if bench.teardown:
+            bench.teardown(data)
+    result = {'seconds': min(times), 'times': times, 'peak_rss_kb': after}
+    if after is not None:
+        result['rss_growth_kb'] = after - before
+    return result
+
+def forked(func, *args):
+    """Call `func` in a child process and return its result, which must be
+    serializable as JSON. Exceptions in the child are returned as a
+    dictionary with an 'error' message. Calls `func` in this process where
+    fork is not available.
+    """
+    if not hasattr(os, 'fork'):
+        return func(*args)
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        try:
+            try:
+                result = func(*args)
+            except Exception, e:
+                result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            fl = os.fdopen(w, 'w')
+            fl.write(json.dumps(result))
+            fl.close()
+        finally:
+            os._exit(0)
+    os.close(w)
+    fl = os.fdopen(r)
+    data = fl.read()
+    fl.close()
+    pid, status = os.waitpid(pid, 0)
+    if not data:
+        # e.g. killed when out of memory
+        return {'error': 'Exit status %i' % status}
+    return json.loads(data)
+
+def measure_forked(bench, size, repeat=REPEAT):
+    """Run ``measure()`` in a child process, so every benchmark starts from
+    the same memory use.
+    """
+    return forked(measure, bench, size, repeat)
+
+def run_benchmarks(benchmarks=BENCHMARKS, sizes=SIZES, repeat=REPEAT,
+        log=None):
+    """Run every benchmark for every size and return the results as
+    dictionary, ready to be written as JSON.
+    """
+    results = []
+    for bench in benchmarks:
+        for size in sizes:
+            if bench.max_size and size > bench.max_size:
+                result = {'skipped': 'Size above %i' % bench.max_size}
+            else:
+                result = measure_forked(bench, size, repeat)
+            result.update({'name': bench.name, 'size': size})
+            results.append(result)
+            if log:
+                print >>log, format_result(result)
+    return {
+        'version': pydelicious.__version__,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'repeat': repeat,
+        'results': results,
+    }
+
+def format_result(result):
+    name = '%(name)-26s %(size)8i' % result
+    if 'seconds' in result:
+        return '%s %10.4fs %10s kB' % (name, result['seconds'],
+            result.get('rss_growth_kb', '-'))
+    return '%s  %s' % (name, result.get('error') or result.get('skipped'))
+
+
+def compare(old, new, threshold=.1, out=sys.stdout):
+    """Print the time and memory of the `new` results relative to `old`, and
+    return the number of benchmarks that got slower by more than
+    `threshold` (a fraction).
+    """
+    previous = dict([((r['name'], r['size']), r) for r in old['results']])
+    print >>out, "%-35s %10s %10s %7s %10s" % ("%s -> %s" % (
+        old['version'], new['version']), 'old', 'new', 'time', 'memory')
+    regressions = 0
+    for result in new['results']:
+        before = previous.get((result['name'], result['size']))
+        if not before or 'seconds' not in before \
+                or 'seconds' not in result:
+            continue
+        ratio = result['seconds'] / max(before['seconds'], 1e-9)
+        memory = '-'
+        if before.get('rss_growth_kb') and \
+                result.get('rss_growth_kb') is not None:
+            memory = '%.2fx' % (float(result['rss_growth_kb']) /
+                before['rss_growth_kb'])
+        mark = ''
+        if ratio > 1 + threshold:
+            regressions += 1
+            mark = ' slower'
+        print >>out, "%-26s %8i %9.4fs %9.4fs %6.2fx %10s%s" % (
+            result['name'], result['size'], before['seconds'],
+            result['seconds'], ratio, memory, mark)
+    return regressions
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]\n"
+            "       %prog --compare old.json new.json")
+    parser.add_option('-s', '--sizes', default=','.join(map(str, SIZES)),
+            help="comma-separated numbers of items [%default]")
+    parser.add_option('-r', '--repeat', type='int', default=REPEAT,
+            help="runs per benchmark and size, the best counts [%default]")
+    parser.add_option('-b', '--bench', default='',
+            help="comma-separated names of the benchmarks to run [all]")
+    parser.add_option('-o', '--output',
+            help="write the results to this file instead of stdout")
+    parser.add_option('-c', '--compare', action='store_true',
+            help="compare two result files, exits with 1 on regressions")
+    parser.add_option('-t', '--threshold', type='float', default=.1,
+            help="fraction a benchmark may get slower [%default]")
+    parser.add_option('-l', '--list', action='store_true',
+            help="list the benchmarks")
+    opts, args = parser.parse_args(argv[1:])
+
+    if opts.list:
+        for bench in BENCHMARKS:
+            print bench.name
+        return
+
+    if opts.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        old, new = [json.load(open(fn)) for fn in args]
+        return compare(old, new, opts.threshold) and 1 or 0
+
+    benchmarks = BENCHMARKS
+    if opts.bench:
+        names = opts.bench.split(',')
+        benchmarks = [b for b in BENCHMARKS if b.name in names]
+        if len(benchmarks) != len(names):
+            parser.error("unknown benchmark in %s, see --list" % opts.bench)
+    sizes = [int(s) for s in opts.sizes.split(',')]
+
+    results = run_benchmarks(benchmarks, sizes, opts.repeat, log=sys.stderr)
+    data = json.dumps(results, indent=1, sort_keys=True)
+    if opts.output:
+        open(opts.output, 'w').write(data + '\n')
+    else:
+        print data
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,655 @@
+"""Local mock of the del.icio.us v1 API and the v2 feeds.
+
+``MockAPIServer`` answers the API paths of ``DeliciousAPI.paths`` and the
+feeds of ``pydelicious.delicious_v2_feeds`` from in-memory collections, one
+per user. API requests need HTTP Basic authorization, writes are answered
+with `result` codes like the real service, and the server can be made to
+answer slowly (`latency`) or to throttle with 503 responses (`rate`,
+`error_rate`). Bodies are gzip or deflate coded when the client accepts it,
+unless `compress` is off. Collections can be seeded with synthetic posts, see
+``bench.gen_posts()``.
+
+In tests::
+
+    server = serve_mock({'user': 'passwd'})
+    server.install()
+    try:
+        api = DeliciousAPI('user', 'passwd')
+        ...
+    finally:
+        server.uninstall()
+        server.stop()
+
+``install()`` points ``pydelicious.DLCS_API``, ``DLCS_API_HOST`` and
+``DLCS_FEEDS`` at the server. From the command line::
+
+    % python tests/mockapi.py --user test:test --posts 100000 --port 8080
+"""
+import re
+import sys
+import zlib
+import gzip
+import time
+import random
+import base64
+import optparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from cgi import parse_qs
+from StringIO import StringIO
+from urlparse import urlparse
+from xml.sax.saxutils import quoteattr, escape
+
+try:
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+import pydelicious
+from pydelicious import DLCS_API_REALM, DLCS_API_PATH, delicious_v2_feeds
+
+from bench import gen_posts, xml_document
+
+
+POST_ATTRS = ('href', 'hash', 'meta', 'description', 'extended', 'tag',
+    'time', 'shared', 'others')
+"Attributes of the post elements in API responses"
+
+
+def post_meta(post):
+    "Return the change signature of a post. "
+    return md5(u'\n'.join([post.get(k) or u'' for k in
+        ('description', 'extended', 'tag', 'time', 'shared')]
+        ).encode('utf-8')).hexdigest()
+
+def utctime(t=None):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+class MockCollection:
+
+    """The posts and bundles of one user.
+
+    Some attributes:
+    :posts: maps URL to post dictionary, with unicode values and the
+        'user' for the feeds
+    :tags: maps tag to the number of posts with it
+    :bundles: maps bundle name to its space-separated tags
+    :update: the time of the last change
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.posts = {}
+        self.tags = {}
+        self.bundles = {}
+        self.update = time.time()
+        self._ordered = None
+
+    def __len__(self):
+        return len(self.posts)
+
+    def add(self, post, replace=True):
+        "Add or replace a post, returns False if it exists and not `replace`. "
+        old = self.posts.get(post['href'])
+        if old and not replace:
+            return False
+        if old:
+            self._count(old, -1)
+        post = dict(post, user=self.user)
+        post.setdefault('hash', md5(post['href'].encode('utf-8')).hexdigest())
+        post.setdefault('extended', u'')
+        post.setdefault('tag', u'')
+        post.setdefault('time', utctime())
+        post.setdefault('shared', u'yes')
+        post.setdefault('others', u'0')
+        post['meta'] = post_meta(post)
+        self.posts[post['href']] = post
+        self._count(post, 1)
+        self._changed()
+        return True
+
+    def delete(self, href):
+        post = self.posts.pop(href, None)
+        if not post:
+            return False
+        self._count(post, -1)
+        self._changed()
+        return True
+
+    def seed(self, size, seed=0):
+        "Add `size` synthetic posts. "
+        for post in gen_posts(size, seed):
+            self.add(post)
+
+    def ordered(self):
+        "Return all posts, most recent first. "
+        if self._ordered is None:
+            self._ordered = self.posts.values()
+            self._ordered.sort(key=lambda p: p['time'], reverse=True)
+        return self._ordered
+
+    def tagged(self, tags=u''):
+        "Return the posts with all space or '+' separated `tags`. "
+        tags = tags.replace(u'+', u' ').split()
+        posts = self.ordered()
+        if tags:
+            posts = [p for p in posts if not [t for t in tags
+                if t not in p['tag'].split()]]
+        return posts
+
+    def rename_tag(self, old, new):
+        for post in self.posts.values():
+            tags = post['tag'].split()
+            if old in tags:
+                self.add(dict(post, tag=u' '.join([t == old and new or t
+                    for t in tags])))
+
+    def _count(self, post, n):
+        for tag in post['tag'].split():
+            self.tags[tag] = self.tags.get(tag, 0) + n
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+    def _changed(self):
+        self.update = time.time()
+        self._ordered = None
+
+
+class MockAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answers the requests for a ``MockAPIServer``.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # close idle keep-alive connections
+    timeout = 5
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = dict([(k, v[-1].decode('utf-8'))
+            for k, v in parse_qs(url[4], True).items()])
+        if server.latency:
+            time.sleep(server.latency)
+
+        api = '/%s/' % DLCS_API_PATH
+        if url[2].startswith(api):
+            path = url[2][len(api):]
+            user = self.authorized()
+            if not user:
+                server.count('unauthorized')
+                self.send_response(401)
+                self.send_header('WWW-Authenticate',
+                        'Basic realm="%s"' % DLCS_API_REALM)
+                self.respond('')
+            elif server.throttled(user):
+                server.count('throttled')
+                self.send_response(503)
+                self.send_header('Retry-After', str(server.retry_after))
+                self.respond('')
+            elif path in pydelicious.DeliciousAPI.paths:
+                server.count(path)
+                self.api(path, user, params)
+            else:
+                self.not_found()
+
+        elif url[2].startswith('/v2/'):
+            feed = server.match_feed(url[2][4:])
+            if feed:
+                server.count('feed')
+                self.feed(feed[0], feed[1], params)
+            else:
+                self.not_found()
+
+        else:
+            self.not_found()
+
+    def authorized(self):
+        "Return the user for valid Basic authorization, or None. "
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        try:
+            user, passwd = base64.b64decode(auth[6:]).split(':', 1)
+        except (TypeError, ValueError):
+            return None
+        if self.server.users.get(user) == passwd:
+            return user
+
+    def respond(self, body, content_type='text/xml; charset=UTF-8'):
+        self.send_header('Content-Type', content_type)
+        coding = body and self.coding()
+        if coding == 'gzip':
+            data = StringIO()
+            fl = gzip.GzipFile(fileobj=data, mode='wb')
+            fl.write(body)
+            fl.close()
+            body = data.getvalue()
+        elif coding == 'deflate':
+            body = zlib.compress(body)
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def coding(self):
+        "Return the content coding to answer with, or None. "
+        if not self.server.compress:
+            return None
+        accept = [c.split(';')[0].strip().lower() for c in
+            self.headers.get('Accept-Encoding', '').split(',')]
+        for coding in ('gzip', 'deflate'):
+            if coding in accept:
+                return coding
+
+    def not_found(self):
+        self.send_response(404)
+        self.respond('')
+
+    ## v1 API
+
+    def api(self, path, user, params):
+        server = self.server
+        server.lock.acquire()
+        try:
+            coll = server.collection(user)
+            method = getattr(self, 'api_' + path.replace('/', '_'))
+            body = method(coll, params)
+        finally:
+            server.lock.release()
+        self.send_response(200)
+        self.respond(body)
+
+    def result(self, code):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<result code=%s />\n' \
+                % quoteattr(code)
+
+    def posts(self, coll, posts, **attrib):
+        attrib['user'] = coll.user
+        return xml_document('posts', 'post', [dict([(k, p[k])
+            for k in POST_ATTRS if p.get(k) is not None]) for p in posts],
+            u''.join([u' %s=%s' % (k, quoteattr(v))
+                for k, v in sorted(attrib.items())]))
+
+    def api_tags_get(self, coll, params):
+        return xml_document('tags', 'tag', [{'tag': tag,
+            'count': unicode(count)} for tag, count in sorted(
+                coll.tags.items())])
+
+    def api_tags_delete(self, coll, params):
+        if not params.get('tag'):
+            return self.result('something went wrong')
+        for post in coll.tagged(params['tag']):
+            coll.add(dict(post, tag=u' '.join([t for t in post['tag'].split()
+                if t != params['tag']])))
+        return self.result('done')
+
+    def api_tags_rename(self, coll, params):
+        if not (params.get('old') and params.get('new')):
+            return self.result('something went wrong')
+        coll.rename_tag(params['old'], params['new'])
+        return self.result('done')
+
+    def api_posts_update(self, coll, params):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                '<update time="%s" />\n' % utctime(coll.update)
+
+    def api_posts_dates(self, coll, params):
+        tag = params.get('tag', u'')
+        dates = {}
+        for post in coll.tagged(tag):
+            dates[post['time'][:10]] = dates.get(post['time'][:10], 0) + 1
+        return xml_document('dates', 'date', [{'date': date,
+            'count': unicode(count)} for date, count in sorted(
+                dates.items(), reverse=True)],
+            u' tag=%s user=%s' % (quoteattr(tag), quoteattr(coll.user)))
+
+    def api_posts_get(self, coll, params):
+        tag = params.get('tag', u'')
+        if params.get('url'):
+            posts = [p for p in [coll.posts.get(params['url'])] if p]
+        elif params.get('hashes'):
+            hashes = params['hashes'].replace('+', ' ').split()
+            posts = [p for p in coll.ordered() if p['hash'] in hashes]
+        else:
+            posts = coll.tagged(tag)
+            dt = params.get('dt', posts and posts[0]['time'] or u'')[:10]
+            posts = [p for p in posts if p['time'].startswith(dt)]
+            return self.posts(coll, posts, tag=tag, dt=dt)
+        return self.posts(coll, posts, tag=tag)
+
+    def api_posts_recent(self, coll, params):
+        tag = params.get('tag', u'')
+        count = min(int(params.get('count') or 15), 100)
+        return self.posts(coll, coll.tagged(tag)[:count], tag=tag)
+
+    def api_posts_all(self, coll, params):
+        if params.get('hashes'):
+            return xml_document('posts', 'post', [{'url': p['hash'],
+                'meta': p['meta']} for p in coll.ordered()])
+        tag = params.get('tag', u'')
+        posts = coll.tagged(tag)
+        if params.get('fromdt'):
+            posts = [p for p in posts if p['time'] >= params['fromdt']]
+        if params.get('todt'):
+            posts = [p for p in posts if p['time'] <= params['todt']]
+        start = int(params.get('start') or 0)
+        if params.get('results'):
+            posts = posts[start:start+int(params['results'])]
+        else:
+            posts = posts[start:]
+        return self.posts(coll, posts, tag=tag, update=utctime(coll.update))
+
+    def api_posts_add(self, coll, params):
+        if not (params.get('url') and params.get('description')):
+            return self.result('something went wrong')
+        post = {'href': params['url'], 'description': params['description'],
+            'extended': params.get('extended', u''),
+            'tag': params.get('tags', u''),
+            'shared': params.get('shared', u'yes')}
+        if params.get('dt'):
+            post['time'] = params['dt']
+        if not coll.add(post, params.get('replace', u'yes') != u'no'):
+            return self.result('item already exists')
+        return self.result('done')
+
+    def api_posts_delete(self, coll, params):
+        if not coll.delete(params.get('url')):
+            return self.result('item not found')
+        return self.result('done')
+
+    def api_tags_bundles_all(self, coll, params):
+        return xml_document('bundles', 'bundle', [{'name': name,
+            'tags': tags} for name, tags in sorted(coll.bundles.items())])
+
+    def api_tags_bundles_set(self, coll, params):
+        if not (params.get('bundle') and params.get('tags')):
+            return self.result('something went wrong')
+        coll.bundles[params['bundle']] = params['tags']
+        coll._changed()
+        return self.result('ok')
+
+    def api_tags_bundles_delete(self, coll, params):
+        if coll.bundles.pop(params.get('bundle'), None) is None:
+            return self.result('bundle not found')
+        coll._changed()
+        return self.result('done')
+
+    ## v2 feeds
+
+    def feed(self, name, args, params):
+        server = self.server
+        count = min(int(params.get('count') or 15), 100)
+        server.lock.acquire()
+        try:
+            data = server.feed_data(name, args)
+        finally:
+            server.lock.release()
+        self.send_response(200)
+        if args['format'] == 'json':
+            if isinstance(data, list) and data and 'href' in data[0]:
+                data = [{'u': p['href'], 'd': p['description'],
+                    't': p['tag'].split(), 'dt': p['time'],
+                    'n': p['extended'], 'a': p['user']}
+                    for p in data[:count]]
+            self.respond(json.dumps(data), 'application/json')
+        else:
+            if not isinstance(data, list):
+                data = []
+            self.respond(self.rss(name, data[:count]))
+
+    def rss(self, title, posts):
+        items = []
+        for p in posts:
+            if 'href' not in p:
+                continue
+            items.append(u'<item><title>%s</title><pubDate>%s</pubDate>'
+                u'<link>%s</link><dc:creator>%s</dc:creator>'
+                u'<description>%s</description>%s</item>' % (
+                    escape(p['description']), time.strftime(
+                        '%a, %d %b %Y %H:%M:%S +0000', time.strptime(
+                            p['time'], '%Y-%m-%dT%H:%M:%SZ')),
+                    escape(p['href']), escape(p['user']),
+                    escape(p['extended']), u''.join([
+                        u'<category>%s</category>' % escape(t)
+                        for t in p['tag'].split()])))
+        return (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+            u'<rss version="2.0" '
+            u'xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            u'<channel><title>Delicious/%s</title>\n%s\n</channel></rss>\n'
+            % (escape(title), u'\n'.join(items))).encode('utf-8')
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+
+def feed_patterns(url_map=delicious_v2_feeds):
+    """Return (name, regex) for the feed URL templates, most specific first.
+    Private feeds are served as the public ones.
+    """
+    patterns = []
+    for name, template in url_map.items():
+        template = template.split('?')[0]
+        fields = re.findall(r'%\((\w+)\)s', template)
+        literal = re.sub(r'%\(\w+\)s', '', template)
+        regex = re.escape(template)
+        for field in fields:
+            value = {'format': '(json|rss)',
+                'urlmd5': '([0-9a-f]{32})'}.get(field, '([^/]+)')
+            regex = regex.replace(re.escape('%%(%s)s' % field),
+                    '(?P<%s>%s)' % (field, value[1:-1]), 1)
+        patterns.append(((len(fields), -len(literal), name), name,
+            re.compile(regex + '$')))
+    patterns.sort()
+    return [(name, regex) for key, name, regex in patterns]
+
+
+class MockAPIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """Serves the API and the feeds from collections in memory.
+
+    Some attributes:
+    :users: maps user to password
+    :collections: maps user to his ``MockCollection``
+    :latency: seconds to wait before answering a request
+    :rate: requests per second and user before requests are throttled with
+        a 503 response, or None
+    :error_rate: fraction of the API requests throttled at random
+    :retry_after: the Retry-After value of throttled requests
+    :compress: answer with gzip or deflate coded bodies if accepted
+    :requests: the number of requests per API path, 'feed', 'throttled'
+        and 'unauthorized'
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, users=None, latency=0, rate=None,
+            error_rate=0, retry_after=1, compress=True, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockAPIHandler)
+        self.users = users or {}
+        self.collections = {}
+        self.latency = latency
+        self.rate = rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.compress = compress
+        self.verbose = verbose
+        self.requests = {}
+        self.lock = threading.RLock()
+        self.feeds = feed_patterns()
+        self._last = {}
+        self._random = random.Random(0)
+        self._installed = None
+
+    @property
+    def host(self):
+        return '%s:%i' % self.server_address
+
+    def collection(self, user):
+        "Return the collection of a user, created on first use. "
+        self.lock.acquire()
+        try:
+            if user not in self.collections:
+                self.collections[user] = MockCollection(user)
+            return self.collections[user]
+        finally:
+            self.lock.release()
+
+    def seed(self, user, size, seed=0):
+        "Add `size` synthetic posts to the collection of `user`. "
+        self.collection(user).seed(size, seed)
+
+    def count(self, key):
+        self.lock.acquire()
+        try:
+            self.requests[key] = self.requests.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def throttled(self, user):
+        "Return True if the request of `user` should be answered with 503. "
+        self.lock.acquire()
+        try:
+            if self.error_rate and self._random.random() < self.error_rate:
+                return True
+            if self.rate:
+                now = time.time()
+                if now - self._last.get(user, 0) < 1.0 / self.rate:
+                    return True
+                self._last[user] = now
+            return False
+        finally:
+            self.lock.release()
+
+    def match_feed(self, path):
+        "Return the feed name and its URL fields for `path`, or None. "
+        for name, regex in self.feeds:
+            m = regex.match(path)
+            if m:
+                return name, dict([(k, v.decode('utf-8'))
+                    for k, v in m.groupdict().items()])
+
+    def feed_data(self, name, args):
+        "Return the posts of a feed, or other data. "
+        if name == 'user_tags':
+            return self.collection(args['username']).tags
+        if name == 'urlinfo':
+            posts = self.shared_posts(lambda p: p['hash'] == args['urlmd5'])
+            if not posts:
+                return []
+            tags = {}
+            for p in posts:
+                for tag in p['tag'].split():
+                    tags[tag] = tags.get(tag, 0) + 1
+            return [{'hash': args['urlmd5'], 'url': posts[0]['href'],
+                'title': posts[0]['description'], 'total_posts': len(posts),
+                'top_tags': tags}]
+        if name in ('user', 'user_private', 'user_tagged',
+                'user_tagged_private'):
+            coll = self.collection(args['username'])
+            private = name.endswith('_private')
+            return [p for p in coll.tagged(args.get('tag', u''))
+                if private or p['shared'] != u'no']
+        tags = args.get('tag', u'').replace(u'+', u' ').split()
+        if name in ('hotlist', 'recent', 'popular', 'tagged',
+                'popular_tagged'):
+            posts = self.shared_posts(lambda p: not [t for t in tags
+                if t not in p['tag'].split()])
+            if name.startswith('popular'):
+                posts.sort(key=lambda p: int(p['others']), reverse=True)
+            return posts
+        if name == 'url':
+            return self.shared_posts(lambda p: p['hash'] == args['urlmd5'])
+        # alerts, network, subscriptions, inbox and user info
+        return []
+
+    def shared_posts(self, match):
+        "Return the public posts of all users for which `match` is true. "
+        posts = []
+        for coll in self.collections.values():
+            posts.extend([p for p in coll.ordered()
+                if p['shared'] != u'no' and match(p)])
+        posts.sort(key=lambda p: p['time'], reverse=True)
+        return posts
+
+    def install(self):
+        "Point pydelicious at this server, until ``uninstall()``. "
+        self._installed = (pydelicious.DLCS_API, pydelicious.DLCS_API_HOST,
+                pydelicious.DLCS_FEEDS)
+        pydelicious.DLCS_API_HOST = self.host
+        pydelicious.DLCS_API = 'http://%s/%s' % (self.host, DLCS_API_PATH)
+        pydelicious.DLCS_FEEDS = 'http://%s/v2/' % self.host
+
+    def uninstall(self):
+        if self._installed:
+            pydelicious.DLCS_API, pydelicious.DLCS_API_HOST, \
+                    pydelicious.DLCS_FEEDS = self._installed
+            self._installed = None
+
+    def stop(self):
+        self.uninstall()
+        self.shutdown()
+        self.server_close()
+
+
+def serve_mock(users=None, host='127.0.0.1', port=0, **kwds):
+    """Start a ``MockAPIServer`` in a thread and return it. The server
+    listens on a free port by default.
+    """
+    server = MockAPIServer((host, port), users, **kwds)
+    # a short poll interval to stop quickly
+    t = threading.Thread(target=server.serve_forever, args=(.05,))
+    t.setDaemon(True)
+    t.start()
+    return server
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-H', '--host', default='127.0.0.1')
+    parser.add_option('-p', '--port', type='int', default=8080)
+    parser.add_option('-u', '--user', action='append', default=[],
+            help="user:password, may be repeated [test:test]")
+    parser.add_option('-n', '--posts', type='int', default=0,
+            help="seed every collection with this many posts")
+    parser.add_option('-l', '--latency', type='float', default=0,
+            help="seconds before every answer")
+    parser.add_option('-r', '--rate', type='float',
+            help="requests per second and user before throttling")
+    parser.add_option('-e', '--error-rate', type='float', default=0,
+            help="fraction of API requests throttled at random")
+    parser.add_option('-i', '--identity', action='store_true',
+            help="never compress the answers")
+    parser.add_option('-v', '--verbose', action='store_true',
+            help="log requests")
+    opts, args = parser.parse_args(argv[1:])
+
+    users = dict([u.split(':', 1) for u in opts.user or ['test:test']])
+    server = MockAPIServer((opts.host, opts.port), users, opts.latency,
+            opts.rate, opts.error_rate, compress=not opts.identity,
+            verbose=opts.verbose)
+    for i, user in enumerate(sorted(users)):
+        server.seed(user, opts.posts, seed=i)
+    print >>sys.stderr, "Serving %s at http://%s/%s/ and http://%s/v2/" % (
+        ', '.join(sorted(users)), server.host, DLCS_API_PATH, server.host)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,12 +2,28 @@
 """
 import sys, os
 import unittest
+import subprocess
 import urllib
 import urllib2
+import httplib
+import socket
 import pydelicious
 import time
+import threading
+import BaseHTTPServer
+import SocketServer
 from StringIO import StringIO
 
+import mockapi
+from mockapi import json
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+    from pydelicious import aio
+except ImportError:
+    aio = None
+
 test_data = {
     # old rss feeds
     'http://del.icio.us/rss/': 'var/rss.xml',
@@ -32,7 +48,7 @@ def fetch_file(url, fn):
     open(fn, 'w+').write(data)
     print "%s file %s for <%s>" % (acted, fn, url)
 
-def http_request_dummy(url, user_agent=None, retry=0, opener=None):
+def http_request_dummy(url, user_agent=None, retry=0, opener=None, **kwds):
     if url in test_data:
         fn = test_data[url]
         if not os.path.isfile(fn): 
@@ -45,6 +61,7 @@ def http_request_dummy(url, user_agent=None, retry=0, opener=None):
 # Turn of all HTTP fetching in pydelicious,
 # don't do http requests but return pre-def data
 # See blackbox tests if you want to test for real
+http_request = pydelicious.http_request
 pydelicious.http_request = http_request_dummy
 
 
@@ -74,32 +91,51 @@ class PyDeliciousTester(unittest.TestCase):
 class TestWaiter(PyDeliciousTester):
 
     def testwait1(self):
-        wt = pydelicious.DLCS_WAIT_TIME
+        wt = .2
+        waiter = pydelicious._Waiter(wt)
 
         # First call, no wait needed
         t = time.time()
-        pydelicious.Waiter()
+        waiter()
         waited = round(time.time() - t, 1)
         self.assert_(waited < wt,
                 "unneeded wait of %s" % (waited,))
 
         # Some values between full wait intervals
-        for w in .4, .7, 1.5:
+        for w in .04, .07, .15:
             time.sleep(w)
             t = time.time()
-            pydelicious.Waiter()
-            waited = round(time.time() - t, 1)
-            self.assert_(waited <= pydelicious.DLCS_WAIT_TIME,
-                    "unneeded wait of %s (not %s)" % (w,
-                        pydelicious.DLCS_WAIT_TIME-w))
+            waiter()
+            waited = round(time.time() - t, 2)
+            self.assert_(waited <= wt,
+                    "unneeded wait of %s (not %s)" % (waited, wt-w))
 
         # Some more regular intervals
         t = time.time()
         for i in range(0, 2):
-            pydelicious.Waiter()
+            waiter()
             waited = time.time() - t
             self.assert_(waited >= i*wt,
                     "needed wait of %s, not %s" % (i*wt, waited,))
+        self.assert_(waiter.waited)
+
+    def test_wait(self):
+        waiter = pydelicious._Waiter(.2)
+        waiter.backoff()
+        self.assertEqual(waiter.rate, 2.5)
+        waiter.wait = .1
+        self.assertEqual(waiter.wait, .1)
+        self.assertEqual((waiter.rate, waiter.max_rate), (10, 10))
+
+    def test_shared(self):
+        waiter = pydelicious.Waiter
+        self.assertEqual(waiter.wait, pydelicious.DLCS_WAIT_TIME)
+        tokens = waiter.burst + 1
+        # more than a burst has to wait, give the tokens back after
+        wait = waiter.reserve(tokens)
+        waiter.tokens += tokens
+        self.assert_(wait > 0)
+        self.assert_(wait <= pydelicious.DLCS_WAIT_TIME)
 
 
 class TestGetrss(PyDeliciousTester):
@@ -228,6 +264,1114 @@ class DeliciousApiUnitTest(PyDeliciousTester):
         self.assertEqual(a.request_raw('tags/bundles/set', bundle='bundle1', tags='tag1 tag2'), a.bundles_set('bundle1', 'tag1 tag2', _raw=True))
         self.assertEqual(a.request_raw('tags/bundles/delete', bundle='bundle1'), a.bundles_delete('bundle1', _raw=True))
 
+posts_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<posts tag="" user="testUser" update="2008-11-28T20:08:25Z">
+  <post href="http://example.org/1" hash="a1" meta="m1" description="One"
+    tag="foo bar" time="2008-11-28T20:08:25Z" extended="" />
+  <post href="http://example.org/2" hash="a2" meta="m2" description="Two"
+    tag="bar" time="2008-11-27T20:08:25Z" extended="Note" />
+</posts>
+"""
+
+class TestIterparse(PyDeliciousTester):
+
+    def test_iterparse_posts(self):
+        posts = list(pydelicious.dlcs_iterparse_posts(posts_xml))
+        self.assertEqual(posts,
+                pydelicious.dlcs_parse_xml(posts_xml)['posts'])
+
+    def test_iter_posts_all(self):
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+            api_request=lambda path, **kwds: StringIO(posts_xml))
+        posts = api.iter_posts_all()
+        self.assertEqual(posts.next()['href'], 'http://example.org/1')
+        self.assertEqual(posts.next()['extended'], 'Note')
+        self.assertRaises(StopIteration, posts.next)
+
+    def test_result(self):
+        posts = pydelicious.dlcs_iterparse_posts(
+                '<result code="something went wrong" />')
+        self.assertRaises(pydelicious.DeliciousError, list, posts)
+
+
+atom_xml = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Bookmarks</title>
+  <link rel="self" href="http://example.org/feed"/>
+  <entry>
+    <title>Example</title>
+    <link rel="alternate" href="http://example.org/1"/>
+    <id>tag:example.org,2008:1</id>
+    <updated>2008-11-28T20:09:20Z</updated>
+    <author><name>user</name></author>
+    <category term="foo"/><category term="bar"/>
+    <summary>Note</summary>
+  </entry>
+</feed>"""
+
+class TestFeedPosts(PyDeliciousTester):
+
+    def test_rss(self):
+        posts = pydelicious.dlcs_feed_posts(open('var/rss_popular.xml'))
+        self.assertEqual(len(posts), 15)
+        for fn in ('var/rss.xml', 'var/feed_v2.rss'):
+            posts = pydelicious.dlcs_feed_posts(open(fn))
+            self.assertEqual(len(posts), 15)
+            self.assertEqual(posts[0]['url'], 'http://drawminos.com/')
+            self.assertEqual(posts[0]['description'], 'DRAWMINOS')
+            self.assertEqual(posts[0]['tags'].split()[:3],
+                    ['games', 'flash', 'game'])
+        posts = pydelicious.dlcs_feed_posts(open('var/rss.xml'))
+        self.assertEqual(posts[0]['dt'], '2008-11-28T20:09:20Z')
+        posts = pydelicious.dlcs_feed_posts(open('var/feed_v2.rss'))
+        self.assertEqual(posts[0]['dt'], 'Fri, 28 Nov 2008 20:08:25 +0000')
+
+    def test_atom(self):
+        self.assertEqual(list(pydelicious.dlcs_iterparse_feed(atom_xml)), [
+            {'url': 'http://example.org/1', 'description': 'Example',
+                'tags': 'foo bar', 'dt': '2008-11-28T20:09:20Z',
+                'extended': 'Note', 'user': 'user'}])
+
+    def test_malformed(self):
+        feed = ('<rss version="2.0"><channel><item><title>Fish & Chips</title>'
+            '<link>http://example.org/</link></item></channel></rss>')
+        self.assertRaises(SyntaxError, list,
+                pydelicious.dlcs_iterparse_feed(feed))
+        if pydelicious.feedparser:
+            posts = pydelicious.dlcs_feed_posts(StringIO(feed))
+            self.assertEqual(posts[0]['url'], 'http://example.org/')
+        else:
+            self.assertRaises(pydelicious.PyDeliciousException,
+                    pydelicious.dlcs_feed_posts, StringIO(feed))
+
+    def test_json(self):
+        data = open('var/feed_v2.json').read()
+        class SlowFile:
+            "Returns a few bytes per read. "
+            def __init__(self, data):
+                self.fl = StringIO(data)
+            def read(self, size=-1):
+                return self.fl.read(7)
+        items = pydelicious.dlcs_iterparse_json(SlowFile(data))
+        self.assertEqual(list(items), json.loads(data))
+        self.assertEqual(list(pydelicious.dlcs_iterparse_json(
+            SlowFile('{"python": 12345, "web": 2}'))),
+            [('python', 12345), ('web', 2)])
+        self.assertEqual(list(pydelicious.dlcs_iterparse_json(' [ ] ')), [])
+        self.assertRaises(ValueError, list,
+                pydelicious.dlcs_iterparse_json('[1, 2'))
+        self.assertRaises(ValueError, list,
+                pydelicious.dlcs_iterparse_json('[1 2]'))
+
+        self.assertEqual(pydelicious.dlcs_json_record(json.loads(data)[0]),
+            {'href': 'http://drawminos.com/', 'description': 'DRAWMINOS',
+                'tag': 'games flash game fun dominos kids web funny cool '
+                'webgame', 'time': '2008-11-28T20:08:25Z'})
+        self.assertEqual(pydelicious.dlcs_json_record(('python', 3)),
+                {'tag': 'python', 'count': '3'})
+        self.assertEqual(pydelicious.dlcs_json_record(
+            {'user': 'other', 'dt': '2008-11-28T20:08:25Z'}),
+            {'user': 'other', 'time': '2008-11-28T20:08:25Z'})
+
+
+class TestRecords(PyDeliciousTester):
+
+    def test_posts(self):
+        rs = pydelicious.dlcs_parse_xml(posts_xml, compact=True)
+        plain = pydelicious.dlcs_parse_xml(posts_xml)
+        self.assertEqual(rs, plain)
+        posts = rs['posts']
+        self.assertEqual(posts[0]['tag'], 'foo bar')
+        post = posts[0]
+        self.assert_(isinstance(post, pydelicious.Post))
+        self.assertEqual(post.tags, ('foo', 'bar'))
+        # equal tag strings are shared between posts
+        self.assert_(post.tags[1] is posts[1].tags[0])
+        self.failIf('shared' in post)
+        self.assertEqual(post.get('shared', 'yes'), 'yes')
+        self.assertRaises(KeyError, lambda: post['shared'])
+        post['tag'] = 'baz'
+        self.assertEqual(post.tags, ('baz',))
+        post['unknown'] = 'x'
+        self.assertEqual(dict(post)['unknown'], 'x')
+        del post['unknown']
+        self.failIf('unknown' in post.keys())
+
+    def test_pickle(self):
+        import pickle
+        post = pydelicious.dlcs_parse_xml(posts_xml, compact=True)['posts'][1]
+        for proto in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(post, proto))
+            self.assertEqual(copy, post)
+            self.assertEqual(copy.tags, ('bar',))
+
+    def test_tags(self):
+        tags = pydelicious.dlcs_parse_xml('<tags><tag tag="foo" count="2" />'
+            '</tags>', compact=True)['tags']
+        self.assertEqual(tags, [{'tag': 'foo', 'count': '2'}])
+        self.assert_(isinstance(tags[0], pydelicious.Tag))
+
+    def test_iterparse(self):
+        posts = list(pydelicious.dlcs_iterparse_posts(posts_xml, compact=True))
+        self.assertEqual([p.tags for p in posts], [('foo', 'bar'), ('bar',)])
+
+
+class TestBulk(PyDeliciousTester):
+
+    def setUp(self):
+        import tempfile
+        fd, self.journal = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.journal)
+        self.calls = []
+        self.answers = {}
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+            api_request=self.api_request)
+
+    def tearDown(self):
+        if os.path.exists(self.journal):
+            os.unlink(self.journal)
+
+    def api_request(self, path, params=None, opener=None):
+        self.calls.append((path, params['url']))
+        answer = self.answers.get(params['url'], 'done')
+        if isinstance(answer, list):
+            answer = answer.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return StringIO('<result code="%s" />' % answer)
+
+    def test_bulk(self):
+        ops = [('add', {'url': 'http://a/', 'description': 'A'}),
+            ('replace', {'url': 'http://b/', 'description': 'B'}),
+            ('delete', {'url': 'http://a/'})]
+        results = list(self.api.posts_bulk(ops))
+        self.assertEqual(results, [('http://a/', 'delete', 'done'),
+            ('http://b/', 'replace', 'done')])
+        self.assertEqual(self.calls, [('posts/delete', 'http://a/'),
+            ('posts/add', 'http://b/')])
+        self.assertRaises(pydelicious.PyDeliciousException, list,
+                self.api.posts_bulk([('edit', {'url': 'http://a/'})]))
+
+    def test_errors(self):
+        self.answers['http://a/'] = [pydelicious.PyDeliciousThrottled(),
+            'done']
+        self.answers['http://b/'] = 'item already exists'
+        results = dict([(url, status) for url, action, status in
+            self.api.posts_bulk([
+                ('add', {'url': 'http://a/', 'description': 'A'}),
+                ('add', {'url': 'http://b/', 'description': 'B'})],
+                retries=1)])
+        self.assertEqual(results['http://a/'], 'done')
+        self.assert_(isinstance(results['http://b/'],
+            pydelicious.DeliciousItemExistsError))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_journal(self):
+        ops = [('delete', {'url': 'http://%i/' % i}) for i in range(4)]
+        self.answers['http://3/'] = 'something went wrong'
+        bulk = self.api.posts_bulk(ops, journal=self.journal)
+        bulk.next(); bulk.next()
+        bulk.close()
+        self.assertEqual(len(open(self.journal).readlines()), 3)
+
+        # resume, the failed operation keeps the journal
+        self.calls = []
+        results = list(self.api.posts_bulk(ops, journal=self.journal))
+        self.assertEqual([status for url, action, status in results][:3],
+                ['journal', 'journal', 'done'])
+        self.assertEqual(len(self.calls), 2)
+        self.assert_(os.path.exists(self.journal))
+
+        # only the failed operation is retried, then the journal is removed
+        self.calls = []
+        del self.answers['http://3/']
+        list(self.api.posts_bulk(ops, journal=self.journal))
+        self.assertEqual(self.calls, [('posts/delete', 'http://3/')])
+        self.failIf(os.path.exists(self.journal))
+
+    def test_stale_journal(self):
+        ops = [('delete', {'url': 'http://%i/' % i}) for i in range(2)]
+        self.answers['http://1/'] = 'something went wrong'
+        list(self.api.posts_bulk(ops, journal=self.journal))
+        self.assert_(os.path.exists(self.journal))
+
+        # a later run with other operations does not skip http://0/
+        self.calls = []
+        del self.answers['http://1/']
+        results = list(self.api.posts_bulk(ops[:1], journal=self.journal))
+        self.assertEqual(results, [('http://0/', 'delete', 'done')])
+        self.assertEqual(self.calls, [('posts/delete', 'http://0/')])
+        self.failIf(os.path.exists(self.journal))
+
+
+class TestMemoize(PyDeliciousTester):
+
+    def setUp(self):
+        self.calls = []
+        self.update = '2008-11-28T20:08:25Z'
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+            api_request=self.api_request, memoize=2)
+
+    def api_request(self, path, params=None, opener=None):
+        self.calls.append(path)
+        if path == 'posts/update':
+            return StringIO('<update time="%s" />' % self.update)
+        elif path == 'tags/get':
+            return StringIO('<tags><tag tag="foo" count="2" /></tags>')
+        elif path == 'posts/all':
+            return StringIO(posts_xml)
+        return StringIO('<result code="done" />')
+
+    def test_memoize(self):
+        tags = self.api.tags_get()
+        self.assert_(self.api.tags_get() is tags)
+        self.assertEqual(self.calls, ['tags/get'])
+        self.api.posts_all(tag='foo')
+        self.api.posts_all(tag='foo')
+        self.api.posts_all(tag='bar')
+        self.assertEqual(self.calls.count('posts/all'), 2)
+        # LRU
+        self.failIf(self.api.tags_get() is tags)
+
+    def test_invalidate(self):
+        # the first update time drops all results memoized before it
+        self.api.posts_update()
+        self.api.tags_get()
+        self.api.posts_add('http://example.org/', 'Example')
+        self.api.tags_get()
+        self.assertEqual(self.calls.count('tags/get'), 2)
+
+        self.api.posts_update()
+        self.api.tags_get()
+        self.assertEqual(self.calls.count('tags/get'), 2)
+        self.update = '2008-11-29T20:08:25Z'
+        self.api.posts_update()
+        self.api.tags_get()
+        self.assertEqual(self.calls.count('tags/get'), 3)
+
+    def test_check(self):
+        self.api.memoize_check = 0
+        self.api.tags_get()
+        time.sleep(.01)
+        self.api.tags_get()
+        # expired results are requested again, without posts/update
+        self.assertEqual(self.calls, ['tags/get', 'tags/get'])
+
+    def test_lru(self):
+        cache = pydelicious.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.failIf('b' in cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+
+
+class LocalHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answers every GET with a small XML document over HTTP/1.1.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = 1
+    body = '<result code="done" />'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve_local(handler_class=LocalHTTPRequestHandler):
+    "Start a HTTP server on a free localhost port, return server instance. "
+    server = LocalHTTPServer(('127.0.0.1', 0), handler_class)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+
+class TestKeepAlive(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = serve_local()
+        self.host = '127.0.0.1:%i' % self.server.server_port
+        self.url = 'http://%s/v1/posts/update' % self.host
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        o = pydelicious.build_api_opener(self.host, 'testUser', 'testPwd')
+        for i in range(3):
+            self.assertEqual(o.open(self.url).read(),
+                    LocalHTTPRequestHandler.body)
+        stats = o.keepalive.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['idle'], 1)
+        o.keepalive.close()
+        self.assertEqual(o.keepalive.stats()['idle'], 0)
+
+    def test_abandoned_response(self):
+        o = pydelicious.build_api_opener(self.host, 'testUser', 'testPwd')
+        fl = o.open(self.url)
+        fl.read(4)
+        fl.close()
+        self.assertEqual(o.keepalive.stats()['idle'], 0)
+        o.open(self.url).read()
+        self.assertEqual(o.keepalive.stats()['created'], 2)
+
+    def test_idle_timeout(self):
+        o = pydelicious.build_api_opener(
+                self.host, 'testUser', 'testPwd')
+        o.keepalive.pool.timeout = 0
+        o.open(self.url).read()
+        o.open(self.url).read()
+        stats = o.keepalive.stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['reused'], 0)
+
+    def test_disabled(self):
+        o = pydelicious.build_api_opener(self.host, 'testUser', 'testPwd',
+                keepalive=False)
+        self.assertEqual(o.keepalive, None)
+        self.assertEqual(o.open(self.url).read(),
+                LocalHTTPRequestHandler.body)
+
+
+class ThrottlingHTTPRequestHandler(LocalHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(503)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class SlowHTTPRequestHandler(LocalHTTPRequestHandler):
+
+    """Answers with the request path after a short delay, and keeps track of
+    the number of concurrent requests.
+    """
+
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def do_GET(self):
+        klass = SlowHTTPRequestHandler
+        klass.lock.acquire()
+        klass.active += 1
+        klass.max_active = max(klass.max_active, klass.active)
+        klass.lock.release()
+        time.sleep(.05)
+        klass.lock.acquire()
+        klass.active -= 1
+        klass.lock.release()
+        if self.path.endswith('/error'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.body = self.path
+        LocalHTTPRequestHandler.do_GET(self)
+
+
+class TestFeedFetcher(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = serve_local(SlowHTTPRequestHandler)
+        self.base = 'http://127.0.0.1:%i/' % self.server.server_port
+        pydelicious.http_request = http_request
+
+    def tearDown(self):
+        pydelicious.http_request = http_request_dummy
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        fetcher = pydelicious.FeedFetcher(threads=6, host_connections=3,
+                host_rate=1000)
+        feeds = [self.base + 'feed/%i' % i for i in range(12)]
+        feeds.append(('tagged', {'tag': 'python'}))
+        feeds_base = pydelicious.DLCS_FEEDS
+        pydelicious.DLCS_FEEDS = self.base
+        t = time.time()
+        try:
+            results = list(fetcher.fetch(feeds))
+        finally:
+            pydelicious.DLCS_FEEDS = feeds_base
+            fetcher.close()
+        self.assertEqual(len(results), 13)
+        self.assertEqual(sorted([result for feed, result, error in results]),
+                sorted(['/feed/%i' % i for i in range(12)] +
+                    ['/json/tag/python']))
+        self.assert_(SlowHTTPRequestHandler.max_active <= 3)
+        # 13 requests of 50ms, 3 at a time
+        self.assert_(time.time() - t < 13 * .05)
+
+    def test_errors(self):
+        fetcher = pydelicious.FeedFetcher(threads=2)
+        results = list(fetcher.fetch([self.base + 'error',
+            self.base + 'ok']))
+        fetcher.close()
+        errors = dict([(feed, error) for feed, result, error in results])
+        self.assert_(isinstance(errors[self.base + 'error'],
+            pydelicious.PyDeliciousException))
+        self.assertEqual(errors[self.base + 'ok'], None)
+
+
+    def test_retry(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        host = '127.0.0.1:%i' % sock.getsockname()[1]
+        url = 'http://%s/' % host
+        sock.close()
+        fetcher = pydelicious.FeedFetcher(threads=1, host_connections=3,
+                host_rate=1)
+        fetcher.opener.retry_policy = pydelicious.RetryPolicy(connect=2,
+                base=.01)
+        results = list(fetcher.fetch([url]))
+        fetcher.close()
+        self.assert_(isinstance(results[0][2],
+            pydelicious.PyDeliciousException))
+        # the request and both retries took a token of the host
+        self.assert_(fetcher._host(host)[1].tokens < 1)
+
+
+class APIHTTPRequestHandler(LocalHTTPRequestHandler):
+
+    """Answers API paths with the documents in `answers`, and with a done
+    result otherwise.
+    """
+
+    answers = {
+        '/v1/tags/get': '<tags><tag tag="foo" count="2" /></tags>',
+        '/v1/posts/all': posts_xml,
+        '/v1/posts/delete': '<result code="item not found" />',
+    }
+
+    def do_GET(self):
+        if self.path.endswith('/throttled'):
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.body = self.answers.get(self.path.split('?')[0],
+                LocalHTTPRequestHandler.body)
+        LocalHTTPRequestHandler.do_GET(self)
+
+
+class TestAsyncAPI(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = serve_local(APIHTTPRequestHandler)
+        self.api_url = pydelicious.DLCS_API
+        pydelicious.DLCS_API = 'http://127.0.0.1:%i/v1' % \
+                self.server.server_port
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.api = aio.AsyncDeliciousAPI('testUser', 'testPwd',
+                rate_limiter=pydelicious.TokenBucket(50, burst=5))
+
+    def tearDown(self):
+        self.api.close()
+        # let the transports close
+        self.run_async(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        pydelicious.DLCS_API = self.api_url
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_memoize(self):
+        api = aio.AsyncDeliciousAPI('testUser', 'testPwd', memoize=2)
+        try:
+            tags = self.run_async(api.tags_get())
+            self.assert_(self.run_async(api.tags_get()) is tags)
+            self.run_async(api.posts_add('http://example.org/', 'Example'))
+            self.failIf(self.run_async(api.tags_get()) is tags)
+            self.assertEqual((api.memo.hits, api.memo.misses), (1, 2))
+        finally:
+            api.close()
+
+    def test_methods(self):
+        tags = self.run_async(self.api.tags_get())
+        self.assertEqual(tags, {'tags': [{'tag': 'foo', 'count': '2'}]})
+        self.assertEqual(self.run_async(self.api.posts_add(
+            'http://example.org/', 'Example')), None)
+        self.assertRaises(pydelicious.DeliciousError, self.run_async,
+                self.api.posts_delete('http://example.org/'))
+        posts = self.run_async(self.api.iter_posts_all())
+        self.assertEqual([p['hash'] for p in posts], ['a1', 'a2'])
+        self.assertEqual(self.api._opener.stats()['created'], 1)
+
+    def test_bulk(self):
+        import tempfile
+        fd, journal = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(journal)
+        ops = [('add', {'url': 'http://example.org/', 'description': 'A'}),
+            ('delete', {'url': 'http://example.org/2'})]
+        try:
+            results = self.run_async(self.api.posts_bulk(ops,
+                journal=journal, retries=0))
+            self.assertEqual([r[:2] for r in results], [
+                ('http://example.org/', 'add'),
+                ('http://example.org/2', 'delete')])
+            self.assertEqual(results[0][2], 'done')
+            self.assert_(isinstance(results[1][2], pydelicious.DeliciousError))
+
+            # the failed delete kept the journal
+            results = self.run_async(self.api.posts_bulk(ops,
+                journal=journal, retries=0))
+            self.assertEqual(results[0][2], 'journal')
+        finally:
+            if os.path.exists(journal):
+                os.unlink(journal)
+
+    def test_pages(self):
+        server = mockapi.serve_mock({'testUser': 'testPwd'})
+        server.install()
+        server.seed('testUser', 250)
+        server.latency = .2
+
+        @asyncio.coroutine
+        def read(pages):
+            sizes = []
+            while True:
+                page = yield From(pages.next())
+                if page is None:
+                    raise Return(sizes)
+                sizes.append(len(page))
+                yield From(asyncio.sleep(.3))
+
+        try:
+            pages = self.api.posts_pages(results=100)
+            t = time.time()
+            self.assertEqual(self.run_async(read(pages)), [100, 100, 50])
+            # requests overlap the processing of the previous page, in
+            # sequence this would take 1.5 seconds
+            self.assert_(time.time() - t < 1.35, time.time() - t)
+            self.assertEqual((pages.start, pages.pages, pages.requests),
+                    (250, 3, 3))
+            self.assertEqual(pages.attrs['user'], 'testUser')
+            server.latency = 0
+            self.assertEqual(self.run_async(read(
+                self.api.posts_pages(start=250, prefetch=False))), [])
+        finally:
+            server.stop()
+
+    def test_concurrent(self):
+        t = time.time()
+        results = self.run_async(asyncio.gather(*[self.api.posts_update()
+            for i in range(5)] + [self.api.tags_get() for i in range(5)]))
+        self.assertEqual(len(results), 10)
+        # 5 requests in a burst, then 5 at 50 per second
+        self.assert_(time.time() - t >= .08)
+        self.assert_(self.api._opener.stats()['idle'] <= 2)
+
+    def test_throttled(self):
+        rate_limiter = self.api._opener.rate_limiter
+        self.assertRaises(pydelicious.PyDeliciousThrottled, self.run_async,
+                self.api.request('throttled'))
+        self.assertEqual(rate_limiter.backoffs, 1)
+        self.api._opener.rate_limiter = lambda: 0
+        self.assertRaises(pydelicious.PyDeliciousThrottled, self.run_async,
+                self.api.request('throttled'))
+
+    def test_retry(self):
+        self.api._opener.retry_policy = pydelicious.RetryPolicy(throttled=2,
+                base=.01, jitter=0)
+        rate_limiter = self.api._opener.rate_limiter
+        self.assertRaises(pydelicious.PyDeliciousThrottled, self.run_async,
+                self.api.request('throttled'))
+        self.assertEqual(rate_limiter.backoffs, 3)
+
+
+class TestMockAPI(PyDeliciousTester):
+
+    """DeliciousAPI and the feeds against the local mock server.
+    """
+
+    def setUp(self):
+        self.server = mockapi.serve_mock({'testUser': 'testPwd'})
+        self.server.install()
+        pydelicious.http_request = http_request
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100))
+
+    def tearDown(self):
+        self.api._opener.keepalive.close()
+        pydelicious.http_request = http_request_dummy
+        self.server.stop()
+
+    def test_posts(self):
+        api = self.api
+        api.posts_add('http://example.org/', 'Example', tags='foo bar',
+                dt='2009-01-02T03:04:05Z')
+        api.posts_add('http://example.org/2', u'Caf\xe9', tags='foo')
+        self.assertRaises(pydelicious.DeliciousItemExistsError,
+                api.posts_add, 'http://example.org/', 'Again', replace=False)
+        posts = api.posts_all()['posts']
+        self.assertEqual([p['href'] for p in posts],
+                ['http://example.org/2', 'http://example.org/'])
+        self.assertEqual(posts[0]['description'], u'Caf\xe9')
+        self.assertEqual(api.posts_get(url='http://example.org/')['posts'][0]
+                ['tag'], 'foo bar')
+        self.assertEqual(len(api.posts_recent(tag='bar')['posts']), 1)
+        self.assertEqual(api.posts_dates(tag='bar')['dates'],
+                [{'date': '2009-01-02', 'count': '1'}])
+        self.assertEqual(api.tags_get()['tags'], [
+            {'tag': 'bar', 'count': '1'}, {'tag': 'foo', 'count': '2'}])
+        api.tags_rename('foo', 'baz')
+        self.assertEqual(len(api.posts_all(tag='baz')['posts']), 2)
+        api.posts_delete('http://example.org/')
+        self.assertRaises(pydelicious.DeliciousError, api.posts_delete,
+                'http://example.org/')
+        self.assertEqual(len(api.posts_all()['posts']), 1)
+        manifest = api.posts_all(hashes=True)['posts']
+        self.assertEqual(manifest[0]['url'],
+                pydelicious.md5('http://example.org/2').hexdigest())
+
+    def test_bundles(self):
+        self.api.bundles_set('b', ['foo', 'bar'])
+        self.assertEqual(self.api.bundles_all()['bundles'],
+                [{'name': 'b', 'tags': 'foo bar'}])
+        self.api.bundles_delete('b')
+        self.assertEqual(self.api.bundles_all()['bundles'], [])
+
+    def test_seeded(self):
+        self.server.seed('testUser', 500)
+        posts = list(self.api.iter_posts_all())
+        self.assertEqual(len(posts), 500)
+        page = self.api.posts_all(start=490, results=20)['posts']
+        self.assertEqual([p['hash'] for p in page],
+                [p['hash'] for p in posts[490:]])
+
+    def test_unauthorized(self):
+        api = pydelicious.DeliciousAPI('testUser', 'wrong')
+        self.assertRaises(pydelicious.PyDeliciousUnauthorized,
+                api.posts_update)
+        api._opener.keepalive.close()
+
+    def test_throttled(self):
+        self.server.rate = 1
+        rate_limiter = self.api._opener.rate_limiter
+        self.api.posts_update()
+        self.assertRaises(pydelicious.PyDeliciousThrottled,
+                self.api.posts_update)
+        self.assertEqual(rate_limiter.backoffs, 1)
+        self.assertEqual(self.server.requests['throttled'], 1)
+
+    def test_throttled_callable(self):
+        # plain callables as rate limiter have no backoff
+        self.server.error_rate = 1
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                rate_limiter=lambda: 0)
+        self.assertRaises(pydelicious.PyDeliciousThrottled, api.posts_update)
+        api._opener.keepalive.close()
+
+    def test_latency(self):
+        self.server.latency = .1
+        t = time.time()
+        self.api.posts_update()
+        self.assert_(time.time() - t >= .1)
+
+    def test_feeds(self):
+        self.server.collection('other').add({'href': u'http://example.org/',
+            'description': u'Example', 'tag': u'foo bar'})
+        posts = json.loads(pydelicious.dlcs_feed('user', username='other'))
+        self.assertEqual(posts[0]['u'], 'http://example.org/')
+        self.assertEqual(posts[0]['t'], ['foo', 'bar'])
+        self.assertEqual(len(json.loads(pydelicious.dlcs_feed('tagged',
+            tag='foo'))), 1)
+        self.assertEqual(json.loads(pydelicious.dlcs_feed('tagged', tag='baz')),
+                [])
+        rss = pydelicious.dlcs_feed('recent', format='rss')
+        if not pydelicious.feedparser:
+            self.assertContains(rss, '<category>bar</category>')
+        posts = pydelicious.dlcs_feed('recent', format='rss', posts=True)
+        self.assertEqual(posts[0]['url'], 'http://example.org/')
+        self.assertEqual(posts[0]['tags'], 'foo bar')
+        posts = pydelicious.dlcs_feed('user', username='other', posts=True)
+        self.assertEqual((posts[0]['href'], posts[0]['tag']),
+                ('http://example.org/', 'foo bar'))
+        posts = pydelicious.dlcs_iter_feed('user', username='other')
+        self.assertEqual(posts.next()['description'], 'Example')
+        self.assertRaises(StopIteration, posts.next)
+        tags = pydelicious.dlcs_feed('user_tags', username='other',
+                posts=True)
+        self.assertEqual(sorted([t['tag'] for t in tags]), ['bar', 'foo'])
+
+
+class TestPostsPages(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = mockapi.serve_mock({'testUser': 'testPwd'})
+        self.server.install()
+        self.server.seed('testUser', 250)
+        pydelicious.http_request = http_request
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100))
+
+    def tearDown(self):
+        self.api._opener.keepalive.close()
+        pydelicious.http_request = http_request_dummy
+        self.server.stop()
+
+    def test_pages(self):
+        pages = self.api.posts_pages(results=100)
+        sizes = [len(page) for page in pages]
+        self.assertEqual(sizes, [100, 100, 50])
+        self.assertEqual((pages.start, pages.pages, pages.requests),
+                (250, 3, 3))
+        self.assertEqual(pages.attrs['user'], 'testUser')
+        posts = self.api.posts_all()['posts']
+        self.assertEqual([p['href'] for page in
+            self.api.posts_pages(results=50, prefetch=False) for p in page],
+            [p['href'] for p in posts])
+        self.assertEqual(list(self.api.posts_pages(start=250)), [])
+
+    def test_prefetch(self):
+        self.server.latency = .1
+        t = time.time()
+        for page in self.api.posts_pages(results=100):
+            time.sleep(.3)
+        # each request waits twice for the latency, with authentication
+        # three requests in sequence would take 1.5 seconds
+        self.assert_(time.time() - t < 1.35, time.time() - t)
+
+    def test_resume(self):
+        pages = self.api.posts_pages(results=100, prefetch=False)
+        pages.next()
+        self.server.error_rate = 1
+        self.assertRaises(pydelicious.PyDeliciousThrottled, pages.next)
+        self.assertEqual(pages.start, 100)
+        self.server.error_rate = 0
+        self.assertEqual(len(pages.next()), 100)
+        resumed = self.api.posts_pages(start=pages.start, results=100)
+        self.assertEqual([len(page) for page in resumed], [50])
+
+
+class TestMetrics(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = mockapi.serve_mock({'testUser': 'testPwd'})
+        self.server.install()
+        pydelicious.http_request = http_request
+        self.metrics = pydelicious.RequestMetrics()
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100),
+                metrics=self.metrics)
+
+    def tearDown(self):
+        self.api._opener.keepalive.close()
+        pydelicious.http_request = http_request_dummy
+        self.server.stop()
+
+    def test_histogram(self):
+        h = pydelicious.Histogram()
+        for v in (.0005, .003, .003, .1, 100):
+            h.add(v)
+        self.assertEqual((h.count, h.min, h.max), (5, .0005, 100))
+        self.assertEqual(h.percentile(20), .001)
+        self.assertEqual(h.percentile(50), .004)
+        self.assertEqual(h.percentile(100), 100)
+        self.assertEqual(h.snapshot()['buckets'],
+                [(.001, 1), (.004, 2), (.128, 1), (None, 1)])
+        self.assertEqual(pydelicious.Histogram().percentile(50), None)
+
+    def test_api(self):
+        calls = []
+        self.api.before_request.append(lambda path, params:
+                calls.append(path))
+        self.server.seed('testUser', 50)
+        self.server.latency = .02
+        self.api.posts_all()
+        self.api.posts_all()
+        self.api.posts_add('http://example.org/', 'Example')
+        self.server.error_rate = 1
+        self.assertRaises(pydelicious.PyDeliciousThrottled,
+                self.api.posts_update)
+        self.assertEqual(calls, ['posts/all', 'posts/all', 'posts/add',
+            'posts/update'])
+
+        snapshot = self.metrics.snapshot()
+        posts = snapshot['posts/all']
+        self.assertEqual(posts['count'], 2)
+        self.assert_(posts['bytes'] > 50 * 100)
+        self.assert_(posts['network']['min'] >= .02)
+        self.assertEqual(posts['parse']['count'], 2)
+        self.assert_(posts['total']['min'] >= posts['network']['min'])
+        self.assertEqual(snapshot['posts/update']['errors'],
+                {'PyDeliciousThrottled': 1})
+        self.assertContains(self.metrics.report(), 'posts/add')
+        self.metrics.reset()
+        self.assertEqual(self.metrics.snapshot(), {})
+
+    def test_streamed(self):
+        # the parser reads the response as it arrives, not from a buffer
+        files = []
+        def parser(fl):
+            files.append(fl)
+            return pydelicious.dlcs_parse_xml(fl)
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                xml_parser=parser, metrics=self.metrics,
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100))
+        self.server.seed('testUser', 10)
+        self.assertEqual(len(api.posts_all()['posts']), 10)
+        api._opener.keepalive.close()
+        self.failIf(isinstance(files[0], StringIO))
+        self.assertEqual(self.metrics.snapshot()['posts/all']['bytes'],
+                files[0].bytes)
+
+    def test_http_request_hooks(self):
+        recorded = []
+        pydelicious.http_request_hooks.append(lambda url, stats:
+                recorded.append((url, stats)))
+        try:
+            pydelicious.dlcs_feed('recent')
+            self.assertRaises(pydelicious.PyDeliciousException,
+                    pydelicious.dlcs_feed, pydelicious.DLCS_FEEDS + 'none')
+        finally:
+            del pydelicious.http_request_hooks[:]
+        self.assertEqual(recorded[0][1]['error'], None)
+        self.assertEqual(recorded[1][1]['error'], 'HTTPError')
+        self.assert_(recorded[1][1]['network'] > 0)
+
+
+class TestDecoding(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = mockapi.serve_mock({'testUser': 'testPwd'})
+        self.server.install()
+        self.server.seed('testUser', 200)
+        pydelicious.http_request = http_request
+        self.metrics = pydelicious.RequestMetrics()
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100),
+                metrics=self.metrics)
+
+    def tearDown(self):
+        self.api._opener.keepalive.close()
+        pydelicious.http_request = http_request_dummy
+        self.server.stop()
+
+    def test_decode_body(self):
+        import zlib, gzip
+        body = ''.join(["line %i\n" % i for i in range(5000)])
+        gz = StringIO()
+        fl = gzip.GzipFile(fileobj=gz, mode='wb')
+        fl.write(body)
+        fl.close()
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        codings = [('gzip', gz.getvalue()), ('deflate', zlib.compress(body)),
+            ('deflate', raw.compress(body) + raw.flush())]
+        for coding, data in codings:
+            headers = httplib.HTTPMessage(StringIO(
+                "Content-Encoding: %s\r\nContent-Length: %i\r\n\r\n" % (
+                    coding, len(data))))
+            fl = pydelicious.decode_body(StringIO(data), headers)
+            self.assertEqual(headers.items(), [])
+            self.assertEqual(fl.readline(), "line 0\n")
+            self.assertEqual(fl.read(7), "line 1\n")
+            self.assertEqual(fl.read(), body[14:])
+            self.assertEqual(fl.read(), '')
+            self.assertEqual((fl.wire_bytes, fl.bytes),
+                    (len(data), len(body)))
+        headers = httplib.HTTPMessage(StringIO("Content-Length: 4\r\n\r\n"))
+        fl = StringIO('body')
+        self.assert_(pydelicious.decode_body(fl, headers) is fl)
+        self.assertEqual(pydelicious.wire_bytes(fl, 4), 4)
+
+    def test_api(self):
+        posts = self.api.posts_all()['posts']
+        self.assertEqual(len(posts), 200)
+        self.assertEqual(len(list(self.api.iter_posts_all())), 200)
+        fl = self.api.request_raw('posts/all')
+        self.assertEqual(fl.info().get('content-encoding'), None)
+        fl.read()
+        self.assert_(0 < pydelicious.wire_bytes(fl) < fl.fp.bytes)
+
+        m = self.metrics.snapshot()['posts/all']
+        self.assert_(0 < m['wire_bytes'] < m['bytes'] / 2)
+        self.server.compress = False
+        self.metrics.reset()
+        self.assertEqual(len(self.api.posts_all()['posts']), 200)
+        m = self.metrics.snapshot()['posts/all']
+        self.assertEqual(m['wire_bytes'], m['bytes'])
+
+    def test_feed(self):
+        feed = pydelicious.dlcs_feed('user', username='testUser')
+        fl = pydelicious.http_request(pydelicious.dlcs_feed_url('user',
+            username='testUser'))
+        self.assertEqual(fl.read(), feed)
+        self.assert_(0 < pydelicious.wire_bytes(fl) < len(feed))
+        self.server.compress = False
+        self.assertEqual(pydelicious.dlcs_feed('user', username='testUser'),
+                feed)
+
+
+class TestRetryPolicy(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = mockapi.serve_mock({'testUser': 'testPwd'},
+                retry_after=0)
+        self.server.install()
+        pydelicious.http_request = http_request
+        self.opener = pydelicious.build_api_opener(self.server.host,
+                'testUser', 'testPwd',
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100))
+        self.stats = []
+        pydelicious.http_request_hooks.append(lambda url, stats:
+                self.stats.append(stats))
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        del pydelicious.http_request_hooks[:]
+        self.opener.keepalive.close()
+        pydelicious.http_request = http_request_dummy
+        self.server.stop()
+
+    def test_delay(self):
+        policy = pydelicious.RetryPolicy(connect=2, timeout=0, throttled=1, base=1,
+                max_delay=3, jitter=0, deadline=10)
+        self.assertEqual(policy.delay('connect', {'connect': 1}, 0), 1)
+        self.assertEqual(policy.delay('connect', {'connect': 2}, 0), 2)
+        self.assertEqual(policy.delay('connect', {'connect': 3}, 0), None)
+        self.assertEqual(policy.delay('throttled',
+            {'connect': 2, 'throttled': 1}, 0), 3)
+        self.assertEqual(policy.delay('throttled', {'throttled': 1}, 0, 5),
+                5)
+        self.assertEqual(policy.delay('timeout', {'timeout': 1}, 0), None)
+        self.assertEqual(policy.delay('connect', {'connect': 1}, 9.5), None)
+        self.assertEqual(policy.timeout(9.5), .5)
+        policy.jitter = .5
+        for i in range(20):
+            delay = policy.delay('connect', {'connect': 2}, 0)
+            self.assert_(1 <= delay <= 2)
+
+    def test_classify(self):
+        policy = pydelicious.DefaultRetryPolicy
+        for error, kind in [
+                (socket.timeout(), 'timeout'),
+                (urllib2.URLError(socket.timeout()), 'timeout'),
+                (urllib2.URLError(socket.error(111, 'refused')), 'connect'),
+                (httplib.BadStatusLine(''), 'connect'),
+                (pydelicious.PyDeliciousThrottled(), 'throttled'),
+                (urllib2.HTTPError('', 503, '', {}, None), 'throttled'),
+                (urllib2.HTTPError('', 404, '', {}, None), None),
+                (pydelicious.PyDeliciousUnauthorized(), None)]:
+            self.assertEqual(policy.classify(error), kind)
+
+    def test_throttled(self):
+        self.opener.retry_policy = pydelicious.RetryPolicy(throttled=3,
+                base=.11, jitter=0)
+        self.server.rate = 10
+        pydelicious.dlcs_api_request('posts/update', opener=self.opener)
+        pydelicious.dlcs_api_request('posts/update', opener=self.opener)
+        self.assertEqual(self.server.requests['throttled'], 1)
+        self.assertEqual([s['retries'] for s in self.stats], [0, 1])
+
+        self.server.error_rate = 1
+        self.assertRaises(pydelicious.PyDeliciousThrottled,
+                pydelicious.dlcs_api_request, 'posts/update',
+                opener=self.opener)
+        self.assertEqual(self.stats[-1]['retries'], 3)
+        self.assertEqual(self.stats[-1]['error'], 'PyDeliciousThrottled')
+
+    def test_connect(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%i/' % sock.getsockname()[1]
+        sock.close()
+        opener = urllib2.build_opener()
+        opener.rate_limiter = lambda: None
+        policy = pydelicious.RetryPolicy(connect=2, base=.01)
+        self.assertRaises(pydelicious.PyDeliciousException,
+                pydelicious.http_request, url, opener=opener, policy=policy)
+        self.assertEqual(self.stats[-1]['retries'], 2)
+
+        # No retry would start before the deadline
+        policy = pydelicious.RetryPolicy(connect=2, base=1, jitter=0,
+                deadline=.5)
+        self.assertRaises(pydelicious.PyDeliciousException,
+                pydelicious.http_request, url, opener=opener, policy=policy)
+        self.assertEqual(self.stats[-1]['retries'], 0)
+
+
+class TestTokenBucket(PyDeliciousTester):
+
+    def test_burst(self):
+        tb = pydelicious.TokenBucket(10, burst=3)
+        t = time.time()
+        for i in range(3):
+            self.assertEqual(tb(), 0)
+        self.assert_(tb() > 0)
+        self.assert_(time.time() - t >= .1)
+        self.assertEqual(tb.waited, 1)
+
+    def test_backoff(self):
+        tb = pydelicious.TokenBucket(100, burst=5)
+        tb.backoff(.2)
+        self.assertEqual(tb.rate, 50)
+        self.assertEqual(tb.backoffs, 1)
+        self.assert_(tb() >= .2)
+        # recovers on successive calls
+        tb(); tb(); tb(); tb()
+        self.assertEqual(tb.rate, 100)
+
+    def test_threads(self):
+        tb = pydelicious.TokenBucket(50, burst=1)
+        t = time.time()
+        threads = [threading.Thread(target=tb) for i in range(6)]
+        for th in threads: th.start()
+        for th in threads: th.join()
+        self.assert_(time.time() - t >= .1)
+
+    def test_rate_limiter(self):
+        calls = []
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                xml_parser=parser_dummy,
+                rate_limiter=lambda: calls.append(time.time()))
+        api.tags_get()
+        api.posts_update()
+        self.assertEqual(len(calls), 2)
+
+    def test_503_backoff(self):
+        server = serve_local(ThrottlingHTTPRequestHandler)
+        host = '127.0.0.1:%i' % server.server_port
+        try:
+            tb = pydelicious.TokenBucket(10)
+            o = pydelicious.build_api_opener(host, 'testUser', 'testPwd',
+                    rate_limiter=tb)
+            self.assertRaises(pydelicious.PyDeliciousThrottled, o.open,
+                    'http://%s/v1/posts/update' % host)
+            self.assertEqual(tb.backoffs, 1)
+            self.assert_(tb() > .5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
 class DeliciousErrorTest(PyDeliciousTester):
 
     def test_raiseFor(self):
@@ -241,7 +1385,53 @@ class DeliciousErrorTest(PyDeliciousTester):
             );
 
 
-__testcases__ = (TestGetrss, TestBug, TestFeeds, DeliciousApiUnitTest, DeliciousErrorTest)#TestWaiter, )
+class TestImport(unittest.TestCase):
+
+    """Importing pydelicious and dlcs should not load the optional parsers.
+    """
+
+    lazy = ('feedparser', 'xml.etree.ElementTree', 'elementtree.ElementTree',
+            'xml.etree.cElementTree', 'json', 'simplejson', 'sqlite3',
+            'pprint')
+
+    def imported(self, module):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join((root,
+            os.path.join(root, 'tools')))
+        script = "import sys, %s; print ' '.join(sys.modules)" % module
+        proc = subprocess.Popen([sys.executable, '-c', script], env=env,
+                stdout=subprocess.PIPE)
+        out = proc.communicate()[0]
+        assert proc.returncode == 0, out
+        return out.split()
+
+    def test_pydelicious(self):
+        modules = self.imported('pydelicious')
+        for name in self.lazy:
+            assert name not in modules, name
+
+    def test_dlcs(self):
+        modules = self.imported('dlcs')
+        for name in self.lazy:
+            assert name not in modules, name
+
+    def test_lazy_module(self):
+        mod = pydelicious.LazyModule(('no_such_module', 'string'))
+        self.assertEqual(mod.upper('a'), 'A')
+        assert mod
+        mod = pydelicious.LazyModule(('no_such_module',))
+        assert not mod
+        self.assertRaises(ImportError, getattr, mod, 'attr')
+
+
+__testcases__ = (TestGetrss, TestBug, TestFeeds, DeliciousApiUnitTest,
+        DeliciousErrorTest, TestKeepAlive, TestIterparse, TestFeedPosts,
+        TestRecords, TestBulk, TestMemoize, TestTokenBucket, TestFeedFetcher,
+        TestMockAPI, TestPostsPages, TestMetrics, TestDecoding,
+        TestRetryPolicy, TestImport, TestWaiter)
+if aio:
+    __testcases__ += (TestAsyncAPI, )
 
 if __name__ == '__main__':
     if len(sys.argv)>1 and sys.argv[1] == 'refresh_test_data':
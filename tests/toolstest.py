@@ -0,0 +1,740 @@
+"""Unittests for the pydelicious tools.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import urllib2
+from StringIO import StringIO
+
+import time
+from ConfigParser import ConfigParser
+
+try:
+    from tools import sync, store, tagindex, fulltext, dlcs, cache, \
+        scheduler, snapshot
+except ImportError:
+    # installed package
+    from pydelicious.tools import sync, store, tagindex, fulltext, dlcs, \
+        cache, scheduler, snapshot
+
+import pydelicious
+
+from pydelicioustest import serve_local, LocalHTTPRequestHandler, \
+    http_request
+import mockapi
+import bench
+
+
+def post(n, meta='m', tag='foo'):
+    return {'href': 'http://example.org/%i' % n, 'hash': 'h%i' % n,
+            'meta': '%s%i' % (meta, n), 'description': 'Post %i' % n,
+            'extended': '', 'tag': tag, 'time': '2008-11-%02iT20:08:25Z' % n}
+
+
+class DummyAPI:
+
+    """Serves posts/all and posts/get from a list of posts, and records the
+    requests.
+    """
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.calls = []
+
+    def posts_all(self, hashes=False, start=None, results=None, **kwds):
+        self.calls.append(('posts/all', hashes))
+        if hashes:
+            return {'posts': [{'url': p['hash'], 'meta': p['meta']}
+                for p in self.posts]}
+        start = start or 0
+        return {'posts': self.posts[start:results and start + results],
+            'user': 'testUser'}
+
+    def posts_pages(self, results=100, **kwds):
+        return pydelicious.PostsPages(self, results=results, **kwds)
+
+    def posts_get(self, hashes=[], **kwds):
+        self.calls.append(('posts/get', hashes))
+        return {'posts': [p for p in self.posts if p['hash'] in hashes]}
+
+    def posts_bulk(self, operations, journal=None):
+        for action, params in operations:
+            self.calls.append(('posts/bulk', action))
+            yield params['url'], action, 'done'
+
+    def iter_posts_all(self, **kwds):
+        self.calls.append(('posts/all', False))
+        return iter(self.posts)
+
+    def posts_update(self):
+        self.calls.append(('posts/update', None))
+        return {'update': {'time': time.gmtime(self.update)}}
+
+    def tags_get(self):
+        self.calls.append(('tags/get', None))
+        tags = {}
+        for p in self.posts:
+            for t in p['tag'].split(' '):
+                tags[t] = tags.get(t, 0) + 1
+        return {'tags': [{'tag': t, 'count': str(c)} for t, c in tags.items()]}
+
+
+class ToolsTester(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class TestPostsSync(ToolsTester):
+
+    def test_sync(self):
+        api = DummyAPI([post(i) for i in range(1, 11)])
+        s = sync.PostsSync(api, sync.XMLPostsFile(self.path), batch=3)
+        self.assert_(s.sync())
+        # empty store: full fetch
+        self.assertEqual(api.calls[-1], ('posts/all', False))
+        self.assertEqual(s.added, 10)
+
+        # change one, add one, remove one
+        api.posts[0] = post(1, meta='x')
+        api.posts[1:2] = []
+        api.posts.append(post(11))
+        api.calls = []
+        store = sync.XMLPostsFile(self.path)
+        s = sync.PostsSync(api, store, batch=3)
+        self.assert_(s.sync())
+        self.assertEqual((s.added, s.changed, s.removed), (1, 1, 1))
+        self.assertEqual(api.calls[1][0], 'posts/get')
+        self.assertEqual(sorted(api.calls[1][1]), ['h1', 'h11'])
+        self.assertEqual(s.requests, 2)
+
+        store = sync.XMLPostsFile(self.path)
+        self.assertEqual(sorted(store.posts.keys()),
+                sorted([p['hash'] for p in api.posts]))
+        self.assertEqual(store.posts['h1']['meta'], 'x1')
+
+        # nothing changed
+        s = sync.PostsSync(api, store)
+        self.failIf(s.sync())
+        self.assertEqual(s.requests, 1)
+
+    def test_pages(self):
+        api = DummyAPI([post(i) for i in range(1, 11)])
+        s = sync.PostsSync(api, sync.XMLPostsFile(self.path), page_size=4)
+        self.assert_(s.sync())
+        # manifest and three pages
+        self.assertEqual(s.requests, 4)
+        store = sync.XMLPostsFile(self.path)
+        self.assertEqual(len(store.posts), 10)
+        self.assertEqual(store.attrs['user'], 'testUser')
+
+
+class TestPostStore(ToolsTester):
+
+    def setUp(self):
+        ToolsTester.setUp(self)
+        self.store = store.PostStore(self.path)
+        self.store.replace([post(1, tag='foo bar'), post(2, tag='Bar'),
+            post(3, tag='baz')])
+        self.store.commit(user='testUser')
+
+    def tearDown(self):
+        self.store.close()
+        ToolsTester.tearDown(self)
+
+    def hrefs(self, posts):
+        return [p['href'][-1] for p in posts]
+
+    def test_query(self):
+        s = self.store
+        self.assertEqual(len(s), 3)
+        self.assertEqual(s.get_attr('user'), 'testUser')
+        self.assertEqual(s.get('http://example.org/2')['tag'], 'Bar')
+        self.assertEqual(s.get_hash('h3')['href'], 'http://example.org/3')
+        self.assertEqual(s.get('http://example.org/4'), None)
+        self.assertEqual(self.hrefs(s.posts()), ['3', '2', '1'])
+        self.assertEqual(self.hrefs(s.posts(['http://example.org/1'])), ['1'])
+        self.assertEqual(s.tags_per_post(), (1, 2))
+
+    def test_tagged(self):
+        s = self.store
+        self.assertEqual(self.hrefs(s.tagged(['bar'])), ['1'])
+        self.assertEqual(self.hrefs(s.tagged(['bar'], ignore_case=True)),
+                ['2', '1'])
+        self.assertEqual(self.hrefs(s.tagged(['foo', 'bar'])), ['1'])
+        self.assertEqual(self.hrefs(s.tagged(['foo', 'baz'])), [])
+        self.assertEqual(self.hrefs(s.tagged(['foo', 'baz'],
+            match_all=False)), ['3', '1'])
+
+    def test_search(self):
+        s = self.store
+        self.assertEqual(self.hrefs(s.search('Post 2')), ['2'])
+        self.assertEqual(self.hrefs(s.search('post')), [])
+        self.assertEqual(self.hrefs(s.search('post', True)), ['3', '2', '1'])
+        # wildcards match literally
+        self.assertEqual(self.hrefs(s.search('Post ?')), [])
+        self.assertEqual(self.hrefs(s.search('*')), [])
+
+    def test_apply(self):
+        s = self.store
+        s.apply('replace', {'url': 'http://example.org/1',
+            'description': 'Post 1', 'tags': 'foo qux', 'shared': False})
+        s.apply('add', {'url': 'http://example.org/4', 'description': 'New',
+            'tags': 'qux'})
+        s.apply('delete', {'url': 'http://example.org/3'})
+        self.assertEqual(sorted(self.hrefs(s.tagged(['qux']))), ['1', '4'])
+        self.assertEqual(s.get_hash('h1')['shared'], 'no')
+        self.assertEqual(s.get_hash('h1').get('meta'), None)
+        self.assertEqual(s.get('http://example.org/3'), None)
+        self.assertEqual(s.get('http://example.org/4')['hash'],
+                'f9e4619b3d80c2b076ff5b9e726dc03d')
+
+    def test_sync(self):
+        api = DummyAPI([post(1, tag='foo'), post(2, meta='x', tag='Bar')])
+        sync.PostsSync(api, self.store).sync()
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(self.hrefs(self.store.tagged(['foo'])), ['1'])
+        self.assertEqual(self.store.get_hash('h2')['meta'], 'x2')
+
+
+class TestTagIndex(ToolsTester):
+
+    def setUp(self):
+        ToolsTester.setUp(self)
+        self.index = tagindex.TagIndex.from_posts([post(1, tag='foo bar'),
+            post(2, tag='Bar foo'), post(3, tag='baz foo')], stamp=1.0)
+
+    def test_query(self):
+        i = self.index
+        self.assertEqual(i.query(all=['foo']), set(['h1', 'h2', 'h3']))
+        self.assertEqual(i.query(all=['foo', 'bar']), set(['h1']))
+        self.assertEqual(i.query(all=['foo', 'bar'], ignore_case=True),
+                set(['h1', 'h2']))
+        self.assertEqual(i.query(any=['bar', 'baz']), set(['h1', 'h3']))
+        self.assertEqual(i.query(all=['foo'], any=['Bar', 'baz']),
+                set(['h2', 'h3']))
+        self.assertEqual(i.query(all=['nope', 'foo']), set())
+        self.assertEqual(i.hrefs(i.query(all=['foo'])),
+                ['http://example.org/3', 'http://example.org/2',
+                    'http://example.org/1'])
+
+    def test_related(self):
+        i = self.index
+        self.assertEqual(i.related(['foo']), {'bar': 1, 'Bar': 1, 'baz': 1})
+        self.assertEqual(i.related(['bar'], ignore_case=True), {'foo': 2})
+
+    def test_update(self):
+        i = self.index
+        i.add(post(1, tag='baz'))
+        self.assertEqual(i.query(all=['bar']), set())
+        self.assertEqual(i.query(all=['baz']), set(['h1', 'h3']))
+        i.remove('h3')
+        self.assertEqual(i.query(all=['baz']), set(['h1']))
+        self.failIf('Bar' in i.related(['baz']))
+
+    def test_persist(self):
+        self.index.save(self.path)
+        i = tagindex.TagIndex.load(self.path)
+        self.assertEqual(i.stamp, 1.0)
+        self.assertEqual(i.posts, self.index.posts)
+        self.assertEqual(i.tags, self.index.tags)
+
+
+class TestSnapshot(ToolsTester):
+
+    def setUp(self):
+        ToolsTester.setUp(self)
+        # most recent first, like the store
+        self.posts = [post(3, tag='baz foo'), post(2, tag='Bar foo'),
+            post(1, tag='foo bar')]
+        self.posts[0]['description'] = u'Caf\xe9'
+        del self.posts[1]['extended']
+        snapshot.write_snapshot(self.path, self.posts, 1.5)
+        self.snapshot = snapshot.Snapshot(self.path)
+
+    def tearDown(self):
+        self.snapshot.close()
+        ToolsTester.tearDown(self)
+
+    def test_posts(self):
+        s = self.snapshot
+        self.assertEqual(s.stamp, 1.5)
+        self.assertEqual(len(s), 3)
+        self.assertEqual(list(s.posts()), self.posts)
+        self.assertEqual(list(s.posts(['http://example.org/1',
+            'http://example.org/3', 'http://example.org/4'])),
+            [self.posts[0], self.posts[2]])
+        self.assertEqual(s.get('http://example.org/2'), self.posts[1])
+        self.assertEqual(s.get('http://example.org/0'), None)
+        self.assertEqual(s.tags_per_post(), (2, 2))
+        self.assertEqual(s.count_tags(), 4)
+
+    def test_query(self):
+        s = self.snapshot
+        self.assertEqual(s.query(all=['foo']), set([0, 1, 2]))
+        self.assertEqual(s.query(all=['foo', 'bar'], ignore_case=True),
+                set([1, 2]))
+        self.assertEqual(s.query(all=['foo'], any=['Bar', 'baz']),
+                set([0, 1]))
+        self.assertEqual(s.query(all=['nope', 'foo']), set())
+        self.assertEqual(s.hrefs(s.query(all=['foo'])),
+                ['http://example.org/3', 'http://example.org/2',
+                    'http://example.org/1'])
+        self.assertEqual(s.related(['foo']), {'bar': 1, 'Bar': 1, 'baz': 1})
+        self.assertEqual(s.related(['bar'], ignore_case=True), {'foo': 2})
+
+    def test_empty(self):
+        snapshot.write_snapshot(self.path, [])
+        s = snapshot.Snapshot(self.path)
+        self.assertEqual((len(s), list(s.posts()), s.query(all=['foo'])),
+                (0, [], set()))
+        self.assertEqual(s.tags_per_post(), (None, None))
+        s.close()
+        open(self.path, 'wb').write('x' * 200)
+        self.assertRaises(ValueError, snapshot.Snapshot, self.path)
+
+
+class TestFullTextIndex(ToolsTester):
+
+    def setUp(self):
+        ToolsTester.setUp(self)
+        posts = [post(1, tag='python web'), post(2, tag='Pythonic'),
+            post(3, tag='perl')]
+        posts[0]['description'] = 'Python web frameworks'
+        posts[2]['extended'] = 'Not python at all'
+        self.index = fulltext.FullTextIndex.from_posts(posts)
+
+    def test_search(self):
+        i = self.index
+        self.assertEqual([h for s, h in i.search('python')], ['h1', 'h3'])
+        self.assertEqual([h for s, h in i.search('python web')], ['h1'])
+        self.assertEqual(i.search('python nope'), [])
+        self.assertEqual(sorted([h for s, h in i.search('pyth*')]),
+                ['h1', 'h2', 'h3'])
+        self.assertEqual([h for s, h in i.search('tag:python')], ['h1'])
+        self.assertEqual([h for s, h in i.search('extended:python')], ['h3'])
+        self.assertEqual(i.hrefs(i.search('perl')), ['http://example.org/3'])
+        self.assertEqual(len(i.search('example.org/2')), 1)
+
+    def test_sync(self):
+        i = self.index
+        changed = post(2, meta='x', tag='ruby')
+        self.assertEqual(i.sync([post(1, tag='python web'), changed]), 2)
+        self.assertEqual([h for s, h in i.search('ruby')], ['h2'])
+        self.assertEqual(i.search('perl'), [])
+        self.assertEqual(i.search('pythonic'), [])
+        self.assertEqual(i.sync([post(1, tag='python web'), changed]), 0)
+
+    def test_persist(self):
+        self.index.save(self.path)
+        i = fulltext.FullTextIndex.load(self.path)
+        self.assertEqual(i.search('pyth*'), self.index.search('pyth*'))
+
+
+class TestCachedPosts(ToolsTester):
+
+    def test_cached_posts(self):
+        conf = ConfigParser()
+        conf.add_section('local-files')
+        conf.set('local-files', 'store', self.path)
+        api = DummyAPI([post(1), post(2)])
+        api.update = time.time() - 60
+        dlcs.Updates.clear()
+        requests = dlcs.Updates.requests
+
+        posts = dlcs.cached_posts(conf, api)
+        self.assertEqual(len(posts), 2)
+        self.assertEqual(api.calls, [('posts/update', None),
+            ('posts/all', False)])
+
+        # up to date, and the posts/update answer is shared
+        api.calls = []
+        dlcs.cached_posts(conf, api)
+        self.assertEqual(api.calls, [])
+        dlcs.Updates.clear()
+        dlcs.cached_posts(conf, api)
+        self.assertEqual(api.calls, [('posts/update', None)])
+        dlcs.cached_posts(conf, api, noupdate=True)
+        self.assertEqual(len(api.calls), 1)
+
+        # changed on server
+        api.update = time.time() + 60
+        api.posts.append(post(3))
+        api.calls = []
+        dlcs.Updates.clear()
+        posts = dlcs.cached_posts(conf, api)
+        self.assertEqual(len(posts), 3)
+        self.assertEqual([c[0] for c in api.calls],
+                ['posts/update', 'posts/all', 'posts/get'])
+
+        api.calls = []
+        tags = dlcs.cached_tags(conf, api)
+        self.assertEqual(list(tags.tags()), [{'tag': 'foo', 'count': '3'}])
+        self.assertEqual(api.calls, [('tags/get', None)])
+        dlcs.cached_tags(conf, api)
+        self.assertEqual(len(api.calls), 1)
+        self.assertEqual(dlcs.Updates.requests - requests, 3)
+
+        snap = dlcs.cached_snapshot(conf, api, noupdate=True)
+        self.assertEqual(snap.stamp, posts.cached('posts'))
+        self.assertEqual(len(snap.query(all=['foo'])), 3)
+        snap.close()
+
+        index = dlcs.cached_fulltext(conf, api, noupdate=True)
+        self.assertEqual(len(index.search('post')), 3)
+        os.unlink(self.path + '.ftidx')
+        os.unlink(self.path + '.snap')
+
+    def test_page_size(self):
+        conf = ConfigParser()
+        conf.add_section('local-files')
+        conf.set('local-files', 'store', self.path)
+        conf.add_section('dlcs')
+        conf.set('dlcs', 'page_size', '2')
+        api = DummyAPI([post(1), post(2), post(3)])
+        api.update = time.time() - 60
+        dlcs.Updates.clear()
+        store = dlcs.cached_posts(conf, api)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(api.calls, [('posts/update', None),
+            ('posts/all', False), ('posts/all', False)])
+        os.unlink(self.path + '.snap')
+
+    def test_bulk_write(self):
+        conf = ConfigParser()
+        conf.add_section('local-files')
+        conf.set('local-files', 'store', self.path)
+        api = DummyAPI([post(1), post(2)])
+        api.update = time.time() - 60
+        dlcs.Updates.clear()
+        store = dlcs.cached_posts(conf, api)
+        stamp = store.cached('posts')
+
+        p = dict(post(2), tag='foo bar')
+        dlcs.bulk_write(store, api, [dlcs.replace_operation(p)])
+        self.assertEqual(api.calls[-1], ('posts/bulk', 'replace'))
+        self.assertEqual(store.get(p['href'])['tag'], 'foo bar')
+        self.assertNotEqual(store.cached('posts'), stamp)
+
+        snap = dlcs.cached_snapshot(conf, api, noupdate=True)
+        self.assertEqual(snap.stamp, store.cached('posts'))
+        self.assertEqual(len(snap.query(all=['bar'])), 1)
+        snap.close()
+        os.unlink(self.path + '.snap')
+
+    def test_tag(self):
+        conf = ConfigParser()
+        conf.add_section('local-files')
+        conf.set('local-files', 'store', self.path)
+        posts = [post(1), post(2)]
+        for p in posts:
+            p['hash'] = dlcs.md5(p['href']).hexdigest()
+        api = DummyAPI(posts)
+        api.update = time.time() - 60
+        dlcs.Updates.clear()
+        store = dlcs.cached_posts(conf, api)
+
+        # changed on the server since it was cached
+        posts[0]['tag'] = 'foo baz'
+        api.calls = []
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            dlcs.tag(conf, api, 'bar', posts[0]['href'],
+                    'http://example.org/3', keep_cache=True)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(api.calls, [('posts/get', [posts[0]['hash'],
+            dlcs.md5('http://example.org/3').hexdigest()]),
+            ('posts/bulk', 'replace')])
+        self.assertEqual(store.get(posts[0]['href'])['tag'], 'foo baz bar')
+        os.unlink(self.path + '.snap')
+
+
+class CachingHTTPRequestHandler(LocalHTTPRequestHandler):
+
+    """Serves the path with an ETag and the headers in `response_headers`,
+    answers 304 to a matching If-None-Match. Counts the requests.
+    """
+
+    requests = []
+    response_headers = {}
+
+    def do_GET(self):
+        CachingHTTPRequestHandler.requests.append(self.path)
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        for k, v in self.headers_for(self.path).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(self.path)))
+        self.end_headers()
+        self.wfile.write(self.path)
+
+    def headers_for(self, path):
+        return CachingHTTPRequestHandler.response_headers.get(
+                path.split('/')[1], {})
+
+
+class TestHTTPCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = serve_local(CachingHTTPRequestHandler)
+        self.base = 'http://127.0.0.1:%i/' % self.server.server_port
+        CachingHTTPRequestHandler.requests = []
+        CachingHTTPRequestHandler.response_headers = {
+            'fresh': {'Cache-Control': 'max-age=60'},
+            'stale': {'Cache-Control': 'no-cache'},
+            'nostore': {'Cache-Control': 'no-store'},
+        }
+        self.cache = cache.HTTPCache(self.path)
+        self.opener = urllib2.build_opener(cache.CacheHandler(self.cache))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        fl = self.opener.open(self.base + path)
+        data = fl.read()
+        fl.close()
+        return data
+
+    def test_fresh(self):
+        self.assertEqual(self.get('fresh/1'), '/fresh/1')
+        self.assertEqual(self.get('fresh/1'), '/fresh/1')
+        self.assertEqual(CachingHTTPRequestHandler.requests, ['/fresh/1'])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        # persistent
+        c = cache.HTTPCache(self.path)
+        self.assertEqual(c.stats()['entries'], 1)
+        self.assertEqual([n for n in os.listdir(self.path)
+            if not n.endswith('.cache')], [])
+
+    def test_revalidate(self):
+        self.assertEqual(self.get('stale/1'), '/stale/1')
+        fl = self.opener.open(self.base + 'stale/1')
+        self.assertEqual(fl.code, 200)
+        self.assertEqual(fl.read(), '/stale/1')
+        self.assertEqual(len(CachingHTTPRequestHandler.requests), 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['revalidated'], stats['misses']), (1, 1))
+
+    def test_no_store(self):
+        self.get('nostore/1')
+        self.get('nostore/1')
+        self.assertEqual(len(CachingHTTPRequestHandler.requests), 2)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_evict(self):
+        self.get('fresh/1')
+        size = self.cache.size
+        self.cache.max_size = size * 2.5
+        self.get('fresh/2')
+        self.get('fresh/1')
+        self.get('fresh/3')
+        # fresh/2 was least recently used
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.get('fresh/2')
+        self.assertEqual(CachingHTTPRequestHandler.requests,
+                ['/fresh/1', '/fresh/2', '/fresh/3', '/fresh/2'])
+
+    def test_api_writes(self):
+        server = mockapi.serve_mock({'testUser': 'testPwd'})
+        server.install()
+        http_request_ = pydelicious.http_request
+        pydelicious.http_request = http_request
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+                build_opener=lambda user, passwd:
+                    cache.dlcs_cached_api_opener(user, passwd, self.cache),
+                rate_limiter=pydelicious.TokenBucket(1000, burst=100))
+        try:
+            api.posts_add('http://example.org/', 'Example')
+            self.assertEqual(len(api.posts_all()['posts']), 1)
+            api.posts_delete('http://example.org/')
+            self.assertEqual(len(api.posts_all()['posts']), 0)
+            # the same request again, it must reach the server
+            api.posts_add('http://example.org/', 'Example')
+            self.assertEqual(len(api.posts_all()['posts']), 1)
+            self.assertEqual(len(server.collection('testUser').posts), 1)
+
+            api.posts_update()
+            api.posts_update()
+            self.assertEqual(server.requests['posts/update'], 2)
+            api.posts_all()
+            self.assertEqual(self.cache.stats()['hits'], 1)
+        finally:
+            api._opener.keepalive.close()
+            pydelicious.http_request = http_request_
+            server.stop()
+
+    def test_freshness(self):
+        self.assertEqual(cache.freshness({}, 5), 5)
+        self.assertEqual(cache.freshness({'cache-control':
+            'public, max-age=10'}, 5), 10)
+        self.assertEqual(cache.freshness({
+            'expires': 'Thu, 01 Jan 2009 00:01:00 GMT',
+            'date': 'Thu, 01 Jan 2009 00:00:00 GMT'}, 5), 60)
+        self.assertEqual(cache.freshness({'expires': '0'}, 5), 0)
+
+
+class TestSyncScheduler(unittest.TestCase):
+
+    users = ['user%i' % i for i in range(4)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = mockapi.serve_mock(dict([(u, 'pwd') for u in self.users]),
+                latency=.1)
+        self.server.install()
+        self.http_request = pydelicious.http_request
+        pydelicious.http_request = http_request
+        for i, user in enumerate(self.users):
+            self.server.seed(user, 20 + i, seed=i)
+
+    def tearDown(self):
+        pydelicious.http_request = self.http_request
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def scheduler(self, **kwds):
+        s = scheduler.SyncScheduler(rate=100, **kwds)
+        for user in self.users:
+            s.add(user, 'pwd', os.path.join(self.dir, user))
+        return s
+
+    def stored(self, user):
+        return len(store.PostStore(os.path.join(self.dir, user)))
+
+    def test_run(self):
+        s = self.scheduler(workers=4)
+        t = time.time()
+        self.assertEqual(len(s.run()), 4)
+        # Four requests per account (two of them to authenticate), taking
+        # 3.2 seconds for the accounts one after the other
+        self.assert_(time.time() - t < 1.6)
+        for i, user in enumerate(self.users):
+            self.assertEqual(self.stored(user), 20 + i)
+            self.assertEqual(s.accounts[user].stats['added'], 20 + i)
+
+        self.assertEqual(s.run(), [])
+        self.assertEqual(self.server.requests['posts/update'], 8)
+
+        # Only the changed account is synced again
+        coll = self.server.collection('user2')
+        coll.add({'href': 'http://example.org/new', 'description': 'New'})
+        coll.update += 10
+        synced = s.run()
+        self.assertEqual([a.user for a in synced], ['user2'])
+        self.assertEqual(self.stored('user2'), 23)
+        self.assertEqual(len(s.run(force=True)), 4)
+        s.close()
+
+    def test_priority(self):
+        self.server.latency = 0
+        s = self.scheduler(workers=1)
+        s.run()
+        for i, user in enumerate(self.users[1:]):
+            self.server.collection(user).update += 10 * (i + 1)
+        synced = s.run(force=True)
+        self.assertEqual([a.user for a in synced],
+                ['user3', 'user2', 'user1', 'user0'])
+        s.close()
+
+    def test_page_size(self):
+        self.server.latency = 0
+        s = self.scheduler(workers=2, page_size=10)
+        s.run()
+        for i, user in enumerate(self.users):
+            self.assertEqual(self.stored(user), 20 + i)
+            # the manifest and three pages
+            self.assertEqual(s.accounts[user].stats['requests'], 4)
+        s.close()
+
+    def test_xml_store(self):
+        self.server.latency = 0
+        s = self.scheduler(store_class=sync.XMLPostsFile)
+        s.run()
+        for i, user in enumerate(self.users):
+            path = os.path.join(self.dir, user)
+            self.assertEqual(len(pydelicious.dlcs_parse_xml(open(path))['posts']), 20 + i)
+        s.close()
+
+    def test_no_keepalive(self):
+        self.server.latency = 0
+        opener = lambda user, passwd: pydelicious.dlcs_api_opener(user, passwd,
+                keepalive=False)
+        s = self.scheduler(api_options={'build_opener': opener})
+        self.assertEqual(len(s.run()), 4)
+        s.remove('user0')
+        s.close()
+        self.assertEqual(self.stored('user1'), 21)
+
+    def test_errors(self):
+        s = self.scheduler()
+        s.add('unknown', 'pwd', os.path.join(self.dir, 'unknown'))
+        self.assertEqual(len(s.run()), 4)
+        self.assert_(isinstance(s.accounts['unknown'].error,
+            pydelicious.PyDeliciousUnauthorized))
+        s.close()
+
+    def test_global_rate(self):
+        self.server.latency = 0
+        s = self.scheduler(workers=4, global_rate=20)
+        t = time.time()
+        s.run()
+        # 12 requests, the first 4 at once
+        self.assert_(time.time() - t >= .4)
+        s.close()
+
+    def test_processes(self):
+        s = self.scheduler(workers=4, processes=True)
+        self.assertEqual(len(s.run()), 4)
+        for i, user in enumerate(self.users):
+            self.assertEqual(self.stored(user), 20 + i)
+        self.assertEqual(s.run(), [])
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run_benchmarks(sizes=(20,), repeat=2)
+        self.assertEqual([r['name'] for r in results['results']],
+                [b.name for b in bench.BENCHMARKS])
+        for result in results['results']:
+            assert 'skipped' in result or len(result['times']) == 2, result
+
+    def test_compare(self):
+        old = {'version': '0.1', 'results': [
+            {'name': 'a', 'size': 10, 'seconds': 1.0},
+            {'name': 'b', 'size': 10, 'seconds': 1.0},
+            {'name': 'c', 'size': 10, 'skipped': ''}]}
+        new = {'version': '0.2', 'results': [
+            {'name': 'a', 'size': 10, 'seconds': 1.05},
+            {'name': 'b', 'size': 10, 'seconds': 2.0},
+            {'name': 'c', 'size': 10, 'seconds': 2.0}]}
+        out = StringIO()
+        self.assertEqual(bench.compare(old, new, .1, out), 1)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+__testcases__ = (TestPostsSync, TestPostStore, TestTagIndex, TestSnapshot,
+        TestFullTextIndex, TestCachedPosts, TestHTTPCache, TestSyncScheduler,
+        TestBench)
+
+if __name__ == '__main__':
+    unittest.main()
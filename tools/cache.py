@@ -1,87 +1,322 @@
+"""HTTP response cache for urllib2 openers.
+
+``CacheHandler`` keeps successful GET responses in an ``HTTPCache`` directory.
+A stored response is served without a request while it is fresh, according
+to its Cache-Control max-age or Expires header, or for a default TTL. Once
+stale it is revalidated with If-None-Match and If-Modified-Since (using the
+ETag and Last-Modified of the stored response), and a 304 answer is served
+from the cache. The size of the cache is kept below a limit by removing the
+least recently used responses.
+
+Requests to the del.icio.us API are cached too, except for ``posts/update``
+and the paths that change the collection (see
+``pydelicious.DeliciousAPI.write_paths``): those always go to the server,
+and a successful write clears the cache.
+
+Use ``dlcs_cached_api_opener()`` for a ``pydelicious.DeliciousAPI`` or
+``cached_opener()`` with ``pydelicious.http_request()`` and the feeds.
+"""
 import os
+import time
+import marshal
+import tempfile
+import threading
+import httplib
 import urllib2
-import pydelicious
 from StringIO import StringIO
+from email.Utils import parsedate_tz, mktime_tz
 
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
-DLCS_CACHE = os.expanduser('~/.dlcs-cache/')
+import pydelicious
 
 
-class CachedResponse(StringIO):
-    def info(self):
-        return self.headers
+DLCS_CACHE = '~/.dlcs-cache/'
+"Default location of the response cache"
+DLCS_CACHE_TTL = 300
+"Seconds a response without expiration headers is used without revalidation"
+DLCS_CACHE_SIZE = 32 * 1024 * 1024
+"Maximum size in bytes of the response cache"
+DLCS_UNCACHED_PATHS = ('posts/update',)
+"API paths that are never answered from the cache, besides the write paths"
 
-    def geturl(self):
-        return self.url
 
+class HTTPCache:
 
-class CachedHandler(urllib2.BaseHandler):
-    
-    def __init__(self, cachedir):
-        self.cachedir = cachedir
+    """Directory with one file per cached response.
 
-    def default_open(self, request):
-        if request.get_method() != 'GET':
+    Some attributes:
+    :path: the cache directory
+    :max_size: the maximum total size of the stored responses
+    :ttl: seconds a response without expiration headers stays fresh
+    :hits: the number of responses served without a request
+    :revalidated: the number of stale responses confirmed by the server
+    :misses: the number of requests not answered by the cache
+    :evictions: the number of responses removed to limit the size
+    """
+
+    def __init__(self, path=DLCS_CACHE, max_size=DLCS_CACHE_SIZE,
+            ttl=DLCS_CACHE_TTL):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = self.revalidated = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # key -> [size, last used]
+        self._entries = {}
+        self.size = 0
+        for name in os.listdir(self.path):
+            if name.endswith('.cache'):
+                st = os.stat(os.path.join(self.path, name))
+                self._entries[name[:-6]] = [st.st_size, st.st_mtime]
+                self.size += st.st_size
+
+    def key(self, request):
+        "Return the cache key for a urllib2 request. "
+        # Responses are cached per user
+        auth = request.get_header('Authorization', '')
+        return md5(request.get_full_url() + '\n' + auth).hexdigest()
+
+    def get(self, key):
+        "Return the stored entry as dictionary, or None. "
+        try:
+            fl = open(self._file(key), 'rb')
+            try:
+                entry = marshal.load(fl)
+            finally:
+                fl.close()
+        except (IOError, EOFError, ValueError, TypeError):
             return None
-        url = quote(request.get_full_url(), '')
-        path = os.path.join(self.cachedir, url)
-        if os.path.exists(path):
-            f = open(path)
-            data = email.message_from_file(f)
-            if data.get('x-cache-md5') is None:
-                return None
-            payload = data.get_payload()
-            if data.get('x-cache-md5') != md5.new(payload).hexdigest():
-                return None
-            response = CachedResponse(payload)
-            response.url = request.get_full_url()
-            response.headers = dict(data.items())
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._entries[key][1] = time.time()
+        finally:
+            self._lock.release()
+        return entry
+
+    def put(self, key, entry):
+        "Store the entry and evict old entries if the cache grew too big. "
+        path = self._file(key)
+        # unique across threads and processes sharing the directory
+        fd, tmp = tempfile.mkstemp('.tmp', key + '.', self.path)
+        fl = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump(entry, fl)
+        finally:
+            fl.close()
+        size = os.path.getsize(tmp)
+        os.rename(tmp, path)
+
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self.size -= self._entries[key][0]
+            self._entries[key] = [size, time.time()]
+            self.size += size
+            if self.size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def count(self, counter):
+        "Add one to the `counter` attribute, e.g. 'hits'. "
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size,
+            'hits': self.hits, 'revalidated': self.revalidated,
+            'misses': self.misses, 'evictions': self.evictions}
+
+    def _evict(self):
+        lru = [(used, key) for key, (size, used) in self._entries.items()]
+        lru.sort()
+        # Make room for some new entries at once
+        target = self.max_size * .9
+        for used, key in lru:
+            if self.size <= target:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[0]
+        try:
+            os.unlink(self._file(key))
+        except OSError:
+            pass
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.cache')
+
+
+def freshness(headers, default):
+    """Return the number of seconds a response is fresh according to its
+    Cache-Control and Expires headers, or `default`.
+    """
+    cache_control = [d.strip().lower()
+        for d in headers.get('cache-control', '').split(',')]
+    if 'no-cache' in cache_control:
+        return 0
+    for directive in cache_control:
+        if directive.startswith('max-age='):
             try:
-                response.code = int(data['x-cache-code'])
-                response.msg = data['x-cache-msg']
-            except (TypeError, KeyError):
-                return None
-            return response
+                return int(directive[8:])
+            except ValueError:
+                return 0
+    expires = headers.get('expires')
+    if expires:
+        expires = parsedate_tz(expires)
+        date = parsedate_tz(headers.get('date', ''))
+        if not expires:
+            return 0
+        if date:
+            return mktime_tz(expires) - mktime_tz(date)
+        return mktime_tz(expires) - time.time()
+    return default
+
+
+def cached_response(entry):
+    "Build a response like those of urllib2 from a cache entry. "
+    headers = httplib.HTTPMessage(StringIO(entry['headers']))
+    response = urllib2.addinfourl(StringIO(entry['body']), headers,
+            entry['url'], entry['code'])
+    response.msg = entry['msg']
+    return response
+
+
+def api_path(url):
+    "Return the del.icio.us API path requested by the URL, or None. "
+    base = pydelicious.DLCS_API + '/'
+    if url.startswith(base):
+        return url[len(base):].split('?', 1)[0]
+
+
+class CacheHandler(urllib2.BaseHandler):
+
+    """Answers GET requests from an ``HTTPCache`` and stores the responses.
+    API requests for the `uncached` paths and the write paths of
+    ``pydelicious.DeliciousAPI`` bypass the cache, successful writes clear
+    it.
+    """
+
+    # before the protocol handlers and the error processor
+    handler_order = 400
+
+    def __init__(self, cache, uncached=DLCS_UNCACHED_PATHS):
+        self.cache = cache
+        self.uncached = uncached
+
+    def cacheable(self, request):
+        """Return True if the response may be cached, False for requests
+        that bypass the cache, or 'write' for API writes.
+        """
+        if request.get_method() != 'GET':
+            return False
+        path = api_path(request.get_full_url())
+        if path in pydelicious.DeliciousAPI.write_paths:
+            return 'write'
+        return path not in self.uncached
+
+    def default_open(self, request):
+        if self.cacheable(request) is not True:
+            return None
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry is None:
+            self.cache.count('misses')
+            return None
+        if time.time() < entry['expires']:
+            self.cache.count('hits')
+            return cached_response(entry)
+        # Stale: ask the server whether it changed
+        if entry['etag']:
+            request.add_unredirected_header('If-None-Match', entry['etag'])
+        if entry['last-modified']:
+            request.add_unredirected_header('If-Modified-Since',
+                    entry['last-modified'])
+        request._cache_entry = key, entry
         return None
 
     def http_response(self, request, response):
-        if request.get_method() != 'GET':
+        cacheable = self.cacheable(request)
+        if cacheable is not True:
+            if cacheable == 'write' and response.code == 200:
+                # any cached API answer may have changed
+                self.cache.clear()
             return response
+        key, entry = getattr(request, '_cache_entry', (None, None))
         headers = response.info()
-        if headers.get('x-cache-md5') == None:
-            data = Message()
-            for k,v in headers.items():
-                data[k] = v
-            payload = response.read()
-            data['x-cache-md5'] = md5.new(payload).hexdigest()
-            data['x-cache-code'] = str(response.code)
-            data['x-cache-msg'] = response.msg
-            data.set_payload(payload)
-            url = quote(request.get_full_url(), '')
-            path = os.path.join(self.cache, url)
-            f = open(path, 'w')
-            f.write(str(data))
-            f.close()
-            new_response = CachedResponse(payload)
-            new_response.url = response.url
-            new_response.headers = response.headers
-            new_response.code = response.code
-            new_response.msg = response.msg
-            return new_response
-        return response
-
-
-
-def dlcs_cached_api_opener(user, passwd, cachedir=DLCS_CACHE):
 
+        if response.code == 304 and entry:
+            self.cache.count('revalidated')
+            entry['expires'] = time.time() + freshness(headers,
+                    self.cache.ttl)
+            self.cache.put(key, entry)
+            return cached_response(entry)
+
+        if entry:
+            self.cache.count('misses')
+        if response.code != 200 or \
+                'no-store' in headers.get('cache-control', '').lower():
+            return response
+
+        body = response.read()
+        response.close()
+        entry = {
+            'url': response.geturl(),
+            'code': response.code,
+            'msg': response.msg,
+            'headers': "".join(headers.headers),
+            'body': body,
+            'etag': headers.get('etag', ''),
+            'last-modified': headers.get('last-modified', ''),
+            'expires': time.time() + freshness(headers, self.cache.ttl),
+        }
+        self.cache.put(key or self.cache.key(request), entry)
+        return cached_response(entry)
+
+    https_response = http_response
+
+
+def cached_opener(cache=None):
     """
-    Build an opener like pydelicious.dlcs_api_opener but with an additional
-    caching handler.
+    Build an opener with a cache, e.g. for ``pydelicious.http_request()``.
     """
+    return urllib2.build_opener(pydelicious.DecodingHandler(),
+            CacheHandler(cache or HTTPCache()))
 
-    caching_handler = CachedHandler(cachedir)
-
-    return pydelicious.build_api_opener(
-            pydelicious.DLCS_API_HOST, user, passwd, (caching_handler,))
-    
 
+def dlcs_cached_api_opener(user, passwd, cache=None):
+    """
+    Build an opener like pydelicious.dlcs_api_opener but with an additional
+    caching handler.
+    """
+    return pydelicious.build_api_opener(pydelicious.DLCS_API_HOST, user,
+            passwd, (CacheHandler(cache or HTTPCache()),))
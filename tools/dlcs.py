@@ -35,6 +35,11 @@ but this can be changed using command line options. If no username or
 password are provided `dlcs` will guess the username and prompt for the
 password.
 
+The local copy of the post and tag lists is kept in a SQLite database, set
+by the option 'store' in the section 'local-files' (default
+~/.dlcs-store.sqlite). Feeds are cached in the directory set by the option
+'cache' (default ~/.dlcs-cache/).
+
 Limitation
 ----------
 - Bundle sizes are restricted by the maximum URL size [xxx:length?], the
@@ -86,8 +91,9 @@ from os.path import expanduser, getmtime, exists, abspath
 from ConfigParser import ConfigParser
 import pydelicious
 from pydelicious import DeliciousAPI, dlcs_parse_xml, PyDeliciousException, \
-    dlcs_feed
-from pprint import pformat    
+    FeedFetcher
+# The local storage and index modules are imported by the functions that
+# use them, to keep the start up time of commands such as postit short
 
 try:
     # Python >= 2.4
@@ -102,13 +108,14 @@ try:
 except ImportError:
     from md5 import md5
 
-try:
-    from simplejson import dumps as jsonwrite, loads as jsonread
-except:
-    try:
-        from json import read as jsonread, write as jsonwrite
-    except:
-        print >>sys.stderr, "No JSON decoder installed"
+json = pydelicious.LazyModule(('simplejson', 'json'),
+        "No JSON decoder installed")
+
+def jsonwrite(data):
+    return json.dumps(data)
+
+def jsonread(data):
+    return json.loads(data)
 
 
 __cmds__ = [
@@ -156,6 +163,11 @@ else:
 
 NEW_CONFIG = not os.path.exists(DLCS_CONFIG)
 
+DLCS_STORE = '~/.dlcs-store.sqlite'
+"Default location of the local post and tag store"
+DLCS_UPDATE_TTL = 30
+"Seconds a posts/update answer is shared by the cached resources"
+
 ENCODING = locale.getpreferredencoding()
 
 __usage__ = """%prog [options] [command] [args...] """ + """
@@ -187,6 +199,12 @@ __options__ = [
         'help':"When posting a URL, set the 'shared' parameter."}),
     (('-r', '--replace'),{'default':False,
         'help':"When posting a URL, set the 'replace' parameter."}),
+    (('-j', '--journal'),{
+        'help':"Record the progress of `tag` and `untag` in this file and resume from it (defaults to a file next to the store)"}),
+    (('-P', '--page-size'),{'dest':'page_size',
+        'help':"Fetch a new or changed post list in pages of this many posts (defaults to the config, or all at once)"}),
+    (('-m', '--metrics'),{
+        'help':"Print request statistics to stderr ('-') or write them as JSON to this file"}),
     (('-v', '--verboseness'),{'default':0,
         'help':"TODO: Increase or set DEBUG (defaults to 0 or the DLCS_DEBUG env. var.)"})
 ]
@@ -334,6 +352,52 @@ class DebugWrapper:
         base = self.__dict__["__base__"]
         setattr(base, name, value)
 
+class UpdateCheck:
+
+    """Shares the posts/update answer of del.icio.us between the locally
+    cached resources, so that commands using both the cached posts and tags
+    request it once. Answers are reused for `ttl` seconds.
+
+    Resources record the update time they were fetched at in the store, as
+    the '<resource>-update' attribute, and are fresh while it equals the
+    time del.icio.us reports.
+
+    Some attributes:
+    :requests: the number of posts/update requests made
+    """
+
+    def __init__(self, ttl=DLCS_UPDATE_TTL):
+        self.ttl = ttl
+        self.requests = 0
+        self._updates = {}
+
+    def latest(self, dlcs):
+        "Return the last update time of the user of `dlcs`, as ISO string. "
+        user = getattr(dlcs, 'user', None)
+        update, checked = self._updates.get(user, (None, 0))
+        if time.time() - checked >= self.ttl:
+            update = time.strftime(pydelicious.ISO_8601_DATETIME,
+                    dlcs.posts_update()['update']['time'])
+            self._updates[user] = update, time.time()
+            self.requests += 1
+        return update
+
+    def fresh(self, store, resource, dlcs):
+        "Return true if the resource is stored at the latest update time. "
+        return store.get_attr(resource + '-update') == self.latest(dlcs)
+
+    def record(self, store, resource, dlcs):
+        """Note the resource is stored at the latest update time, the store
+        saves it with the next commit.
+        """
+        store.set_attr(resource + '-update', self.latest(dlcs))
+
+    def clear(self):
+        "Forget the shared answers. "
+        self._updates = {}
+
+Updates = UpdateCheck()
+
 
 ### Main
 
@@ -394,12 +458,14 @@ def main(argv):
     if not 'local-files' in conf.sections():        
         # Other default settings:
         conf.add_section('local-files')
-        conf.set('local-files', 'tags', expanduser("~/.dlcs-tags.xml"))
-        conf.set('local-files', 'posts', expanduser("~/.dlcs-posts.xml"))
+        conf.set('local-files', 'store', expanduser(DLCS_STORE))
         conf.write(open(conf_file, 'w'))
     #return "Config written. Just run dlcs again or review the default config first."
 
 
+    if opts.get('page_size'):
+        conf.set('dlcs', 'page_size', opts['page_size'])
+
     ### Merge config items under 'dlcs' with opts
     # conf provides defaults, command line options override
     options = dict(conf.items('dlcs'))
@@ -413,9 +479,13 @@ def main(argv):
     sys.stdout = codecs.getwriter(options['encoding'])(sys.stdout)
     # TODO: run tests, args = [a.decode(options['encoding']) for a in args]
 
+    metrics = None
+    if options.get('metrics'):
+        metrics = pydelicious.RequestMetrics()
+
     # DeliciousAPI instance to pass to the command functions
     dlcs = DeliciousAPI(options['username'], options['password'],
-        codec=options['encoding'])
+        codec=options['encoding'], metrics=metrics)
 
     # TODO: integrate debugwrapper if DEBUG:
     if DEBUG > 2:
@@ -424,11 +494,15 @@ def main(argv):
     ### Defer processing to command function
     cmd = getattr(sys.modules[__name__], cmdid)
     try:
-        return cmd(conf, dlcs, *args, **options)
-    except PyDeliciousException, e:
-        print >> sys.stderr, e
-    except pydelicious.DeliciousError, e:
-        print >> sys.stderr, e
+        try:
+            return cmd(conf, dlcs, *args, **options)
+        except PyDeliciousException, e:
+            print >> sys.stderr, e
+        except pydelicious.DeliciousError, e:
+            print >> sys.stderr, e
+    finally:
+        if metrics:
+            output_metrics(metrics, options['metrics'])
 
 ### Command functions
 
@@ -468,24 +542,26 @@ def info(conf, dlcs, **opts):
     """Default command.
     """
 
-    u = dlcs.posts_update()['update']['time']
-    print "Posts last updated on: %s (UTC)" % time.strftime("%c", u)
+    u = Updates.latest(dlcs)
+    print "Posts last updated on: %s (UTC)" % time.strftime("%c",
+            time.strptime(u, pydelicious.ISO_8601_DATETIME))
+
+    store = cached_store(conf)
 
-    posts_file = conf.get('local-files', 'posts')
-    if exists(posts_file):
-        postsupd = getmtime(posts_file)
+    postsupd = store.cached('posts')
+    if postsupd:
         print "Cached post list on: %s (local)" % time.strftime("%c", time.localtime(postsupd))
     else:
         print "Need to cache post list"
 
-    tags_file = conf.get('local-files', 'tags')
-    if exists(tags_file):
-        tagsupd = getmtime(tags_file)
+    tagsupd = store.cached('tags')
+    if tagsupd:
         print "Cached tag list on: %s (local)" % time.strftime("%c", time.localtime(tagsupd))
     else:
         print "Need to cache tag list"
 
-    if (exists(tags_file) and u > time.gmtime(tagsupd)) or (exists(posts_file) and u > time.gmtime(postsupd)):
+    if (tagsupd and not Updates.fresh(store, 'tags', dlcs)) or \
+            (postsupd and not Updates.fresh(store, 'posts', dlcs)):
         print "Cache is out of date"
 
 def stats(conf, dlcs, **opts):
@@ -493,22 +569,15 @@ def stats(conf, dlcs, **opts):
     """Statistics
     """
 
-    posts = cached_posts(conf, dlcs, opts['keep_cache'])
+    posts = cached_snapshot(conf, dlcs, opts['keep_cache'])
     tags = cached_tags(conf, dlcs, opts['keep_cache'])
 
     # TODO: Some more intel gathering on tags would be nice
-    print "Tags: %s" % len(tags['tags'])
-    print "Posts: %s" % len(posts['posts'])
+    print "Tags: %s" % tags.count_tags()
+    print "Posts: %s" % len(posts)
 
     # Tag usage per post
-    taggedhigh = 0
-    taggedlow = 0
-    for post in posts['posts']:
-        tags = len(post['tag'].split(' '))
-        if not taggedlow or tags < taggedlow:
-            taggedlow = tags
-        if not taggedhigh or tags > taggedhigh:
-            taggedhigh = tags
+    taggedlow, taggedhigh = posts.tags_per_post()
 
     print "Tags per post (min/max): %s/%s" % (taggedlow, taggedhigh)
 
@@ -636,12 +705,9 @@ def posts(conf, dlcs, *urls, **opts):
     """Either prints the ALL URLs or posts of given urls.
     """
 
-    posts = cached_posts(conf, dlcs, opts['keep_cache'])
-    for post in posts['posts']:
-        if urls and not post['href'] in urls:
-            continue
-        else:
-            print output('posts', opts, post)
+    posts = cached_snapshot(conf, dlcs, opts['keep_cache'])
+    for post in posts.posts(urls):
+        print output('posts', opts, post)
 
 def postsupdate(conf, dlcs, **opts):
 
@@ -681,23 +747,29 @@ def getposts(conf, dlcs, *urls, **opts):
 
     print output('getposts', opts, out)
 
-def findposts(conf, dlcs, keyword, **opts):
+def findposts(conf, dlcs, *keywords, **opts):
 
-    """Search all text fields of all posts for the keyword and print machting URLs.
+    """Search all text fields of all posts for the keywords and print
+    matching URLs, best matches first.
 
-        % dlcs findposts keyword
+        % dlcs findposts keyword [keyword...]
+
+    End a keyword with '*' to find any word starting with it, and use
+    'field:keyword' to search only the description, extended, tag or href
+    field. Without --ignore-case the keywords must match case too.
     """
 
     posts = cached_posts(conf, dlcs, opts['keep_cache'])
-    for post in posts['posts']:
-        fields = post['tag']+post['href']+post['description']+post['extended']
+    index = cached_fulltext(conf, dlcs, True)
+    ranked = index.search(keywords)
 
-        if opts['ignore_case']:
-            if fields.lower().find(keyword.lower()) > -1:
-                print post['href']
+    if not opts['ignore_case']:
+        words = [k.split(':')[-1].rstrip('*') for k in keywords]
+        ranked = [(score, h) for score, h in ranked
+            if has_words(posts.get_hash(h), words)]
 
-        elif fields.find(keyword) > -1:
-            print post['href']
+    for href in index.hrefs(ranked):
+        print href
 
 def deleteposts(conf, dlcs, *urls, **opts):
 
@@ -813,38 +885,30 @@ def tag(conf, dlcs, tags, *urls, **opts):
 
         % dlcs tag "tag1 tag2" http://... http://...
 
-    This will retrieve the post for each URL, add the given tags and then
-    replace the post at del.icio.us. URLs not in the collection cause
-    a message to stderr and are ignored.
+    This will fetch the current post for each URL, add the given tags and
+    then replace the posts at del.icio.us. URLs not in the collection cause
+    a message to stderr and are ignored. An interrupted run continues where
+    it stopped when started again, see --journal.
     """
 
+    store = cached_posts(conf, dlcs, opts['keep_cache'])
+    tags = tags.split(' ')
+
+    current = fetch_posts(store, dlcs, urls)
+    operations = []
     for url in urls:
-        posts = dlcs.request('posts/get', url=url)
-        if not posts['posts']:
+        post = current.get(url)
+        if not post:
             print >>sys.stderr, '* URL "%s" not in collection' % (url)
+            continue
 
-        else:
-            post = posts['posts'][0]
-            if not 'extended' in post:
-                post['extended'] = ""
-            if not 'tag' in post:
-                post['tag'] = ""
-            if not 'shared' in post:
-                post['shared'] = "True"
-
-            # XXX: del.icio.us takes care of duplicates...
-            post['tag'] += ' '+tags
-
-            dlcs.posts_add(replace="yes",
-                shared=post['shared'],
-                description=post['description'],
-                extended=post['extended'],
-                url=post['href'],
-                tags=post['tag'],
-                time=post['time'])
-
-            print '* tagged "%s" with "%s"' % (url,
-                post['tag'])
+        tagged = post.get('tag', '').split(' ')
+        tagged += [t for t in tags if t and t not in tagged]
+        post['tag'] = " ".join([t for t in tagged if t])
+        operations.append(replace_operation(post,
+            '* tagged "%s" with "%s"' % (url, post['tag'])))
+
+    bulk_write(store, dlcs, operations, **opts)
 
 def untag(conf, dlcs, tags, *urls, **opts):
 
@@ -861,84 +925,56 @@ def untag(conf, dlcs, tags, *urls, **opts):
         tags = tags.split(' ')
 
     urls = list(urls)
+    store = cached_posts(conf, dlcs, opts['keep_cache'])
 
     if not urls:
-        posts = cached_posts(conf, dlcs, opts['keep_cache'])
-
-        for post in posts['posts']:
-            for tag in tags:
-                if opts['ignore_case']:
-                    post['tag'] = post['tag'].lower()
-                if tag in post['tag'].split(' '):
-                    urls.append(post['href'])
+        index = cached_snapshot(conf, dlcs, True)
+        urls = index.hrefs(index.query(any=tags,
+            ignore_case=opts['ignore_case']))
 
+    current = fetch_posts(store, dlcs, urls)
+    operations = []
     for url in urls:
-        # TODO: fetching posts is inefficient and ignoring the localcache:
-        # Must have indexed access to fields in localcache
-        posts = dlcs.request('posts/get', url=url)
-        if not posts['posts']:
+        post = current.get(url)
+        if not post:
             print >>sys.stderr, '* URL "%s" not in collection' % (url)
+            continue
 
+        if opts['ignore_case']:
+            tagged = post.get('tag', '').lower().split(' ')
         else:
-            post = posts['posts'][0]
-            if not 'extended' in post:
-                post['extended'] = ""
-            if not 'tag' in post:
-                post['tag'] = ""
-            if not 'shared' in post:
-                post['shared'] = "True"
+            tagged = post.get('tag', '').split(' ')
+        untagged = []
 
-            if opts['ignore_case']:
-                tagged = post['tag'].lower().split(' ')
-            else:                    
-                tagged = post['tag'].split(' ')
-            untagged = []
-
-            for tag in tags:
-                if tag in tagged:
-                    tagged.remove(tag)
-                    untagged.append(tag)
-
-            if not untagged:
-                print >>sys.stderr, '* Tags "%s" not found on URL "%s"' % (tags, url)
-                continue
+        for tag in tags:
+            if tag in tagged:
+                tagged.remove(tag)
+                untagged.append(tag)
 
-            post['tag'] = " ".join(tagged)
+        if not untagged:
+            print >>sys.stderr, '* Tags "%s" not found on URL "%s"' % (tags, url)
+            continue
 
-            dlcs.posts_add(replace="yes",
-                shared=post['shared'],
-                description=post['description'],
-                extended=post['extended'],
-                url=post['href'],
-                tags=post['tag'],
-                time=post['time'])
+        post['tag'] = " ".join(tagged)
+        operations.append(replace_operation(post,
+            '* untagged "%s" from "%s"' % (" ".join(untagged), url)))
 
-            print '* untagged "%s" from "%s"' % (" ".join(untagged),
-                url)
+    bulk_write(store, dlcs, operations, **opts)
 
 def tagged(conf, dlcs, *tags, **opts):
 
     """Request all posts for a tag or overlap of tags. Print URLs.
 
-        % dlcs tagged tag [tag2 ...]
+        % dlcs tagged tag[+tag2...] [tag3 ...]
     """
 
-    posts = cached_posts(conf, dlcs, opts['keep_cache'])
-    for post in posts['posts']:
-
-        if opts['ignore_case']:
-            post_tags = post['tag'].lower().split(' ')
-            tags = map(lambda t: t.lower(), tags)
-        else:
-            post_tags = post['tag'].split(' ')
-
-        for tag in tags:
-            if '+' in tag:
-                andq = tag.split('+')
-                if Set(post_tags).issuperset(Set(andq)):
-                    print post['href']
-            elif tag in post_tags:
-                print post['href']
+    index = cached_snapshot(conf, dlcs, opts['keep_cache'])
+    posts = set()
+    for tag in tags:
+        posts |= index.query(all=tag.split('+'),
+                ignore_case=opts['ignore_case'])
+    for href in index.hrefs(posts):
+        print href
 
 
 def tags(conf, dlcs, *count, **opts):
@@ -961,7 +997,7 @@ def tags(conf, dlcs, *count, **opts):
         else:
             count = '='
 
-    for tag in tags['tags']:
+    for tag in tags.tags():
         if count:
             tc = int(tag['count'])
             if count == '=':
@@ -980,34 +1016,19 @@ def tagrel(conf, dlcs, *tags, **opts):
 
     """Print related tags.
 
-    Finds all posts tagged `tags` and gather other tags for post.
+    Finds all posts tagged `tags` and gather other tags for post. Tags are
+    printed in order of the number of posts they share with `tags`.
     """
 
-    reltags = []
+    reltags = {}
 
-    posts = cached_posts(conf, dlcs, opts['keep_cache'])
-    for post in posts['posts']:
+    index = cached_snapshot(conf, dlcs, opts['keep_cache'])
+    for tag in tags:
+        counts = index.related(tag.split('+'), ignore_case=opts['ignore_case'])
+        for ntag, count in counts.items():
+            reltags[ntag] = reltags.get(ntag, 0) + count
 
-        if opts['ignore_case']:
-            post_tags = post['tag'].lower().split(' ')
-            tags = map(lambda t: t.lower(), tags)
-        else:
-            post_tags = post['tag'].split(' ')
-
-
-        for tag in tags:
-            if '+' in tag:
-                andq = tag.split('+')
-                if Set(post_tags).issuperset(Set(andq)):
-                    for ntag in post['tag'].split(' '):
-                        if ntag != tag and not ntag in reltags:
-                            reltags.append(ntag)
-            elif tag in post_tags:
-                for ntag in post['tag'].split(' '):
-                    if ntag != tag and not ntag in reltags:
-                        reltags.append(ntag)
-
-    for tag in reltags:
+    for tag, count in value_sorted(reltags):
         print tag,
 
 def gettags(conf, dlcs, *tags, **opts):
@@ -1018,9 +1039,9 @@ def gettags(conf, dlcs, *tags, **opts):
     if opts['ignore_case']:
         tags = [t.lower() for t in tags]
 
-    for tag in cached_tags(conf, dlcs, opts['keep_cache'])['tags']:
-        if tag['tag'] in findtags or \
-                (opts['ignore_case'] and tag['tag'].lower() in findtags):
+    for tag in cached_tags(conf, dlcs, opts['keep_cache']).tags():
+        if tag['tag'] in tags or \
+                (opts['ignore_case'] and tag['tag'].lower() in tags):
             print jsonwrite(tag)
 
 def findtags(conf, dlcs, *tags, **opts):
@@ -1028,7 +1049,7 @@ def findtags(conf, dlcs, *tags, **opts):
     """Search all tags for (a part of) a tag.
     """
 
-    for tag in cached_tags(conf, dlcs, opts['keep_cache'])['tags']:
+    for tag in cached_tags(conf, dlcs, opts['keep_cache']).tags():
         tag = tag['tag']
 
         for findtag in tags:
@@ -1043,50 +1064,60 @@ def clearcache(conf, dlcs, *clear, **opts):
 
     """Delete all locally cached data::
 
-        % dlcs clear [tags | posts]
+        % dlcs clear [tags | posts | feeds]
     """
 
     if not clear:
-        clear = ['tags', 'posts']
-
-    if 'tags' in clear:
-        try:
-            tags = conf.get('local-files', 'tags')
-            os.unlink(tags)
-            print "* Deleted '%s'" % tags
-        except: pass
-
-    if 'posts' in clear:
-        try:
-            posts = conf.get('local-files', 'posts')
-            os.unlink(posts)
-            print "* Deleted '%s'" % posts
-        except: pass
+        clear = ['tags', 'posts', 'feeds']
+
+    store = cached_store(conf)
+    for resource in 'tags', 'posts':
+        if resource in clear:
+            store.clear(resource)
+            print "* Deleted %s from '%s'" % (resource, store.path)
+    if 'feeds' in clear:
+        cache = cached_responses(conf)
+        cache.clear()
+        print "* Deleted feeds from '%s'" % cache.path
 
 def mates(conf, dlcs, *args, **opts):
 
     """The following was adapted from delicious_mates.
     http://www.aiplayground.org/artikel/delicious-mates/
 
-        % dlcs mates [max_mates[, min_bookmarks[, min_common]]]
+        % dlcs mates [max_mates [min_bookmarks [min_common]]]
 
+    The feeds for the bookmarks and users are fetched concurrently, see
+    `pydelicious.FeedFetcher`.
     """
    
-    max_mates, min_bookmarks, min_common = map(int, opts['mates'].split(','))
+    max_mates, min_bookmarks, min_common = map(int,
+            (list(args) + ['10', '50', '2'][len(args):])[:3])
 
     delicious_users = {}
     posts = cached_posts(conf, dlcs, opts['keep_cache'])
-    print "Getting mates for collection of %i bookmarks" % len(posts['posts'])
+    print "Getting mates for collection of %i bookmarks" % len(posts)
 
-    print "\nUsers for each bookmark:"
-    for i, post in enumerate(posts['posts']):
+    from cache import CacheHandler
+    fetcher = FeedFetcher(handlers=(CacheHandler(cached_responses(conf)),))
 
-        hash = md5.md5(post['href']).hexdigest()
-        #urlfeed = pydelicious.dlcs_feed('urlinfo', urlmd5=hash)
-        posts = dlcs_feed('url', count='all', format='rss', urlmd5=hash)
-        usernames = [e['author'] for e in posts['entries']]
+    print "\nUsers for each bookmark:"
+    hrefs = {}
+    feeds = []
+    for post in posts.posts():
+        hash = md5(post['href']).hexdigest()
+        hrefs[hash] = post['href']
+        feeds.append(('url', {'count': 'all', 'format': 'rss',
+            'urlmd5': hash}))
+
+    for i, (feed, rss, error) in enumerate(fetcher.fetch(feeds)):
+        href = hrefs[feed[1]['urlmd5']]
+        if error:
+            print >>sys.stderr, "    %i. %s: %s" % (i+1, href, error)
+            continue
+        usernames = [e['author'] for e in rss['entries']]
 
-        print "    %i. %s (%i)" % (i+1, post['href'], len(usernames))
+        print "    %i. %s (%i)" % (i+1, href, len(usernames))
        
         for username in usernames:
             if username != dlcs.user:
@@ -1097,11 +1128,26 @@ def mates(conf, dlcs, *args, **opts):
     
     print "\n%i candidates from list of %i users" % (max_mates, len(delicious_users))
     friends = {}
-    for (username, (weight, num_common)) in value_sorted(delicious_users):
-        if num_common >= min_common:
+    candidates = [(username, weight, num_common) for (username,
+        (weight, num_common)) in value_sorted(delicious_users)
+        if num_common >= min_common]
+    # Request the user info of as many candidates at once as there are
+    # fetcher threads, and stop as soon as there are enough mates
+    for i in range(0, len(candidates), fetcher.threads):
+        batch = candidates[i:i+fetcher.threads]
+        info = {}
+        for feed, rss, error in fetcher.fetch([('user_info',
+                {'format': 'rss', 'username': username})
+                for username, weight, num_common in batch]):
+            info[feed[1]['username']] = rss, error
+
+        for username, weight, num_common in batch:
+            rss, error = info[username]
+            if error:
+                print >>sys.stderr, "    %s: %s" % (username, error)
+                continue
 
-            num_bookmarks = float([e['summary'] for e in 
-                dlcs_feed('user_info', format='rss', username='mpe')['entries'] 
+            num_bookmarks = float([e['summary'] for e in rss['entries']
                 if e['id'] == 'items'][0])
 
             print "    %s (%i/%i)" % (username, num_common, num_bookmarks),
@@ -1111,7 +1157,9 @@ def mates(conf, dlcs, *args, **opts):
                     break
             else:
                 print
-            time.sleep(1)
+
+        if len(friends) >= max_mates:
+            break
     
     print "\nTop %i del.icio.us mates:" % max_mates
     print "username".ljust(20), "weight".ljust(20), "# common bookmarks".ljust(20), "# total bookmarks".ljust(20), "% common"
@@ -1126,6 +1174,16 @@ def mates(conf, dlcs, *args, **opts):
 
 
 ### Utils
+def output_metrics(metrics, fn):
+    """
+    Print the request statistics as table to stderr, or write them as JSON
+    to file `fn`.
+    """
+    if fn == '-':
+        print >>sys.stderr, metrics.report()
+    else:
+        open(fn, 'w').write(jsonwrite(metrics.snapshot()))
+
 def http_dump(fl):
 
     """Format fileobject wrapped in urllib.addinfourl as HTTP message string
@@ -1143,44 +1201,217 @@ def cache_file(fn, data):
 def cache_append_posts(fl, ):
     pass
 
+def cached_store(conf):
+    """
+    Open the local store for posts and tags, see `store.PostStore`.
+    """
+    from store import PostStore
+    if conf.has_option('local-files', 'store'):
+        path = conf.get('local-files', 'store')
+    else:
+        path = expanduser(DLCS_STORE)
+    return PostStore(path)
+
+def cached_responses(conf):
+    """
+    Open the HTTP response cache for feeds, see `cache.HTTPCache`.
+    """
+    from cache import HTTPCache, DLCS_CACHE
+    if conf.has_option('local-files', 'cache'):
+        path = conf.get('local-files', 'cache')
+    else:
+        path = expanduser(DLCS_CACHE)
+    return HTTPCache(path)
+
 def cached_tags(conf, dlcs, noupdate=False):
     """
-    Make sure the tag list is cached locally. Updates when the file is
-    older than the last time the posts where updated (according to
-    del.icio.us posts/update, which only notes new posts, not any updates).
+    Make sure the tag list is cached locally and return the store. Updates
+    when the list was fetched before the last time the posts where updated
+    (according to del.icio.us posts/update, which only notes new posts, not
+    any updates). The posts/update answer is shared, see `UpdateCheck`.
     """
-    tags_file = conf.get('local-files', 'tags')
-    if not exists(tags_file):
+    store = cached_store(conf)
+    cached = store.cached('tags')
+    if cached is None:
         print >>sys.stderr, "cached_tags: Fetching new tag list..."
-        cache_file(tags_file, dlcs.tags_get(_raw=True))
+        Updates.record(store, 'tags', dlcs)
+        store.replace_tags(dlcs.tags_get()['tags'])
     else:
         if not noupdate:
-            lastupdate = dlcs.posts_update()['update']['time']
-            if time.gmtime(getmtime(tags_file)) < lastupdate:
+            if not Updates.fresh(store, 'tags', dlcs):
                 print >>sys.stderr, "cached_tags: Updating tag list..."
-                cache_file(tags_file, dlcs.tags_get(_raw=True))
+                Updates.record(store, 'tags', dlcs)
+                store.replace_tags(dlcs.tags_get()['tags'])
         elif DEBUG: print >>sys.stderr, "cached_tags: Forced read from cached file..."
-    tags = dlcs_parse_xml(open(tags_file))
-    return tags
+    return store
 
 def cached_posts(conf, dlcs, noupdate=False):
     """
-    Same as cached_tags but for the post list.
+    Same as cached_tags but for the post list. An existing post list is
+    updated incrementally, see `sync.PostsSync`. With the 'page_size' option
+    set in the 'dlcs' section of the config, a full list is fetched in pages
+    of that many posts.
     """
-    posts_file = conf.get('local-files', 'posts')
-    if not exists(posts_file):
+    store = cached_store(conf)
+    page_size = None
+    if conf.has_option('dlcs', 'page_size'):
+        page_size = conf.getint('dlcs', 'page_size')
+    cached = store.cached('posts')
+    if cached is None:
         print >>sys.stderr, "cached_posts: Fetching new post list..."
-        cache_file(posts_file, dlcs.posts_all(_raw=True))
+        Updates.record(store, 'posts', dlcs)
+        if page_size:
+            store.replace(post for page in
+                    dlcs.posts_pages(results=page_size) for post in page)
+        else:
+            store.replace(dlcs.iter_posts_all())
+        store.commit()
+        snapshot_posts(store)
     else:
         if not noupdate:
-            lastupdate = dlcs.posts_update()['update']['time']
-            if time.gmtime(getmtime(posts_file)) < lastupdate:
+            if not Updates.fresh(store, 'posts', dlcs):
                 print >>sys.stderr, "cached_posts: Updating post list..."
-                cache_file(posts_file, dlcs.posts_all(_raw=True))
+                Updates.record(store, 'posts', dlcs)
+                from sync import PostsSync
+                sync = PostsSync(dlcs, store, page_size=page_size)
+                sync.sync()
+                snapshot_posts(store)
+                if DEBUG: print >>sys.stderr, \
+                    "cached_posts: %i new, %i changed, %i removed posts" % (
+                        sync.added, sync.changed, sync.removed)
         elif DEBUG: print >>sys.stderr, "cached_posts: Forced read from cached file..."
-    posts = dlcs_parse_xml(open(posts_file))
+    return store
+
+def snapshot_posts(store):
+    """
+    Write the snapshot of the posts in the store, see
+    `snapshot.write_snapshot`.
+    """
+    from snapshot import write_snapshot
+    if DEBUG: print >>sys.stderr, "snapshot_posts: Writing snapshot..."
+    write_snapshot(store.path + '.snap', store.posts(), store.cached('posts'))
+
+def cached_snapshot(conf, dlcs, noupdate=False):
+    """
+    Return the memory-mapped snapshot of the cached posts, see
+    `snapshot.Snapshot`. The snapshot is written by cached_posts when the
+    posts are updated, and here if it is missing or out of date.
+    """
+    from snapshot import Snapshot
+    store = cached_posts(conf, dlcs, noupdate)
+    path = store.path + '.snap'
+    if exists(path):
+        try:
+            snapshot = Snapshot(path)
+        except ValueError:
+            pass
+        else:
+            if snapshot.stamp == store.cached('posts'):
+                return snapshot
+            snapshot.close()
+    snapshot_posts(store)
+    return Snapshot(path)
+
+def cached_fulltext(conf, dlcs, noupdate=False):
+    """
+    Return the full-text index for the cached posts, see
+    `fulltext.FullTextIndex`. The index is kept in a file next to the store,
+    only new and changed posts are indexed after an update.
+    """
+    from fulltext import FullTextIndex
+    store = cached_posts(conf, dlcs, noupdate)
+    stamp = store.cached('posts')
+    index_file = store.path + '.ftidx'
+    if exists(index_file):
+        index = FullTextIndex.load(index_file)
+        if index.stamp == stamp:
+            return index
+    else:
+        index = FullTextIndex()
+    changes = index.sync(store.posts())
+    if DEBUG: print >>sys.stderr, \
+        "cached_fulltext: Indexed %i changed posts" % changes
+    index.stamp = stamp
+    index.save(index_file)
+    return index
+
+def fetch_posts(store, dlcs, urls, batch=None):
+    """
+    Return the current posts for the URLs as a dictionary by URL, requested
+    from del.icio.us in batches of posts/get?hashes=... calls. The fetched
+    posts are updated in the store, URLs not in the collection are left out.
+    """
+    from sync import DLCS_HASHES_BATCH
+    batch = batch or DLCS_HASHES_BATCH
+    hashes = [md5(url).hexdigest() for url in urls]
+    posts = {}
+    for i in range(0, len(hashes), batch):
+        fetched = dlcs.posts_get(hashes=hashes[i:i+batch], meta=True)['posts']
+        store.update(fetched)
+        for post in fetched:
+            posts[post['href']] = post
     return posts
 
+def replace_operation(post, message=None):
+    """
+    Return a `DeliciousAPI.posts_bulk` operation that replaces the post at
+    del.icio.us with `post`. `message` is printed once it is done.
+    """
+    return 'replace', {
+        'url': post['href'],
+        'description': post.get('description', ''),
+        'extended': post.get('extended', ''),
+        'tags': post.get('tag', ''),
+        'dt': post.get('time', ''),
+        'shared': post.get('shared') != 'no',
+    }, message
+
+def bulk_write(store, dlcs, operations, **opts):
+    """
+    Perform a list of ``(action, params, message)`` operations using
+    `DeliciousAPI.posts_bulk`. Prints the message for every operation done,
+    and errors to stderr. Progress is journaled to the --journal file, or
+    next to the store.
+
+    Every operation done is applied to the store as well. The store is
+    committed when done, which outdates the snapshot and the full-text index
+    of the cached posts, the snapshot is rewritten right away.
+    """
+    journal = opts.get('journal')
+    if not journal:
+        journal = store.path + '.journal'
+    ops = dict([(params['url'], (params, message))
+        for action, params, message in operations])
+    applied = 0
+    try:
+        for url, action, status in dlcs.posts_bulk(
+                [(action, params) for action, params, message in operations],
+                journal=journal):
+            if status in ('done', 'journal'):
+                params, message = ops[url]
+                store.apply(action, params)
+                applied += 1
+                if message:
+                    print message
+            else:
+                print >>sys.stderr, '* %s "%s" failed: %s' % (action, url,
+                        status)
+    finally:
+        if applied:
+            store.commit()
+            snapshot_posts(store)
+
+def has_words(post, words):
+    """
+    Return true if every word occurs in the text fields of the post.
+    """
+    text = " ".join([post.get(f, '') for f in ('tag', 'href', 'description',
+        'extended')])
+    for word in words:
+        if word not in text:
+            return False
+    return True
+
 def value_sorted(dic):
     """
     Return dic.items(), sorted by the values stored in the dictionary.
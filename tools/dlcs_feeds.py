@@ -25,6 +25,7 @@ __options__ = [
 	(('-L', '--list-feeds'),{'action':'store_true','help':'List available feeds for given parameters. '}),
 	(('-f', '--format'),{'default':'rss'}),
 	(('-k', '--key'),{}),
+	(('-p', '--parse'),{'action':'store_true','help':'Print the records of the feed as they are read. '}),
 	(('-l', '--url'),{}),
 	(('-H', '--urlmd5'),{}),
 	(('-t', '--tag'),{'dest':'tags','action':'append'}),
@@ -97,6 +98,10 @@ def main(argv):
 			print >>sys.stderr, "Multiple paths for given parameters, see -L"
 			sys.exit()
 	assert path in pydelicious.delicious_v2_feeds
+	if opts.parse:
+		for record in pydelicious.dlcs_iter_feed(path, **kwds):
+			pprint(record)
+		return
 	return pydelicious.dlcs_feed(path, **kwds)
 
 def _main():
@@ -0,0 +1,200 @@
+"""Full-text index over the text fields of a bookmark collection.
+
+``FullTextIndex`` tokenizes the description, extended, tag and href fields
+of every post into case-folded terms and keeps per-field postings (term ->
+post -> term frequency). Queries are sets of terms that must all match,
+``term*`` matches any term with that prefix and ``field:term`` restricts a
+term to one field. Results are ranked by TF-IDF, weighted per field.
+
+The index records the meta signature of every post, so ``sync()`` only
+re-tokenizes posts that changed since the index was built.
+"""
+import re
+import math
+import marshal
+from bisect import bisect_left
+
+
+FIELD_WEIGHTS = {
+    'description': 3.0,
+    'tag': 2.0,
+    'extended': 1.0,
+    'href': 1.0,
+}
+"Relative weight of a term occurring in each field"
+
+tokenize = re.compile(r'\w+', re.UNICODE).findall
+
+
+class FullTextIndex:
+
+    """Inverted index of terms in the text fields of posts.
+
+    Some attributes:
+    :stamp: a value identifying the version of the collection indexed
+    :postings: maps field to a dictionary of term -> {URL MD5: frequency}
+    :docs: maps URL MD5 to a tuple with href, time, meta signature and the
+        (field, term) pairs indexed for the post
+    """
+
+    def __init__(self, stamp=None, weights=FIELD_WEIGHTS):
+        self.stamp = stamp
+        self.weights = weights
+        self.postings = dict([(f, {}) for f in weights])
+        self.docs = {}
+        self._terms = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, post):
+        "Add or replace a post (a dictionary as parsed from the API). "
+        h = post['hash']
+        if h in self.docs:
+            self.remove(h)
+        indexed = {}
+        for field, postings in self.postings.items():
+            for term in tokenize((post.get(field) or '').lower()):
+                docs = postings.setdefault(term, {})
+                docs[h] = docs.get(h, 0) + 1
+                indexed[field, term] = True
+        self.docs[h] = (post['href'], post.get('time'), post.get('meta'),
+                tuple(indexed))
+        self._terms = None
+
+    def remove(self, h):
+        href, time, meta, indexed = self.docs.pop(h)
+        for field, term in indexed:
+            docs = self.postings[field][term]
+            del docs[h]
+            if not docs:
+                del self.postings[field][term]
+        self._terms = None
+
+    def sync(self, posts):
+        """Bring the index up to date with the collection `posts`, only
+        (re)indexing new and changed posts. Returns the number of changes.
+        """
+        changes = 0
+        seen = {}
+        for post in posts:
+            h = post['hash']
+            seen[h] = True
+            if h not in self.docs or self.docs[h][2] != post.get('meta') \
+                    or post.get('meta') is None:
+                self.add(post)
+                changes += 1
+        for h in self.docs.keys():
+            if h not in seen:
+                self.remove(h)
+                changes += 1
+        return changes
+
+    def terms(self):
+        "Return a sorted list of all terms. "
+        if self._terms is None:
+            terms = {}
+            for postings in self.postings.values():
+                terms.update(postings)
+            self._terms = terms.keys()
+            self._terms.sort()
+        return self._terms
+
+    def expand(self, prefix):
+        "Return all indexed terms starting with `prefix`. "
+        terms = self.terms()
+        i = bisect_left(terms, prefix)
+        matches = []
+        while i < len(terms) and terms[i].startswith(prefix):
+            matches.append(terms[i])
+            i += 1
+        return matches
+
+    def search(self, query):
+        """Return a list of (score, URL MD5) for all posts matching every term
+        in `query` (a string or list of terms), best match first.
+        """
+        if isinstance(query, basestring):
+            query = query.split()
+        n = float(len(self.docs))
+        result = None
+        for qterm in query:
+            fields = self.postings.keys()
+            if ':' in qterm:
+                field, qterm = qterm.split(':', 1)
+                if field in self.postings:
+                    fields = [field]
+            prefix = qterm.endswith('*')
+            words = tokenize(qterm.lower())
+            if not words:
+                continue
+
+            scores = None
+            for i, word in enumerate(words):
+                if prefix and i == len(words) - 1:
+                    terms = self.expand(word)
+                else:
+                    terms = [word]
+                wscores = {}
+                for field in fields:
+                    postings = self.postings[field]
+                    weight = self.weights[field]
+                    for term in terms:
+                        docs = postings.get(term, {})
+                        if not docs:
+                            continue
+                        idf = math.log(1 + n / len(docs))
+                        for h, tf in docs.items():
+                            wscores[h] = wscores.get(h, 0) + weight * tf * idf
+                scores = intersect(scores, wscores)
+
+            result = intersect(result, scores or {})
+            if not result:
+                return []
+
+        if not result:
+            return []
+        ranked = [(score, h) for h, score in result.items()]
+        ranked.sort(key=lambda r: (-r[0], r[1]))
+        return ranked
+
+    def hrefs(self, ranked):
+        "Return the URLs for a ranked result. "
+        return [self.docs[h][0] for score, h in ranked]
+
+    ## Persistence
+
+    def save(self, path):
+        data = {'stamp': self.stamp, 'docs': self.docs,
+            'postings': self.postings}
+        fl = open(path, 'wb')
+        try:
+            marshal.dump(data, fl)
+        finally:
+            fl.close()
+
+    def load(klass, path, weights=FIELD_WEIGHTS):
+        fl = open(path, 'rb')
+        try:
+            data = marshal.load(fl)
+        finally:
+            fl.close()
+        index = klass(data['stamp'], weights)
+        index.docs = data['docs']
+        index.postings.update(data['postings'])
+        return index
+    load = classmethod(load)
+
+    def from_posts(klass, posts, stamp=None):
+        index = klass(stamp)
+        for post in posts:
+            index.add(post)
+        return index
+    from_posts = classmethod(from_posts)
+
+
+def intersect(scores, other):
+    "Combine two score dictionaries, keeping keys present in both. "
+    if scores is None:
+        return other
+    return dict([(h, s + other[h]) for h, s in scores.items() if h in other])
@@ -0,0 +1,239 @@
+"""Synchronizes the local stores of many del.icio.us accounts at once.
+
+The API throttles each user separately, so every account gets a
+``DeliciousAPI`` with its own opener and ``TokenBucket`` instead of waiting
+behind the shared ``pydelicious.Waiter`` for all other accounts. An optional
+global rate caps the requests of all accounts together.
+
+``SyncScheduler.run()`` first asks every account for its ``posts/update``
+time, and then brings the stores of the accounts that changed up to date
+with ``sync.PostsSync``, the most recently changed first. Both steps run on
+a pool of worker threads, or of processes to parse the documents in
+parallel as well, so the time of a run grows with the number of accounts
+divided by the number of workers.
+"""
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import pydelicious
+from pydelicious import DeliciousAPI, TokenBucket
+
+from sync import PostsSync
+
+
+DLCS_SCHEDULER_WORKERS = 4
+"Number of accounts requested at the same time"
+DLCS_ACCOUNT_RATE = 1.0 / pydelicious.DLCS_WAIT_TIME
+"Requests per second per account"
+
+
+class AccountLimiter:
+
+    """Rate limiter for the opener of one account, waits for the account's
+    ``TokenBucket`` and then for the `shared` one, if any. When the server
+    throttles the account only the account's bucket backs off.
+    """
+
+    def __init__(self, account, shared=None):
+        self.account = account
+        self.shared = shared
+
+    def __call__(self):
+        wait = self.account()
+        if self.shared:
+            wait += self.shared()
+        return wait
+
+    def backoff(self, delay=None):
+        self.account.backoff(delay)
+
+
+class Account:
+
+    """An account of a ``SyncScheduler``.
+
+    Some attributes:
+    :user: the del.icio.us user name
+    :path: the location of the local store
+    :update: the ``posts/update`` time of the last sync, or None
+    :latest: the ``posts/update`` time of the last check, or None
+    :synced: the local time of the last successful sync, or None
+    :last_request: the local time of the last request, or 0
+    :error: the exception of the last failed check or sync, or None
+    :stats: the added, changed, removed and requests counts of the last sync
+    """
+
+    def __init__(self, user, passwd, path, update=None):
+        self.user = user
+        self.passwd = passwd
+        self.path = path
+        self.update = update
+        self.latest = None
+        self.synced = None
+        self.last_request = 0
+        self.error = None
+        self.stats = {}
+
+
+class SyncScheduler:
+
+    """Keeps the local stores of a number of accounts in sync.
+
+    Accounts are added with ``add()``, each with the path of its store, a
+    `store_class` instance (by default ``store.PostStore``, or e.g.
+    ``sync.XMLPostsFile``) that is opened by the worker syncing the account.
+    Requests are limited to `rate` per second per account, and with
+    `global_rate` to that many for all accounts. With `processes` the
+    workers are processes and each gets an equal part of the global rate.
+    With `page_size` full syncs request the posts in pages of that size, see
+    ``sync.PostsSync``.
+
+    Some attributes:
+    :accounts: maps user name to ``Account``
+    :workers: the number of accounts handled at the same time
+    """
+
+    def __init__(self, workers=DLCS_SCHEDULER_WORKERS, rate=DLCS_ACCOUNT_RATE,
+            global_rate=None, processes=False, store_class=None,
+            api_options=None, page_size=None):
+        if store_class is None:
+            from store import PostStore as store_class
+        self.accounts = {}
+        self.workers = workers
+        self.rate = rate
+        self.global_rate = global_rate
+        self.processes = processes
+        self.store_class = store_class
+        self.api_options = api_options or {}
+        self.page_size = page_size
+        self.shared = None
+        if global_rate:
+            self.shared = TokenBucket(global_rate, workers)
+        self._clients = {}
+
+    def add(self, user, passwd, path, update=None):
+        """Add an account. `update` is the ``posts/update`` time of the last
+        sync, if known; it is only synced again after that changed.
+        """
+        self.accounts[user] = Account(user, passwd, path, update)
+
+    def changed(self, account):
+        "Return True if the account changed since its last sync. "
+        return account.latest != account.update
+
+    def remove(self, user):
+        del self.accounts[user]
+        client = self._clients.pop(user, None)
+        if client:
+            self._close(client)
+
+    def run(self, force=False):
+        """Check all accounts and sync the changed ones, or all of them
+        with `force`. Returns the list of synced accounts, in the order
+        their syncs were started.
+        """
+        if self.processes:
+            # Workers get a copy of the scheduler, the tasks carry the state
+            # of the accounts
+            pool = Pool(self.workers, _init_worker, (self,))
+            scheduler = None
+        else:
+            pool = ThreadPool(self.workers)
+            scheduler = self
+        try:
+            accounts = self.accounts.values()
+            for user, result in pool.imap_unordered(_run_task,
+                    [('check', scheduler, a) for a in accounts]):
+                self._result(user, result)
+
+            due = [a for a in accounts
+                    if not a.error and (force or self.changed(a))]
+            # Changed accounts first, the most recently changed first
+            due.sort(key=lambda a: (self.changed(a), a.latest), reverse=True)
+            for user, result in pool.imap_unordered(_run_task,
+                    [('sync', scheduler, a) for a in due]):
+                self._result(user, result)
+        finally:
+            pool.close()
+            pool.join()
+        return due
+
+    def close(self):
+        "Close the idle connections of the accounts. "
+        for client in self._clients.values():
+            self._close(client)
+        self._clients = {}
+
+    def _close(self, client):
+        # clients built with ``keepalive=False`` have no connections to close
+        if getattr(client._opener, 'keepalive', None) is not None:
+            client._opener.keepalive.close()
+
+    def client(self, account):
+        "Return the ``DeliciousAPI`` for an account, created on first use. "
+        client = self._clients.get(account.user)
+        if client is None:
+            limiter = AccountLimiter(TokenBucket(self.rate), self.shared)
+            client = DeliciousAPI(account.user, account.passwd,
+                    rate_limiter=limiter, **self.api_options)
+            self._clients[account.user] = client
+        return client
+
+    def check(self, account):
+        """Request the ``posts/update`` time of an account, returns the new
+        values of its 'latest' and 'last_request' attributes.
+        """
+        latest = self.client(account).posts_update()['update']['time']
+        return {'latest': latest, 'last_request': time.time()}
+
+    def sync(self, account):
+        """Sync the store of an account, returns the new values of its
+        'update', 'synced', 'stats' and 'last_request' attributes.
+        """
+        client = self.client(account)
+        # The account may have been checked from another worker process
+        wait = account.last_request + 1.0 / self.rate - time.time()
+        if self.processes and wait > 0:
+            time.sleep(wait)
+        store = self.store_class(account.path)
+        try:
+            sync = PostsSync(client, store, page_size=self.page_size)
+            sync.sync()
+        finally:
+            if hasattr(store, 'close'):
+                store.close()
+        return {'update': account.latest, 'last_request': time.time(),
+                'synced': time.time(), 'stats': {'added': sync.added,
+                    'changed': sync.changed, 'removed': sync.removed,
+                    'requests': sync.requests}}
+
+    def _result(self, user, result):
+        account = self.accounts[user]
+        if isinstance(result, Exception):
+            account.error = result
+            return
+        account.error = None
+        for name, value in result.items():
+            setattr(account, name, value)
+
+
+_scheduler = None
+"The copy of the ``SyncScheduler`` in a worker process"
+
+def _init_worker(scheduler):
+    global _scheduler
+    _scheduler = scheduler
+    # Each process gets its part of the global rate
+    if scheduler.global_rate:
+        scheduler.shared = TokenBucket(
+                float(scheduler.global_rate) / scheduler.workers)
+    scheduler._clients = {}
+
+def _run_task((method, scheduler, account)):
+    if scheduler is None:
+        scheduler = _scheduler
+    try:
+        return account.user, getattr(scheduler, method)(account)
+    except Exception, e:
+        return account.user, e
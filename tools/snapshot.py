@@ -0,0 +1,314 @@
+"""Memory-mapped snapshot of a bookmark collection.
+
+A snapshot is a read-only copy of the posts of a ``store.PostStore`` in one
+binary file, that is mapped into memory instead of being read and parsed.
+Queries decode only the posts and strings they return, so commands answer
+in about the same time for small and large collections.
+
+The file is columnar: every distinct string is kept once in a string table,
+each post field is an array of string numbers, and tags are linked to posts
+by arrays of post and tag numbers with offsets. All numbers are unsigned
+32-bit little-endian integers::
+
+    header      magic, stamp, counts and section offsets, see ``HEADER``
+    strings     string offsets (one more than strings), UTF-8 strings
+    columns     a string number per post for each of ``POST_FIELDS``
+    post tags   tag offsets (one more than posts), tag numbers
+    tags        a string number per tag, sorted by tag
+    tag posts   post offsets (one more than tags), post numbers
+    hrefs       post numbers sorted by URL
+
+Posts are numbered in the order of the store, most recent first.
+``Snapshot`` answers the tag queries of ``tagindex.TagIndex`` (see
+``tagindex.TagQueries``) with sets of post numbers instead of URL MD5s, and the post queries of ``store.PostStore``
+used by `dlcs`.
+"""
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+try:
+    # Python >= 2.4
+    assert set and frozenset
+except (NameError, AssertionError):
+    from sets import Set as set, ImmutableSet as frozenset
+
+from store import POST_FIELDS, split_tags
+from tagindex import TagQueries
+
+
+MAGIC = 'DLCSNAP1'
+"Identifies the file format and its version"
+HEADER = struct.Struct('<8sd4I9I')
+"Magic, stamp, the numbers of posts, strings, tags and tag postings, and the\
+ offsets of the nine arrays and tables that follow"
+NONE = 0xFFFFFFFF
+"String number of missing fields"
+
+_uint32 = struct.Struct('<I')
+_uint32_pair = struct.Struct('<2I')
+
+
+def uint32s(values=()):
+    "Return an array of unsigned 32-bit integers. "
+    if array('I').itemsize == 4:
+        return array('I', values)
+    return array('L', values)
+
+def write_uint32s(fl, ints):
+    if sys.byteorder == 'big':
+        ints = array(ints.typecode, ints)
+        ints.byteswap()
+    ints.tofile(fl)
+
+def read_uint32s(data):
+    ints = uint32s()
+    ints.fromstring(data)
+    if sys.byteorder == 'big':
+        ints.byteswap()
+    return ints
+
+
+def write_snapshot(path, posts, stamp=None):
+    """Write the posts (dictionaries as returned by ``store.PostStore``) to
+    a snapshot file. `stamp` is a number identifying the version of the
+    collection, e.g. the time the posts where cached. The file is replaced
+    at once, snapshots opened before stay valid.
+    """
+    strings = {}
+    def number(value):
+        if value is None:
+            return NONE
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        n = strings.get(value)
+        if n is None:
+            n = strings[value] = len(strings)
+        return n
+
+    columns = [uint32s() for field in POST_FIELDS]
+    post_tags = []
+    for post in posts:
+        for column, field in zip(columns, POST_FIELDS):
+            column.append(number(post.get(field)))
+        tags = split_tags(post.get('tag'))
+        post_tags.append(set([number(t) for t in tags]))
+
+    table = [None] * len(strings)
+    for value, n in strings.iteritems():
+        table[n] = value
+    strings.clear()
+
+    # Tags sorted by tag, posts refer to tags by position
+    tags = list(set().union(*post_tags))
+    tags.sort(key=table.__getitem__)
+    position = dict([(n, i) for i, n in enumerate(tags)])
+
+    post_tag_offsets = uint32s([0])
+    post_tag_list = uint32s()
+    tag_posts = [uint32s() for tag in tags]
+    for i, numbers in enumerate(post_tags):
+        positions = [position[n] for n in numbers]
+        positions.sort()
+        post_tag_list.extend(positions)
+        post_tag_offsets.append(len(post_tag_list))
+        for p in positions:
+            tag_posts[p].append(i)
+    tag_post_offsets = uint32s([0])
+    tag_post_list = uint32s()
+    for postings in tag_posts:
+        tag_post_list.extend(postings)
+        tag_post_offsets.append(len(tag_post_list))
+    del tag_posts
+
+    hrefs = range(len(post_tags))
+    href_column = columns[POST_FIELDS.index('href')]
+    hrefs.sort(key=lambda i: table[href_column[i]])
+
+    string_offsets = uint32s([0])
+    size = 0
+    for value in table:
+        size += len(value)
+        string_offsets.append(size)
+
+    sections = [
+        (string_offsets, table),
+        (sum(columns, uint32s()),),
+        (post_tag_offsets, post_tag_list),
+        (uint32s(tags),),
+        (tag_post_offsets, tag_post_list),
+        (uint32s(hrefs),),
+    ]
+
+    tmp = '%s.%i.tmp' % (path, os.getpid())
+    fl = open(tmp, 'wb')
+    try:
+        fl.seek(HEADER.size)
+        offsets = []
+        for section in sections:
+            for part in section:
+                offsets.append(fl.tell())
+                if isinstance(part, array):
+                    write_uint32s(fl, part)
+                else:
+                    fl.write(''.join(part))
+                    # Keep the following integers aligned
+                    fl.write('\0' * (-fl.tell() % 4))
+        fl.seek(0)
+        fl.write(HEADER.pack(MAGIC, stamp or 0, len(post_tags), len(table),
+            len(tags), len(tag_post_list), *offsets))
+    finally:
+        fl.close()
+    os.rename(tmp, path)
+
+
+class Snapshot(TagQueries):
+
+    """Read-only, memory-mapped snapshot file written by ``write_snapshot()``.
+
+    Some attributes:
+    :path: the snapshot file
+    :stamp: the stamp of the collection version
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fl = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fl.close()
+        header = HEADER.unpack_from(self._map, 0)
+        if header[0] != MAGIC:
+            self.close()
+            raise ValueError, "Not a snapshot: %s" % path
+        self.stamp = header[1]
+        self._posts, self._strings, self._tags, self._postings = header[2:6]
+        (self._string_offsets, self._string_data, self._columns,
+            self._post_tag_offsets, self._post_tag_list, self._tag_strings,
+            self._tag_post_offsets, self._tag_post_list,
+            self._hrefs) = header[6:]
+        self._tag_names = None
+        self._folded = None
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._posts
+
+    ## Posts, like store.PostStore
+
+    def post(self, i):
+        "Return post number `i` as dictionary. "
+        post = {}
+        for j, field in enumerate(POST_FIELDS):
+            n = self._int(self._columns, j * self._posts + i)
+            if n != NONE:
+                post[field] = self._string(n)
+        return post
+
+    def posts(self, hrefs=()):
+        """Iterate over all posts, most recent first, or over the posts for
+        the given URLs.
+        """
+        if hrefs:
+            found = [self._find(href) for href in hrefs]
+            numbers = [i for i in found if i is not None]
+            numbers.sort()
+        else:
+            numbers = xrange(self._posts)
+        for i in numbers:
+            yield self.post(i)
+
+    def get(self, href):
+        "Return the post for URL, or None. "
+        i = self._find(href)
+        if i is not None:
+            return self.post(i)
+
+    def tags_per_post(self):
+        "Return the minimum and maximum number of tags on a post. "
+        if not self._posts:
+            return None, None
+        offsets = self._ints(self._post_tag_offsets, 0, self._posts + 1)
+        counts = [offsets[i+1] - offsets[i] for i in xrange(self._posts)]
+        return min(counts), max(counts)
+
+    def count_tags(self):
+        return self._tags
+
+    ## Tag queries of tagindex.TagQueries, with post numbers
+
+    def _posts_tagged(self, tag):
+        t = self.tag_names().get(tag)
+        if t is None:
+            return ()
+        start, end = _uint32_pair.unpack_from(self._map,
+                self._tag_post_offsets + 4 * t)
+        return self._ints(self._tag_post_list, start, end - start)
+
+    def _all_tags(self):
+        return self.tag_names()
+
+    def _count_tags(self, posts):
+        counts = {}
+        offsets = self._ints(self._post_tag_offsets, 0, self._posts + 1)
+        post_tags = self._ints(self._post_tag_list, 0, self._postings)
+        for i in posts:
+            for t in post_tags[offsets[i]:offsets[i+1]]:
+                counts[t] = counts.get(t, 0) + 1
+        return dict([(self._tag(t), count) for t, count in counts.items()])
+
+    def hrefs(self, posts):
+        "Return the URLs for a set of posts, most recent first. "
+        column = self._ints(self._columns,
+                POST_FIELDS.index('href') * self._posts, self._posts)
+        return [self._string(column[i]) for i in sorted(posts)]
+
+    def tag_names(self):
+        "Return a mapping of the tags to their numbers. "
+        if self._tag_names is None:
+            self._tag_names = dict([(self._tag(t), t)
+                for t in xrange(self._tags)])
+        return self._tag_names
+
+    def _tag(self, t):
+        return self._string(self._int(self._tag_strings, t))
+
+    def _find(self, href):
+        "Return the number of the post for URL, or None. "
+        if isinstance(href, unicode):
+            href = href.encode('utf-8')
+        column = POST_FIELDS.index('href') * self._posts
+        lo, hi = 0, self._posts
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = self._int(self._hrefs, mid)
+            if self._bytes(self._int(self._columns, column + i)) < href:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._posts:
+            i = self._int(self._hrefs, lo)
+            if self._bytes(self._int(self._columns, column + i)) == href:
+                return i
+
+    def _int(self, offset, i):
+        return _uint32.unpack_from(self._map, offset + 4 * i)[0]
+
+    def _ints(self, offset, i, count):
+        start = offset + 4 * i
+        return read_uint32s(self._map[start:start + 4 * count])
+
+    def _bytes(self, n):
+        start, end = _uint32_pair.unpack_from(self._map,
+                self._string_offsets + 4 * n)
+        return self._map[self._string_data + start:self._string_data + end]
+
+    def _string(self, n):
+        return self._bytes(n).decode('utf-8')
@@ -0,0 +1,259 @@
+"""Local del.icio.us bookmark store backed by SQLite.
+
+Keeps posts and tags as parsed by ``pydelicious.dlcs_parse_xml`` in an
+indexed database, so lookups by URL, URL hash, tag or date don't need to
+parse and scan the entire collection. ``PostStore`` implements the store
+interface of ``sync.PostsSync``.
+"""
+import time
+
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    import sqlite3
+except ImportError:
+    # Python 2.4
+    from pysqlite2 import dbapi2 as sqlite3
+
+
+POST_FIELDS = ('hash', 'href', 'meta', 'description', 'extended', 'tag',
+        'time', 'shared', 'others')
+"Post attributes kept by the store, other attributes are dropped"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    hash TEXT PRIMARY KEY,
+    href TEXT NOT NULL,
+    meta TEXT,
+    description TEXT,
+    extended TEXT,
+    tag TEXT,
+    time TEXT,
+    shared TEXT,
+    others TEXT
+);
+CREATE INDEX IF NOT EXISTS posts_href ON posts (href);
+CREATE INDEX IF NOT EXISTS posts_time ON posts (time);
+
+CREATE TABLE IF NOT EXISTS post_tags (
+    hash TEXT NOT NULL,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS post_tags_hash ON post_tags (hash);
+CREATE INDEX IF NOT EXISTS post_tags_tag ON post_tags (tag);
+CREATE INDEX IF NOT EXISTS post_tags_tag_nocase
+    ON post_tags (tag COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY,
+    count INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS attrs (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class PostStore:
+
+    """SQLite database with the posts and tags of one collection.
+
+    Posts are returned as dictionaries with the same keys as the attributes
+    of the post elements in the API responses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    ## Collection attributes
+
+    def get_attr(self, key, default=None):
+        row = self.db.execute("SELECT value FROM attrs WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_attr(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO attrs VALUES (?, ?)",
+                (key, value))
+
+    ## Store interface for sync.PostsSync
+
+    def signatures(self):
+        return dict(self.db.execute("SELECT hash, meta FROM posts"))
+
+    def update(self, posts):
+        for post in posts:
+            h = post['hash']
+            self.db.execute("DELETE FROM post_tags WHERE hash = ?", (h,))
+            self.db.execute("INSERT OR REPLACE INTO posts VALUES (%s)" %
+                    ", ".join("?" * len(POST_FIELDS)),
+                    [post.get(k) for k in POST_FIELDS])
+            self.db.executemany("INSERT INTO post_tags VALUES (?, ?)",
+                    [(h, t) for t in split_tags(post.get('tag'))])
+
+    def remove(self, hashes):
+        for h in hashes:
+            self.db.execute("DELETE FROM posts WHERE hash = ?", (h,))
+            self.db.execute("DELETE FROM post_tags WHERE hash = ?", (h,))
+
+    def replace(self, posts):
+        self.db.execute("DELETE FROM posts")
+        self.db.execute("DELETE FROM post_tags")
+        self.update(posts)
+
+    def commit(self, **attrs):
+        for k, v in attrs.items():
+            self.set_attr(k, v)
+        self.set_attr('posts-cached', time.time())
+        self.db.commit()
+
+    def clear(self, resource='posts'):
+        "Delete all locally stored posts or tags. "
+        if resource == 'posts':
+            self.db.execute("DELETE FROM posts")
+            self.db.execute("DELETE FROM post_tags")
+        else:
+            self.db.execute("DELETE FROM tags")
+        self.db.execute("DELETE FROM attrs WHERE key = ?",
+                (resource+'-cached',))
+        self.db.commit()
+
+    def apply(self, action, params):
+        """Apply a `DeliciousAPI.posts_bulk` operation that was performed at
+        del.icio.us to the stored posts. The post gets no 'meta' signature,
+        so the next sync fetches it again.
+        """
+        url = params['url']
+        row = self.db.execute("SELECT hash FROM posts WHERE href = ?",
+                (url,)).fetchone()
+        if action == 'delete':
+            if row:
+                self.remove([row[0]])
+            return
+        if row:
+            h = row[0]
+        else:
+            h = md5(isinstance(url, unicode) and url.encode('utf8') or url
+                    ).hexdigest()
+        shared = params.get('shared', True)
+        self.update([{'hash': h, 'href': url,
+            'description': params.get('description'),
+            'extended': params.get('extended') or None,
+            'tag': params.get('tags') or None,
+            'time': params.get('dt') or None,
+            'shared': shared in (False, 'no') and 'no' or None}])
+
+    def replace_tags(self, tags):
+        "Replace the tag list with the ``tags/get`` result ``tags``. "
+        self.db.execute("DELETE FROM tags")
+        self.db.executemany("INSERT INTO tags VALUES (?, ?)",
+                [(t['tag'], int(t['count'])) for t in tags])
+        self.set_attr('tags-cached', time.time())
+        self.db.commit()
+
+    ## Queries
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM posts").fetchone()[0]
+
+    def cached(self, resource='posts'):
+        """Return the local time at which the posts or tags where last stored,
+        or None.
+        """
+        t = self.get_attr(resource+'-cached')
+        if t is not None:
+            return float(t)
+
+    def posts(self, hrefs=()):
+        """Iterate over all posts, most recent first, or over the posts for
+        the given URLs.
+        """
+        if hrefs:
+            return self._posts("WHERE href IN (%s) ORDER BY time DESC" %
+                    ", ".join("?" * len(hrefs)), hrefs)
+        return self._posts("ORDER BY time DESC")
+
+    def get(self, href):
+        "Return the post for URL, or None. "
+        for post in self._posts("WHERE href = ?", (href,)):
+            return post
+
+    def get_hash(self, urlmd5):
+        "Return the post for the URL MD5, or None. "
+        for post in self._posts("WHERE hash = ?", (urlmd5,)):
+            return post
+
+    def tagged(self, tags, match_all=True, ignore_case=False):
+        """Iterate over the posts that have all of the tags, or any of them if
+        ``match_all`` is false.
+        """
+        if not tags:
+            return iter(())
+        tags = dict([(ignore_case and t.lower() or t, t)
+            for t in tags]).values()
+        cmp = ignore_case and "tag COLLATE NOCASE" or "tag"
+        where = "%s IN (%s)" % (cmp, ", ".join("?" * len(tags)))
+        if match_all:
+            distinct = ignore_case and "lower(tag)" or "tag"
+            sub = ("SELECT hash FROM post_tags WHERE %s GROUP BY hash "
+                "HAVING count(DISTINCT %s) = %i" % (where, distinct, len(tags)))
+        else:
+            sub = "SELECT hash FROM post_tags WHERE %s" % where
+        return self._posts("WHERE hash IN (%s) ORDER BY time DESC" % sub, tags)
+
+    def search(self, keyword, ignore_case=False):
+        "Iterate over all posts with keyword in any text field. "
+        fields = "(ifnull(tag, '') || href || ifnull(description, '') || " \
+            "ifnull(extended, ''))"
+        if ignore_case:
+            fields = "lower(%s)" % fields
+            keyword = keyword.lower()
+        # GLOB is case-sensitive (unlike LIKE) and in every SQLite version
+        return self._posts("WHERE %s GLOB ? ORDER BY time DESC" % fields,
+                ('*%s*' % glob_escape(keyword),))
+
+    def count_tags(self):
+        return self.db.execute("SELECT count(*) FROM tags").fetchone()[0]
+
+    def tags(self):
+        "Iterate over the tags, as dictionaries with 'tag' and 'count'. "
+        for tag, count in self.db.execute(
+                "SELECT tag, count FROM tags ORDER BY tag"):
+            yield {'tag': tag, 'count': str(count)}
+
+    def tags_per_post(self):
+        "Return the minimum and maximum number of tags on a post. "
+        return self.db.execute("SELECT min(n), max(n) FROM (SELECT "
+            "count(post_tags.tag) AS n FROM posts LEFT JOIN post_tags "
+            "ON posts.hash = post_tags.hash GROUP BY posts.hash)").fetchone()
+
+    def _posts(self, clause, args=()):
+        for row in self.db.execute("SELECT %s FROM posts %s" % (
+                ", ".join(POST_FIELDS), clause), args):
+            yield dict([(k, v) for k, v in zip(POST_FIELDS, row)
+                if v is not None])
+
+
+def glob_escape(text):
+    "Quote the GLOB wildcards in text. "
+    return ''.join([c in '*?[' and '[%s]' % c or c for c in text])
+
+
+def split_tags(tag):
+    "Split a space separated tag string, ignoring empty tags. "
+    if not tag:
+        return []
+    return [t for t in tag.split(' ') if t]
@@ -0,0 +1,155 @@
+"""Incremental synchronization of a local copy of a del.icio.us collection.
+
+Instead of downloading the complete ``posts/all`` document whenever the
+collection changed, ``PostsSync`` requests the posts manifest (URL and meta
+hashes, see ``DeliciousAPI.posts_all(hashes=True)``), compares it with the
+signatures held in a local store and fetches only new or changed posts, in
+batches of ``posts/get?hashes=...`` calls.
+
+A store is any object with the methods:
+
+- ``signatures()``, returns a dictionary with URL MD5 -> meta signature for
+  all locally stored posts;
+- ``update(posts)``, adds or replaces posts (dictionaries as parsed by
+  ``pydelicious.dlcs_parse_xml``);
+- ``remove(hashes)``, deletes the posts with these URL MD5s;
+- ``replace(posts)``, replaces the entire collection;
+- ``commit(**attrs)``, saves the changes and any collection attributes.
+
+``store.PostStore`` is the SQLite store used by `dlcs`. ``XMLPostsFile``
+keeps a plain ``posts/all`` XML document instead, as a backup that any
+``posts/all`` reader can load, e.g. with
+``SyncScheduler(store_class=XMLPostsFile)`` or::
+
+    PostsSync(DeliciousAPI(user, passwd), XMLPostsFile('posts.xml')).sync()
+"""
+import os
+
+try:
+    from elementtree.ElementTree import Element, SubElement, ElementTree
+except ImportError:
+    # Python 2.5 and higher
+    from xml.etree.ElementTree import Element, SubElement, ElementTree
+
+from pydelicious import dlcs_parse_xml
+
+
+DLCS_HASHES_BATCH = 50
+"Number of posts to request per posts/get call"
+DLCS_FULL_SYNC_RATIO = .5
+"Fetch posts/all instead if more than this part of the collection changed"
+
+
+class PostsSync:
+
+    """Brings a local store up to date with the collection of the user of a
+    ``DeliciousAPI`` instance.
+
+    With `page_size` a full fetch requests that many posts at a time (see
+    ``DeliciousAPI.posts_pages()``) instead of all posts in one response,
+    which can time out for very large collections.
+
+    Some attributes (set after each ``sync()``):
+    :added: the number of new posts
+    :changed: the number of updated posts
+    :removed: the number of deleted posts
+    :requests: the number of API requests made
+    """
+
+    def __init__(self, dlcs, store, batch=DLCS_HASHES_BATCH,
+            full_sync_ratio=DLCS_FULL_SYNC_RATIO, page_size=None):
+        self.dlcs = dlcs
+        self.store = store
+        self.batch = batch
+        self.full_sync_ratio = full_sync_ratio
+        self.page_size = page_size
+        self.added = self.changed = self.removed = self.requests = 0
+
+    def sync(self):
+        """Update the store, returns True when anything changed.
+        """
+        self.added = self.changed = self.removed = 0
+
+        manifest = self.dlcs.posts_all(hashes=True)
+        self.requests = 1
+        remote = dict([(p['url'], p.get('meta')) for p in manifest['posts']])
+        local = self.store.signatures()
+
+        fetch = [h for h, meta in remote.items() if local.get(h) != meta]
+        remove = [h for h in local if h not in remote]
+        self.added = len([h for h in fetch if h not in local])
+        self.changed = len(fetch) - self.added
+        self.removed = len(remove)
+
+        attrs = dict([(k, v) for k, v in manifest.items() if k != 'posts'])
+
+        if remote and len(fetch) > len(remote) * self.full_sync_ratio \
+                and self.page_size:
+            pages = self.dlcs.posts_pages(meta=True, results=self.page_size)
+            self.store.replace(post for page in pages for post in page)
+            self.requests += pages.requests
+            attrs.update(pages.attrs or {})
+
+        elif remote and len(fetch) > len(remote) * self.full_sync_ratio:
+            # Cheaper to get everything at once
+            posts = self.dlcs.posts_all(meta=True)
+            self.requests += 1
+            attrs.update([(k, v) for k, v in posts.items() if k != 'posts'])
+            self.store.replace(posts['posts'])
+
+        else:
+            for i in range(0, len(fetch), self.batch):
+                posts = self.dlcs.posts_get(hashes=fetch[i:i+self.batch],
+                        meta=True)
+                self.requests += 1
+                self.store.update(posts['posts'])
+            if remove:
+                self.store.remove(remove)
+
+        self.store.commit(**attrs)
+        return bool(fetch or remove)
+
+
+class XMLPostsFile:
+
+    """Store for ``PostsSync`` in a ``posts/all`` XML document at path, for
+    backups readable without the SQLite store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.attrs = {}
+        self.posts = {}
+        if os.path.exists(path):
+            data = dlcs_parse_xml(open(path))
+            self.attrs = dict([(k, v) for k, v in data.items()
+                    if k != 'posts'])
+            for post in data['posts']:
+                self.posts[post['hash']] = post
+
+    def signatures(self):
+        return dict([(h, p.get('meta')) for h, p in self.posts.items()])
+
+    def update(self, posts):
+        for post in posts:
+            self.posts[post['hash']] = post
+
+    def remove(self, hashes):
+        for h in hashes:
+            del self.posts[h]
+
+    def replace(self, posts):
+        self.posts = {}
+        self.update(posts)
+
+    def commit(self, **attrs):
+        self.attrs.update(attrs)
+        root = Element('posts', self.attrs)
+        # Keep the most recent posts first, like posts/all
+        posts = self.posts.values()
+        posts.sort(key=lambda p: p.get('time'), reverse=True)
+        for post in posts:
+            SubElement(root, 'post', post)
+        tmp = self.path + '.tmp'
+        ElementTree(root).write(tmp, 'utf-8')
+        os.rename(tmp, self.path)
@@ -0,0 +1,180 @@
+"""In-memory inverted tag index over a bookmark collection.
+
+``TagIndex`` maps each tag to the set of posts (by URL MD5) carrying it, and
+each post to its tags, so AND/OR tag queries and tag co-occurrence are
+answered with set operations instead of scanning every post. The index can
+be saved to and loaded from a file next to the `dlcs` cache.
+"""
+import marshal
+
+try:
+    # Python >= 2.4
+    assert set and frozenset
+except (NameError, AssertionError):
+    from sets import Set as set, ImmutableSet as frozenset
+
+from store import split_tags
+
+
+class TagQueries:
+
+    """The tag queries of ``TagIndex`` and ``snapshot.Snapshot``. Posts are
+    identified by whatever the class uses, the class provides:
+
+    - ``_posts_tagged(tag)``, the posts with exactly this tag;
+    - ``_all_tags()``, all tags;
+    - ``_count_tags(posts)``, a dictionary with the number of the posts
+      carrying each tag.
+
+    The mapping of lower-cased tags is kept in `_folded`, None to rebuild it.
+    """
+
+    _folded = None
+
+    def tagged(self, tag, ignore_case=False):
+        "Return the set of posts with the tag. "
+        if not ignore_case:
+            return set(self._posts_tagged(tag))
+        posts = set()
+        for variant in self.folded().get(tag.lower(), ()):
+            posts.update(self._posts_tagged(variant))
+        return posts
+
+    def query(self, all=(), any=(), ignore_case=False):
+        """Return the set of posts that carry all of the tags in `all`, and
+        at least one of the tags in `any` (if given).
+        """
+        result = None
+        if all:
+            postings = [self.tagged(t, ignore_case) for t in all]
+            postings.sort(key=len)
+            result = postings[0]
+            for posts in postings[1:]:
+                if not result:
+                    break
+                result &= posts
+        if any:
+            union = set()
+            for tag in any:
+                union |= self.tagged(tag, ignore_case)
+            if result is None:
+                result = union
+            else:
+                result &= union
+        return result or set()
+
+    def related(self, tags, ignore_case=False):
+        """Return a dictionary with the number of times every other tag
+        occurs on the posts that carry all `tags`.
+        """
+        if ignore_case:
+            exclude = set([t.lower() for t in tags])
+        else:
+            exclude = set(tags)
+        counts = self._count_tags(self.query(all=tags,
+            ignore_case=ignore_case))
+        for tag in counts.keys():
+            if (ignore_case and tag.lower() or tag) in exclude:
+                del counts[tag]
+        return counts
+
+    def folded(self):
+        "Return a mapping of lower-cased tags to the actual tags. "
+        if self._folded is None:
+            self._folded = {}
+            for tag in self._all_tags():
+                self._folded.setdefault(tag.lower(), []).append(tag)
+        return self._folded
+
+
+class TagIndex(TagQueries):
+
+    """Tag -> posts and post -> tags mapping.
+
+    Some attributes:
+    :stamp: a value identifying the version of the collection indexed,
+        e.g. the time the posts where cached
+    :posts: maps URL MD5 to a tuple with href, time and frozenset of tags
+    :tags: maps tag to the set of URL MD5s
+    """
+
+    def __init__(self, stamp=None):
+        self.stamp = stamp
+        self.posts = {}
+        self.tags = {}
+        self._folded = None
+
+    def add(self, post):
+        "Add or replace a post (a dictionary as parsed from the API). "
+        h = post['hash']
+        if h in self.posts:
+            self.remove(h)
+        tags = frozenset(split_tags(post.get('tag')))
+        self.posts[h] = (post['href'], post.get('time'), tags)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(h)
+        self._folded = None
+
+    def remove(self, h):
+        href, time, tags = self.posts.pop(h)
+        for tag in tags:
+            self.tags[tag].discard(h)
+            if not self.tags[tag]:
+                del self.tags[tag]
+        self._folded = None
+
+    def __len__(self):
+        return len(self.posts)
+
+    def _posts_tagged(self, tag):
+        return self.tags.get(tag, ())
+
+    def _all_tags(self):
+        return self.tags
+
+    def _count_tags(self, posts):
+        counts = {}
+        for h in posts:
+            for tag in self.posts[h][2]:
+                counts[tag] = counts.get(tag, 0) + 1
+        return counts
+
+    def hrefs(self, posts):
+        "Return the URLs for a set of posts, most recent first. "
+        posts = [self.posts[h] for h in posts]
+        posts.sort(key=lambda p: p[1], reverse=True)
+        return [p[0] for p in posts]
+
+    ## Persistence
+
+    def save(self, path):
+        data = {'stamp': self.stamp, 'posts': dict([
+            (h, (href, time, tuple(tags)))
+            for h, (href, time, tags) in self.posts.items()])}
+        fl = open(path, 'wb')
+        try:
+            marshal.dump(data, fl)
+        finally:
+            fl.close()
+
+    def load(klass, path):
+        fl = open(path, 'rb')
+        try:
+            data = marshal.load(fl)
+        finally:
+            fl.close()
+        index = klass(data['stamp'])
+        for h, (href, time, tags) in data['posts'].items():
+            tags = frozenset(tags)
+            index.posts[h] = (href, time, tags)
+            for tag in tags:
+                index.tags.setdefault(tag, set()).add(h)
+        return index
+    load = classmethod(load)
+
+    def from_posts(klass, posts, stamp=None):
+        index = klass(stamp)
+        for post in posts:
+            index.add(post)
+        return index
+    from_posts = classmethod(from_posts)